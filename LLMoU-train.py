@@ -1,6 +1,7 @@
 import argparse
+import copy
+import functools
 import logging
-import math
 import os.path
 import typing
 from typing import Optional, Union, Tuple
@@ -15,9 +16,20 @@ from tqdm.auto import tqdm
 from transformers import GPT2Tokenizer, AutoTokenizer
 
 from config.config import TQDM_KWARGS
-from modules.dataset import DatasetLLMoU
+from modules.dataset import DatasetLLMoU, multirc_texts
 from modules.modeling_LLMoU import LLMoUModel, LLMoUConfig
-from utils.utils import make2d, save_checkpoints, get_config_by_name, device_info, get_memory, count_model_parameters, \
+from modules.checkpointing import apply_gradient_checkpointing, CHECKPOINT_POLICIES
+from modules.precision import PrecisionPolicy
+from utils.async_checkpoint import AsyncCheckpointWriter
+from utils.async_evaluator import AsyncEvaluator
+from utils.evaluation import evaluate, StridedWindows, pack_documents
+from utils.distributed import setup_distributed, cleanup_distributed, distributed_device, distributed_model, \
+    distributed_sampler, broadcast_object, is_main_process
+from utils.metrics import TrainMetrics
+from utils.profiling import ModuleProfiler
+from utils.sharded_optimizer import ShardedOptimizer, shard_name, load_optimizer_state
+from utils.train_step import GradientAccumulator, causal_lm_loss
+from utils.utils import make2d, get_config_by_name, device_info, count_model_parameters, \
     create_output_path
 
 # torch.manual_seed(42)
@@ -32,6 +44,28 @@ pars.add_argument('--weight', '--weight', type=str, default='out/LLMoU-ML/weight
 pars.add_argument('--out-path', '--out-path', type=str, default='out')
 pars.add_argument('--model', '--model', type=str, default='LLMoU-ML')
 pars.add_argument('--data-src', '--data-src', type=str, default='HF-super_glue/multirc')
+pars.add_argument('--token-cache', '--token-cache', type=str, default='.cache/tokenized')
+pars.add_argument('--accumulate', '--accumulate', type=int, default=1)
+pars.add_argument('--precision', '--precision', type=str, default='fp32', choices=['fp32', 'bf16'])
+pars.add_argument('--checkpointing', '--checkpointing', type=str, default='none', choices=list(CHECKPOINT_POLICIES))
+pars.add_argument('--checkpoint-every', '--checkpoint-every', type=int, default=2)
+pars.add_argument('--backend', '--backend', type=str, default='gloo')
+pars.add_argument('--keep-checkpoints', '--keep-checkpoints', type=int, default=1)
+pars.add_argument('--zero', '--zero', type=bool, default=False)
+pars.add_argument('--log-every', '--log-every', type=int, default=50)
+pars.add_argument('--eval-every', '--eval-every', type=int, default=50,
+                  help='steps between two sample generations of the evaluator process (0 disables them)')
+pars.add_argument('--eval-threads', '--eval-threads', type=int, default=1)
+pars.add_argument('--eval-split', '--eval-split', type=str, default='validation',
+                  help='held out split of the dataset the evaluator measures the perplexity on')
+pars.add_argument('--eval-overlap', '--eval-overlap', type=int, default=None,
+                  help='tokens shared by consecutive perplexity windows, half a window if None')
+pars.add_argument('--eval-windows', '--eval-windows', type=int, default=64,
+                  help='perplexity windows evaluated each time (0 for the whole split)')
+pars.add_argument('--eval-batch', '--eval-batch', type=int, default=8)
+pars.add_argument('--eval-workers', '--eval-workers', type=int, default=1)
+pars.add_argument('--profile', '--profile', type=int, default=0,
+                  help='profile the first N training steps, runs the eager model (--compile is ignored)')
 
 options = pars.parse_args()
 
@@ -46,32 +80,59 @@ def inter_q(question: Optional[str], tokenizer: GPT2Tokenizer) \
     return out['input_ids'], out['attention_mask']
 
 
+def sample(model: LLMoUModel, step: int, board: Optional[SummaryWriter], tokenizer: GPT2Tokenizer, question: str,
+           windows: Optional[StridedWindows], **evaluate_kwargs):
+    """
+    runs in the evaluator process, generates the answer to `question` and measures the perplexity of the held out
+    `windows` (None without a held out split)
+    """
+    tk, _ = inter_q(question, tokenizer=tokenizer)
+    device = next(model.parameters()).device
+    tk = tk.to(device)
+    try:
+        cals = torch.cat([pred for pred in model.generate(tokens=tk, attention_mask=None,
+                                                          eos_id=tokenizer.eos_token_id)], dim=-1)
+        awn = tokenizer.decode(cals.to('cpu')[0])
+    except Exception:
+        awn = 'error'
+    board.add_text('train/Context', f'{question}', global_step=step)
+    board.add_text('train/GeneratedResponse', f'{awn}', global_step=step)
+    if windows is not None:
+        result = evaluate(model, windows, **evaluate_kwargs)
+        board.add_scalar('eval/Loss', result['loss'], global_step=step)
+        board.add_scalar('eval/Perplexity', result['perplexity'], global_step=step)
+
+
 def train(input_ids: Optional[Tensor],
           targets: Optional[Tensor],
           attention_mask: Optional[Tensor],
           network: Optional[LLMoUModel.forward],
-          optim: Optional[torch.optim.AdamW],
-          loss_average: Optional[Tensor],
-          device: Union[torch.device, str]) -> [typing.Union[torch.Tensor],
-                                                typing.Union[torch.Tensor]]:
+          accumulator: Optional[GradientAccumulator],
+          precision: Optional[PrecisionPolicy],
+          device: Union[torch.device, str]) -> typing.Union[torch.Tensor]:
     labels: Optional[Tensor] = make2d(targets.type(torch.long).to(device))
     input_ids: Optional[Tensor] = make2d(input_ids.type(torch.long).to(device))
     attention_mask: Optional[Tensor] = make2d(attention_mask.type(torch.long).to(device))
     logger.debug('RUNNING TRAIN FUNCTION IN MAIN THREAD ')
-    _, loss = network(input_ids=input_ids, labels=labels, attention_mask=attention_mask)
+    with accumulator.no_sync():
+        with precision.autocast():
+            logits, _ = network(input_ids=input_ids, attention_mask=attention_mask)
+        loss_sum, num_tokens = causal_lm_loss(logits, labels, attention_mask=attention_mask)
+        accumulator.backward(loss_sum, num_tokens)
+    loss = loss_sum.detach() / num_tokens.clamp(min=1)
 
-    loss_average += loss.item()
-    optim.zero_grad(set_to_none=True)
-    loss.backward()
-    optim.step()
-    return loss, loss_average
+    return loss
 
 
 def main(opt):
+    setup_distributed(opt.backend)
     if opt.weight is None:
-        out_path = create_output_path(path=opt.out_path, name=opt.model)
-        if not os.path.exists(os.path.join(out_path, 'weights')):
-            os.mkdir(os.path.join(out_path, 'weights'))
+        out_path = None
+        if is_main_process():
+            out_path = create_output_path(path=opt.out_path, name=opt.model)
+            if not os.path.exists(os.path.join(out_path, 'weights')):
+                os.mkdir(os.path.join(out_path, 'weights'))
+        out_path = broadcast_object(out_path)
     else:
         if opt.weight.endswith('.pt'):
             out_path = opt.weight.split('/')
@@ -98,9 +159,13 @@ def main(opt):
         data = None
         raise ValueError()
     parameters: LLMoUConfig = get_config_by_name(opt.model)
+    parameters.device = distributed_device(parameters.device)
+    precision = PrecisionPolicy(opt.precision, device=parameters.device)
+    precision.prepare_config(parameters)
     tokenizer: GPT2Tokenizer = AutoTokenizer.from_pretrained('tokenizer_model/LLMoU-C')
 
-    dataset = DatasetLLMoU(data=data, max_length=parameters.max_sentence_length, tokenizer=tokenizer)
+    dataset = DatasetLLMoU(data=data, max_length=parameters.max_sentence_length, tokenizer=tokenizer,
+                           cache_dir=opt.token_cache)
     parameters.vocab_size = dataset.tokenizer.vocab_size
 
     parameters.vocab_size += 7
@@ -108,8 +173,9 @@ def main(opt):
     parameters.data_path = opt.data_src
 
     parameters.batch_size = opt.batch
+    sampler = distributed_sampler(dataset)
     dataloader = torch.utils.data.DataLoader(dataset=dataset, batch_size=parameters.batch_size, num_workers=4,
-                                             pin_memory=True)
+                                             pin_memory=True, sampler=sampler)
     erutils.loggers.show_hyper_parameters(parameters)
 
     fprint('Loading Model ...' if opt.weight is not None else 'Creating Model ...')
@@ -117,7 +183,8 @@ def main(opt):
     model = LLMoUModel(config=parameters).to(parameters.device) if opt.weight is not None else LLMoUModel(
         config=parameters).to('cpu')
     optimizer_kwargs = dict(lr=parameters.lr, weight_decay=parameters.weight_decay)
-    optimizer = torch.optim.AdamW(model.parameters(), **optimizer_kwargs)
+    optimizer = ShardedOptimizer(model.parameters(), torch.optim.AdamW, **optimizer_kwargs) if opt.zero else \
+        torch.optim.AdamW(model.parameters(), **optimizer_kwargs)
     model_parameters_size: typing.Optional[float] = count_model_parameters(model)
 
     checkpoints = torch.load(opt.weight, 'cpu') if opt.weight is not None else None
@@ -125,70 +192,88 @@ def main(opt):
     if checkpoints is not None:
         model.load_state_dict(checkpoints['model'])
         model = model.to(parameters.device)
-        optimizer.load_state_dict(checkpoints['optimizer'])
+        load_optimizer_state(optimizer, checkpoints, opt.weight)
     fprint(
         f'Model Loaded With {model_parameters_size} Million Parameters' if opt.weight is not None
         else f'Model Created With {model_parameters_size} Million Parameters')
 
-    if opt.compile:
+    apply_gradient_checkpointing(model, opt.checkpointing, every=opt.checkpoint_every)
+    if opt.compile and not opt.profile:
         model = torch.compile(model)
         fprint(f"Model Compiled Successfully")
-    board = SummaryWriter(log_dir=f'{out_path}/tensorboard', filename_suffix=f'{opt.model}')
+    board = SummaryWriter(log_dir=f'{out_path}/tensorboard', filename_suffix=f'{opt.model}') \
+        if is_main_process() else None
     at = 0 if opt.weight is None else checkpoints['at']
 
     question = 'paragraph: my name is erfan question: what is my name ?' + dataset.agent
     model = model.to(device=parameters.device)
+    network = distributed_model(model)
 
     if opt.train:
         logger.info('TRAIN IS ABOUT TO START')
+        accumulator = GradientAccumulator(optimizer, accumulation_steps=opt.accumulate, model=network)
+        checkpoint_writer = AsyncCheckpointWriter(keep_last=opt.keep_checkpoints)
+        metrics = TrainMetrics(board, flush_every=opt.log_every, device=parameters.device)
+        profiler = ModuleProfiler(model, steps=opt.profile).start() if opt.profile and is_main_process() else None
+        evaluator = None
+        if opt.eval_every > 0 and is_main_process():
+            # sample generation and held out perplexity run on a cpu copy of the model in their own process
+            eval_config = copy.deepcopy(parameters)
+            eval_config.device = 'cpu'
+            windows = None
+            if opt.data_src.startswith('HF-') and opt.eval_split in data:
+                windows = StridedWindows(
+                    pack_documents(multirc_texts(data[opt.eval_split], agent=dataset.agent, eos=dataset.eos),
+                                   tokenizer),
+                    seq_len=parameters.max_sentence_length, pad_id=tokenizer.pad_token_id,
+                    overlap=opt.eval_overlap if opt.eval_overlap is not None else parameters.max_sentence_length // 2)
+            evaluator = AsyncEvaluator(model, functools.partial(LLMoUModel, config=eval_config),
+                                       functools.partial(sample, tokenizer=tokenizer, question=question,
+                                                         windows=windows, batch_size=opt.eval_batch,
+                                                         num_workers=opt.eval_workers,
+                                                         max_windows=opt.eval_windows or None),
+                                       log_dir=f'{out_path}/tensorboard', threads=opt.eval_threads)
         for epoch in range(checkpoints['epoch'] if opt.weight is not None else 0, parameters.epochs):
-            loss_avg = 0
-            with tqdm(enumerate(dataloader), **TQDM_KWARGS,
-                      total=math.ceil(dataset.__len__() // parameters.batch_size)) as progress_bar:
+            with tqdm(enumerate(dataloader), **TQDM_KWARGS, disable=not is_main_process(),
+                      total=len(dataloader)) as progress_bar:
+                metrics.start_epoch(progress_bar, epoch=f'[{epoch}/{parameters.epochs}]', device=parameters.device)
                 for i, (input_ids_t, attention_mask) in progress_bar:
                     logger.debug(f'\033[1;94m input_ids_t    : {input_ids_t.shape}')
                     logger.debug(f'\033[1;94m attention_mask : {attention_mask.shape}')
 
-                    loss, loss_avg = train(input_ids=input_ids_t, targets=input_ids_t, network=model,
-                                           optim=optimizer,
-                                           loss_average=loss_avg, device=parameters.device,
-                                           attention_mask=attention_mask)
-
-                    free_gpu, used_gpu, total_gpu = get_memory(0)
-                    if ((i + 1) % 50) == 0:
-                        tk, _ = inter_q(question, tokenizer=tokenizer
-                                        )
-                        tk = tk.to(parameters.device)
-                        cals = []
-                        try:
-                            for pred in model.generate(tokens=tk,
-                                                       attention_mask=None,
-                                                       eos_id=tokenizer.eos_token_id):
-                                cals.append(pred)
-                            cals = torch.cat(cals, dim=-1)
-                            cals = cals.to('cpu')
-                            awn = tokenizer.decode(cals[0])
-                        except:
-                            awn = 'error'
-                            pass
-                        del cals
-
-                        board.add_scalar('train/Loss', scalar_value=loss.item(), global_step=at)
-                        board.add_scalar('train/avg-Loss', scalar_value=(loss_avg / (i + 1)),
-                                         global_step=at)
-                        board.add_text('train/Context', f'{question}', global_step=at)
-                        board.add_text('train/GeneratedResponse', f'{awn}', global_step=at)
+                    loss = train(input_ids=input_ids_t, targets=input_ids_t, network=network,
+                                 accumulator=accumulator, precision=precision, device=parameters.device,
+                                 attention_mask=attention_mask)
+                    if profiler is not None and profiler.step():
+                        progress_bar.write(profiler.save(f'{out_path}/profile'))
+                        profiler = None
+                    metrics.update(Loss=loss)
+                    metrics.step(at)
+                    if evaluator is not None and (i + 1) % opt.eval_every == 0:
+                        evaluator.submit(model, step=at)
                     at += 1
-                    progress_bar.set_postfix(epoch=f'[{epoch}/{parameters.epochs}]', device=parameters.device,
-                                             loss_avg=(loss_avg / (i + 1)),
-                                             loss=loss.item(), free_GPU=free_gpu, used_GPU=used_gpu)
 
+                accumulator.flush()
                 print()
-                save_checkpoints(model=model.state_dict(), optimizer=optimizer.state_dict(),
-                                 epochs=parameters.epochs, at=at,
-                                 epoch=epoch + 1, config=opt.model,
-                                 name=f'{out_path}/weights/{opt.model}-model.pt')
-                progress_bar.write('==> MODEL SAVED SUCCESSFULLY')
+                if is_main_process():
+                    stalled = checkpoint_writer.save(model=model.state_dict(), optimizer=optimizer.state_dict(),
+                                                     epochs=parameters.epochs, at=at,
+                                                     epoch=epoch + 1, config=opt.model,
+                                                     name=f'{out_path}/weights/{opt.model}-model.pt')
+                    progress_bar.write(f'==> MODEL SAVED IN BACKGROUND (training stalled {stalled:.2f}s)')
+                elif opt.zero:
+                    # rotated along with the main checkpoint, model.1.pt keeps its shard in model.1.rank1.pt
+                    checkpoint_writer.save(optimizer=optimizer.state_dict(), file_of=shard_name,
+                                           name=f'{out_path}/weights/{opt.model}-model.pt')
+        if profiler is not None:
+            # training ended before the requested number of steps
+            profiler.stop()
+            fprint(profiler.save(f'{out_path}/profile'))
+        metrics.close()
+        checkpoint_writer.close()
+        if evaluator is not None:
+            evaluator.close()
+    cleanup_distributed()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 import argparse
 import logging
-import math
 import typing
 from typing import Optional, Union
 
@@ -10,11 +9,21 @@ from datasets import load_dataset
 from erutils.loggers import fprint
 from torch import Tensor
 from tqdm.auto import tqdm
-from transformers import GPT2Tokenizer
+from transformers import GPT2Tokenizer, GPT2TokenizerFast
 
 from modules.dataset import DatasetLLama
 from modules.modeling_LLAmA import LLamaModel, LLamaConfig, Tokens
-from utils.utils import make2d, save_checkpoints, get_config_by_name, device_info, get_memory, _init_weights
+from modules.checkpointing import apply_gradient_checkpointing, CHECKPOINT_POLICIES
+from modules.precision import PrecisionPolicy
+from utils.streaming import StreamingTextDataset, is_article_text
+from utils.async_checkpoint import AsyncCheckpointWriter
+from utils.empty_init import init_empty_weights, assign_weights
+from utils.distributed import setup_distributed, cleanup_distributed, distributed_device, distributed_model, \
+    distributed_sampler, even_batches, broadcast_object, is_main_process
+from utils.metrics import TrainMetrics
+from utils.profiling import ModuleProfiler
+from utils.train_step import GradientAccumulator, token_loss
+from utils.utils import make2d, get_config_by_name, device_info, _init_weights
 
 torch.backends.cudnn.benchmark = True
 
@@ -28,6 +37,19 @@ pars.add_argument('--out-path', '--out-path', type=str, default='out')
 pars.add_argument('--weight', '--weight', type=str, default=None)
 pars.add_argument('--model', '--model', type=str, default='LLama')
 pars.add_argument('--data-src', '--data-src', type=str, default='HF-wikitext/wikitext-2-v1')
+pars.add_argument('--token-cache', '--token-cache', type=str, default='.cache/tokenized')
+pars.add_argument('--streaming', '--streaming', type=bool, default=False)
+pars.add_argument('--max-records', '--max-records', type=int, default=None)
+pars.add_argument('--shuffle-buffer', '--shuffle-buffer', type=int, default=10_000)
+pars.add_argument('--accumulate', '--accumulate', type=int, default=1)
+pars.add_argument('--precision', '--precision', type=str, default='fp32', choices=['fp32', 'bf16'])
+pars.add_argument('--checkpointing', '--checkpointing', type=str, default='none', choices=list(CHECKPOINT_POLICIES))
+pars.add_argument('--checkpoint-every', '--checkpoint-every', type=int, default=2)
+pars.add_argument('--backend', '--backend', type=str, default='gloo')
+pars.add_argument('--keep-checkpoints', '--keep-checkpoints', type=int, default=1)
+pars.add_argument('--log-every', '--log-every', type=int, default=50)
+pars.add_argument('--profile', '--profile', type=int, default=0,
+                  help='profile the first N training steps, runs the eager model (--compile is ignored)')
 
 options = pars.parse_args()
 
@@ -38,37 +60,39 @@ logging.basicConfig(level=logging.WARN)
 def train(input_ids: Optional[Tensor],
           targets: Optional[Tensor],
           network: Optional[LLamaModel.forward],
-          optim: Optional[torch.optim.AdamW],
-          loss_function: Optional[torch.nn.CrossEntropyLoss],
-          loss_average: Optional[Tensor],
-          device: Union[torch.device, str]) -> [typing.Union[torch.Tensor],
-                                                typing.Union[torch.Tensor]]:
+          accumulator: Optional[GradientAccumulator],
+          precision: Optional[PrecisionPolicy],
+          device: Union[torch.device, str]) -> typing.Union[torch.Tensor]:
     targets: Optional[Tensor] = make2d(targets.type(torch.long).to(device))
     input_ids: Optional[Tensor] = make2d(input_ids.type(torch.long).to(device))
-    network.zero_grad(set_to_none=True)
-    predict = network(tokens=input_ids, pos_start=0)
+    with accumulator.no_sync():
+        with precision.autocast():
+            predict = network(tokens=input_ids, pos_start=0)
 
-    # shift_logits = predict[..., :-1, :].contiguous()
-    shift_logits = predict.contiguous()
-    shift_labels = targets[..., -1].contiguous()
+        # shift_logits = predict[..., :-1, :].contiguous()
+        shift_logits = predict.contiguous()
+        shift_labels = targets[..., -1].contiguous()
 
-    shift_logits = shift_logits.view(-1 if shift_logits.shape[0] > 1 else 1, shift_logits.size(-1))
+        shift_logits = shift_logits.view(-1 if shift_logits.shape[0] > 1 else 1, shift_logits.size(-1))
 
-    shift_labels = shift_labels.view(-1)
+        shift_labels = shift_labels.view(-1)
 
-    loss_prediction = loss_function(shift_logits, shift_labels)
+        loss_sum, num_tokens = token_loss(shift_logits, shift_labels)
+        accumulator.backward(loss_sum, num_tokens)
+    loss_prediction = loss_sum.detach() / num_tokens.clamp(min=1)
 
-    loss_average += loss_prediction.item()
-    loss_prediction.backward()
-    optim.step()
-    return loss_prediction, loss_average
+    return loss_prediction
 
 
 def main(opt):
+    setup_distributed(opt.backend)
     if opt.weight is None:
-        out_path = create_output_path(path=opt.out_path, name=opt.model)
-        if not os.path.exists(os.path.join(out_path, 'weights')):
-            os.mkdir(os.path.join(out_path, 'weights'))
+        out_path = None
+        if is_main_process():
+            out_path = create_output_path(path=opt.out_path, name=opt.model)
+            if not os.path.exists(os.path.join(out_path, 'weights')):
+                os.mkdir(os.path.join(out_path, 'weights'))
+        out_path = broadcast_object(out_path)
     else:
         if opt.weight.endswith('.pt'):
             out_path = opt.weight.split('/')
@@ -79,94 +103,126 @@ def main(opt):
         else:
             raise ValueError('weight must contain path to .pt file')
     device_info()
-    if not opt.data_src.startswith('HF-'):
-        data = open(opt.data_src, 'r', encoding='utf8').read().split('<|endoftext|>')
-    else:
-        name = opt.data_src.replace('HF-', '')
-        if '/' in name:
-            model_name = name.split('/')
-            data = load_dataset(model_name[0], model_name[1])
-        else:
-            data = load_dataset(name)
-        data = data["train"]['text']
-        selected = int(len(data) * 0.1)
-        data = data[:selected]
-    board = SummaryWriter(log_dir=f'{out_path}/tensorboard', filename_suffix=f'{opt.model}')
+    board = SummaryWriter(log_dir=f'{out_path}/tensorboard', filename_suffix=f'{opt.model}') \
+        if is_main_process() else None
 
     parameters: LLamaConfig = get_config_by_name(opt.model)
-    tokenizer: GPT2Tokenizer = GPT2Tokenizer.from_pretrained('gpt2-medium', bos_token=Tokens.eos,
-                                                             pad_token=Tokens.pad, sos_token=Tokens.sos)
-    dataset = DatasetLLama(data=data, max_length=parameters.max_sentence_length, tokenizer=tokenizer)
+    parameters.device = distributed_device(parameters.device)
+    precision = PrecisionPolicy(opt.precision, device=parameters.device)
+    tokenizer: GPT2Tokenizer = GPT2TokenizerFast.from_pretrained('gpt2-medium', bos_token=Tokens.eos,
+                                                                 pad_token=Tokens.pad, sos_token=Tokens.sos)
+    if opt.streaming:
+        dataset = DatasetLLama(data=None, max_length=parameters.max_sentence_length, tokenizer=tokenizer)
+        train_data = StreamingTextDataset(opt.data_src, tokenizer=tokenizer, seq_len=parameters.max_sentence_length,
+                                          prefix=dataset.sos, suffix=dataset.eos,
+                                          keep=is_article_text,
+                                          shuffle_buffer_size=opt.shuffle_buffer, max_records=opt.max_records,
+                                          return_mask=False)
+    else:
+        if not opt.data_src.startswith('HF-'):
+            data = open(opt.data_src, 'r', encoding='utf8').read().split('<|endoftext|>')
+        else:
+            name = opt.data_src.replace('HF-', '')
+            if '/' in name:
+                model_name = name.split('/')
+                data = load_dataset(model_name[0], model_name[1])
+            else:
+                data = load_dataset(name)
+            data = data["train"]['text']
+            selected = int(len(data) * 0.1)
+            data = data[:selected]
+        dataset = DatasetLLama(data=data, max_length=parameters.max_sentence_length, tokenizer=tokenizer,
+                               cache_dir=opt.token_cache)
+        train_data = dataset
     parameters.vocab_size = dataset.tokenizer.vocab_size
     parameters.vocab_size += 2
     # parameters.device = 'cpu'
     parameters.data_path = opt.data_src
 
     parameters.batch_size = opt.batch
-    dataloader = torch.utils.data.DataLoader(dataset=dataset, batch_size=parameters.batch_size, num_workers=4,
-                                             pin_memory=True)
+    sampler = distributed_sampler(train_data)
+    dataloader = torch.utils.data.DataLoader(dataset=train_data, batch_size=parameters.batch_size, num_workers=4,
+                                             pin_memory=True, sampler=sampler)
     erutils.loggers.show_hyper_parameters(parameters)
 
     fprint('Loading Model ...' if opt.weight is not None else 'Creating Model ...')
 
-    model = LLamaModel(config=parameters).to(parameters.device) if opt.weight is not None else LLamaModel(
-        config=parameters).to('cpu')
-    model.apply(_init_weights)
+    checkpoints = torch.load(opt.weight, 'cpu') if opt.weight is not None else None
+    if checkpoints is not None:
+        # random init is skipped, the parameters are the tensors of the checkpoint
+        with init_empty_weights():
+            model = LLamaModel(config=parameters)
+        model = assign_weights(model, checkpoints['model'], device=parameters.device)
+    else:
+        model = LLamaModel(config=parameters).to('cpu')
+        model.apply(_init_weights)
+    # the optimizer must be built on the assigned parameters
     optimizer_kwargs = dict(lr=parameters.lr, weight_decay=parameters.weight_decay)
     optimizer = torch.optim.AdamW(model.parameters(), **optimizer_kwargs)
     model_parameters_size: typing.Optional[float] = sum(p.numel() for p in model.parameters()) / 1e6
 
-    checkpoints = torch.load(opt.weight, 'cpu') if opt.weight is not None else None
-
     if checkpoints is not None:
-        model.load_state_dict(checkpoints['model'])
-        model = model.to(parameters.device)
         optimizer.load_state_dict(checkpoints['optimizer'])
     fprint(
         f'Model Loaded With {model_parameters_size} Million Parameters' if opt.weight is not None
         else f'Model Created With {model_parameters_size} Million Parameters')
-    criterion = torch.nn.CrossEntropyLoss()
 
-    if opt.compile:
+    apply_gradient_checkpointing(model, opt.checkpointing, every=opt.checkpoint_every)
+    if opt.compile and not opt.profile:
         model = torch.compile(model)
         fprint(f"Model Compiled Successfully")
 
     question = dataset.encode(Tokens.sos + 'say something ').to(parameters.device)
     question = question['input_ids'].to(parameters.device)
     model = model.to(device=parameters.device)
+    network = distributed_model(model)
     logger.info('TRAIN IS ABOUT TO START!!!')
     if opt.train:
         logger.info('TRAIN IS ABOUT TO START')
         at = 0
+        accumulator = GradientAccumulator(optimizer, accumulation_steps=opt.accumulate, model=network)
+        checkpoint_writer = AsyncCheckpointWriter(keep_last=opt.keep_checkpoints)
+        metrics = TrainMetrics(board, flush_every=opt.log_every, device=parameters.device)
+        profiler = ModuleProfiler(model, steps=opt.profile).start() if opt.profile and is_main_process() else None
         for epoch in range(checkpoints['epoch'] if opt.load else 0, parameters.epochs):
-            loss_avg = 0
-            with tqdm(enumerate(dataloader), colour='blue',
-                      total=math.ceil(dataset.__len__() // parameters.batch_size)) as progress_bar:
+            if opt.streaming:
+                train_data.set_epoch(epoch)
+            with tqdm(enumerate(even_batches(dataloader) if opt.streaming else dataloader), colour='blue',
+                      disable=not is_main_process(), total=None if opt.streaming else len(dataloader)) \
+                    as progress_bar:
+                metrics.start_epoch(progress_bar, epoch=f'[{epoch}/{parameters.epochs}]', device=parameters.device)
                 for i, (input_ids_t) in progress_bar:
                     at += 1
-                    loss, loss_avg = train(input_ids=input_ids_t, targets=input_ids_t, network=model, optim=optimizer,
-                                           loss_average=loss_avg, loss_function=criterion, device=parameters.device)
-                    free_gpu, used_gpu, total_gpu = get_memory(0)
-                    progress_bar.set_postfix(epoch=f'[{epoch}/{parameters.epochs}]', device=parameters.device,
-                                             loss_avg=(loss_avg / (i + 1)),
-                                             loss=loss.item(), free_GPU=free_gpu, used_GPU=used_gpu)
-                    if (i + 1) % 50 == 0:
+                    loss = train(input_ids=input_ids_t, targets=input_ids_t, network=network,
+                                 accumulator=accumulator, precision=precision, device=parameters.device)
+                    if profiler is not None and profiler.step():
+                        progress_bar.write(profiler.save(f'{out_path}/profile'))
+                        profiler = None
+                    metrics.update(Loss=loss)
+                    metrics.step(at)
+                    if (i + 1) % 50 == 0 and board is not None:
                         predictions = model.generate(prompts=question, max_gen_len=30,
                                                      pad_id=dataset.tokenizer.pad_token_id,
                                                      eos_id=dataset.tokenizer.eos_token_id)
-                        board.add_scalar('train/Loss', scalar_value=loss.item(), global_step=at)
-                        board.add_scalar('train/avg-Loss', scalar_value=(loss_avg / (i + 1)),
-                                         global_step=at)
                         board.add_text('train/GeneratedResponse',
                                        f'QUESTION : {dataset.tokenizer.decode(question[0])} |'
                                        f' PREDICTION : {dataset.tokenizer.decode(predictions)}')
 
+                accumulator.flush()
                 print()
-                save_checkpoints(model=model.state_dict(), optimizer=optimizer.state_dict(),
-                                 epochs=parameters.epochs, at=at,
-                                 epoch=epoch + 1, config=opt.model,
-                                 name=f'{out_path}/weights/{opt.model}-model.pt')
-                progress_bar.write('==> MODEL SAVED SUCCESSFULLY')
+                if is_main_process():
+                    stalled = checkpoint_writer.save(model=model.state_dict(), optimizer=optimizer.state_dict(),
+                                                     epochs=parameters.epochs, at=at,
+                                                     epoch=epoch + 1, config=opt.model,
+                                                     name=f'{out_path}/weights/{opt.model}-model.pt')
+                    progress_bar.write(f'==> MODEL SAVED IN BACKGROUND (training stalled {stalled:.2f}s)')
+        if profiler is not None:
+            # training ended before the requested number of steps
+            profiler.stop()
+            fprint(profiler.save(f'{out_path}/profile'))
+        metrics.close()
+        checkpoint_writer.close()
+    cleanup_distributed()
 
 
 if __name__ == "__main__":
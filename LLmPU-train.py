@@ -1,6 +1,5 @@
 import argparse
 import logging
-import math
 from typing import Tuple, Optional, Union
 
 import erutils
@@ -16,7 +15,14 @@ from transformers import T5Tokenizer, AutoTokenizer
 from config.config import TQDM_KWARGS
 from modules.dataset import DatasetLLmPU
 from modules.modeling_LLmPU import LLmPUForConditionalGeneration, LLmPUConfig
-from utils.utils import make2d, count_model_parameters, save_checkpoints, device_info, get_config_by_name, get_memory, \
+from modules.precision import PrecisionPolicy
+from utils.async_checkpoint import AsyncCheckpointWriter
+from utils.distributed import setup_distributed, cleanup_distributed, distributed_device, distributed_model, \
+    distributed_sampler, broadcast_object, is_main_process
+from utils.metrics import TrainMetrics
+from utils.profiling import ModuleProfiler
+from utils.train_step import GradientAccumulator, token_loss
+from utils.utils import make2d, count_model_parameters, device_info, get_config_by_name, \
     _init_weights
 
 logging.basicConfig(level=logging.WARN)
@@ -29,6 +35,15 @@ pars.add_argument('--compile', '--compile', type=bool, default=False)
 pars.add_argument('--load', '--load', type=bool, default=True)
 pars.add_argument('--out-path', '--out-path', type=str, default='out')
 pars.add_argument('--model', '--model', type=str, default='LLmPU-small')
+pars.add_argument('--accumulate', '--accumulate', type=int, default=1)
+pars.add_argument('--precision', '--precision', type=str, default='fp32', choices=['fp32', 'bf16'])
+pars.add_argument('--pre-encode', '--pre-encode', type=str, default='lazy', choices=['lazy', 'eager', 'none'])
+pars.add_argument('--backend', '--backend', type=str, default='gloo')
+pars.add_argument('--keep-checkpoints', '--keep-checkpoints', type=int, default=1)
+pars.add_argument('--log-every', '--log-every', type=int, default=50)
+pars.add_argument('--profile', '--profile', type=int, default=0,
+                  help='profile the first N training steps, runs the eager model (--compile is ignored)')
+pars.add_argument('--debug-inf-checks', '--debug-inf-checks', type=bool, default=False)
 
 opt = pars.parse_args()
 
@@ -50,25 +65,32 @@ def prepare_data(source_mask: Optional[torch.Tensor], source_ids: Optional[torch
 
 
 def train(m: Optional[LLmPUForConditionalGeneration],
-          optim: Optional[torch.optim.AdamW],
+          accumulator: Optional[GradientAccumulator],
+          precision: Optional[PrecisionPolicy],
           source_mask: Optional[torch.Tensor],
           source_ids: Optional[torch.Tensor],
           target_ids: Optional[torch.Tensor],
           device: Union[torch.device, str]) -> Optional[torch.Tensor]:
     input_ids, mask, decoder_input, labels = prepare_data(source_mask, source_ids, target_ids, device=device)
-    out = m(input_ids=input_ids, attention_mask=mask, decoder_input_ids=decoder_input, labels=labels)
-    loss_model = out[0]
-    optim.zero_grad()
-    loss_model.backward()
-    optim.step()
-    return loss_model
+    with accumulator.no_sync():
+        with precision.autocast():
+            # LLmPUConfig has none of the output_* defaults of a PretrainedConfig, they are passed explicitly
+            out = m(input_ids=input_ids, attention_mask=mask, decoder_input_ids=decoder_input,
+                    output_attentions=False, output_hidden_states=False, return_dict=True)
+        loss_sum, num_tokens = token_loss(out['logits'], labels)
+        accumulator.backward(loss_sum, num_tokens)
+    return loss_sum.detach() / num_tokens.clamp(min=1)
 
 
 def _main(opt):
+    setup_distributed(opt.backend)
     if opt.weight is None:
-        out_path = create_output_path(path=opt.out_path, name=opt.model)
-        if not os.path.exists(os.path.join(out_path, 'weights')):
-            os.mkdir(os.path.join(out_path, 'weights'))
+        out_path = None
+        if is_main_process():
+            out_path = create_output_path(path=opt.out_path, name=opt.model)
+            if not os.path.exists(os.path.join(out_path, 'weights')):
+                os.mkdir(os.path.join(out_path, 'weights'))
+        out_path = broadcast_object(out_path)
     else:
         if opt.weight.endswith('.pt'):
             out_path = opt.weight.split('/')
@@ -80,12 +102,14 @@ def _main(opt):
             raise ValueError('weight must contain path to .pt file')
     device_info()
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = distributed_device('cuda' if torch.cuda.is_available() else 'cpu')
     tokenizer: T5Tokenizer = AutoTokenizer.from_pretrained('tokenizer_model/LLmPU')
     data_frame = pd.read_csv('ipynb/news_summary.csv')
     data_frame["text"] = "summarize: " + data_frame["text"]
     data_frame = data_frame[0:500]
     config: LLmPUConfig = get_config_by_name(opt.model, vocab_size=tokenizer.vocab_size)
+    config.debug_inf_checks = opt.debug_inf_checks
+    precision = PrecisionPolicy(opt.precision, device=device)
     show_hyper_parameters(config)
     model = LLmPUForConditionalGeneration(config=config).to(device if not opt.load else 'cpu')
     model.apply(_init_weights)
@@ -105,45 +129,45 @@ def _main(opt):
     else:
         optimizer = torch.optim.Adam(model.parameters(), 3e-4)
     dataset = DatasetLLmPU(tokenizer=tokenizer, source_len=source_length, target_len=target_length,
-                           source_text=data_frame['text'], target_text=data_frame['headlines'])
-    dataloader_kw = dict(batch_size=opt.batch_size, shuffle=True, pin_memory=True)
+                           source_text=data_frame['text'], target_text=data_frame['headlines'],
+                           pre_encode=None if opt.pre_encode == 'none' else opt.pre_encode)
+    sampler = distributed_sampler(dataset, shuffle=True)
+    dataloader_kw = dict(batch_size=opt.batch_size, shuffle=sampler is None, sampler=sampler, pin_memory=True)
     dataloader = DataLoader(dataset, **dataloader_kw)
     casual_iter = 0
-    if opt.compile:
+    if opt.compile and not opt.profile:
         model = torch.compile(model)
         erutils.fprint('Model Compiled Successfully !')
     mesh = config.mesh
-    board = SummaryWriter(log_dir=f'{out_path}/tensorboard', filename_suffix=f'{opt.model}')
+    board = SummaryWriter(log_dir=f'{out_path}/tensorboard', filename_suffix=f'{opt.model}') \
+        if is_main_process() else None
+    network = distributed_model(model)
     if opt.train:
+        accumulator = GradientAccumulator(optimizer, accumulation_steps=opt.accumulate, model=network)
+        checkpoint_writer = AsyncCheckpointWriter(keep_last=opt.keep_checkpoints)
+        metrics = TrainMetrics(board, flush_every=opt.log_every, device=device)
+        profiler = ModuleProfiler(model, steps=opt.profile).start() if opt.profile and is_main_process() else None
         for epoch in range(opt.epochs):
-            total_loss = 0
+            if sampler is not None:
+                sampler.set_epoch(epoch)
             with tqdm(iterable=enumerate(dataloader),
-                      total=math.ceil(dataset.__len__() / opt.batch_size),
+                      total=len(dataloader), disable=not is_main_process(),
                       **TQDM_KWARGS) as progress_bar:
+                metrics.start_epoch(progress_bar, epoch=f'[{epoch}/{opt.epochs}]')
                 for i, data in progress_bar:
                     casual_iter += 1
 
                     _source_ids, _source_mask, _target_ids = data['source_ids'], data['source_mask'], data['target_ids']
-                    loss = train(model, optimizer, source_mask=_source_mask, source_ids=_source_ids,
+                    loss = train(network, accumulator, precision, source_mask=_source_mask, source_ids=_source_ids,
                                  target_ids=_target_ids,
                                  device=device)
-                    total_loss += loss
-                    avg = total_loss.item() / (i + 1)
-                    free_gpu, used_gpu, total_gpu = get_memory(0)
-                    progress_bar.set_postfix(loss=loss.item(), epoch=f'[{epoch}/{opt.epochs}]',
-                                             avg=avg, free_GPU=free_gpu, used_GPU=used_gpu)
-                    if (i + 1) % 50 == 0:
+                    if profiler is not None and profiler.step():
+                        progress_bar.write(profiler.save(f'{out_path}/profile'))
+                        profiler = None
+                    metrics.update(Loss=loss)
+                    if metrics.step(casual_iter) and board is not None:
                         board_args = dict(global_step=casual_iter, new_style=True)
-                        board.add_scalar('train/Loss', scalar_value=loss.item(), **board_args)
-                        board.add_scalar('train/avgLoss', scalar_value=avg, **board_args)
                         board.add_scalar('train/epochs', scalar_value=epoch, **board_args)
-                        board.add_scalar('train/gpu_used', scalar_value=used_gpu, **board_args)
-                        board.add_scalar('train/gpu_free', scalar_value=free_gpu, **board_args)
-                        board.add_scalars('cuda0', {
-                            'total': total_gpu,
-                            'free': free_gpu,
-                            'used': used_gpu
-                        }, global_step=casual_iter)
                         board.add_scalars('meshController', {
                             'sin': i * np.sin(i / mesh),
                             'cos': i * np.cos(i / mesh),
@@ -152,13 +176,23 @@ def _main(opt):
                         board.add_scalar('train/meshIter_sin', scalar_value=i * np.sin(i / mesh), **board_args)
                         board.add_scalar('train/meshIter_cos', scalar_value=i * np.cos(i / mesh), **board_args)
                         board.add_scalar('train/meshIter_tan', scalar_value=np.tan(i / mesh), **board_args)
-                progress_bar.write('=> Saving Model Checkpoints')
-                save_checkpoints(model=model.state_dict(), optimizer=optimizer.state_dict(),
-                                 epochs=opt.epochs,
-                                 epoch=epoch + 1,
-                                 conf=config,
-                                 config_name=opt.model,
-                                 name=f'{out_path}/weights/{opt.model}-model.pt')
+                accumulator.flush()
+                if is_main_process():
+                    progress_bar.write('=> Saving Model Checkpoints')
+                    stalled = checkpoint_writer.save(model=model.state_dict(), optimizer=optimizer.state_dict(),
+                                                     epochs=opt.epochs,
+                                                     epoch=epoch + 1,
+                                                     conf=config,
+                                                     config_name=opt.model,
+                                                     name=f'{out_path}/weights/{opt.model}-model.pt')
+                    progress_bar.write(f'=> Checkpoint queued, training stalled {stalled:.2f}s')
+        if profiler is not None:
+            # training ended before the requested number of steps
+            profiler.stop()
+            erutils.fprint(profiler.save(f'{out_path}/profile'))
+        metrics.close()
+        checkpoint_writer.close()
+    cleanup_distributed()
 
 
 if __name__ == "__main__":
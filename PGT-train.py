@@ -1,5 +1,6 @@
 import argparse
-import math
+import copy
+import functools
 import typing
 from typing import Optional, Union
 
@@ -10,7 +11,18 @@ from erutils.loggers import fprint
 from tqdm.auto import tqdm
 
 from modules.models import PGT
-from utils.utils import DatasetPGTC, make2d, save_checkpoints, get_config_by_name, device_info, get_memory
+from modules.checkpointing import apply_gradient_checkpointing, CHECKPOINT_POLICIES
+from modules.precision import PrecisionPolicy
+from utils.streaming import StreamingTextDataset, is_article_text
+from utils.async_checkpoint import AsyncCheckpointWriter
+from utils.async_evaluator import AsyncEvaluator
+from utils.evaluation import evaluate, StridedWindows, pack_documents
+from utils.distributed import setup_distributed, cleanup_distributed, distributed_device, distributed_model, \
+    distributed_sampler, even_batches, is_main_process
+from utils.metrics import TrainMetrics
+from utils.profiling import ModuleProfiler
+from utils.train_step import GradientAccumulator, causal_lm_loss
+from utils.utils import DatasetPGTC, make2d, get_config_by_name, device_info
 
 Tensor = torch.Tensor
 torch.backends.cudnn.benchmark = True
@@ -23,60 +35,111 @@ pars.add_argument('--compile', '--compile', type=bool, default=True)
 pars.add_argument('--weight', '--weight', type=str, default=None)
 pars.add_argument('--model', '--model', type=str, default='PGT-As')
 pars.add_argument('--data-src', '--data-src', type=str, default='HF-wikitext/wikitext-103-raw-v1')
+pars.add_argument('--token-cache', '--token-cache', type=str, default='.cache/tokenized')
+pars.add_argument('--streaming', '--streaming', type=bool, default=False)
+pars.add_argument('--max-records', '--max-records', type=int, default=None)
+pars.add_argument('--shuffle-buffer', '--shuffle-buffer', type=int, default=10_000)
+pars.add_argument('--accumulate', '--accumulate', type=int, default=1)
+pars.add_argument('--precision', '--precision', type=str, default='fp32', choices=['fp32', 'bf16'])
+pars.add_argument('--checkpointing', '--checkpointing', type=str, default='none', choices=list(CHECKPOINT_POLICIES))
+pars.add_argument('--checkpoint-every', '--checkpoint-every', type=int, default=2)
+pars.add_argument('--backend', '--backend', type=str, default='gloo')
+pars.add_argument('--keep-checkpoints', '--keep-checkpoints', type=int, default=1)
+pars.add_argument('--log-every', '--log-every', type=int, default=50)
+pars.add_argument('--eval', '--eval', type=bool, default=True,
+                  help='sample generation of the evaluator process after every epoch')
+pars.add_argument('--eval-threads', '--eval-threads', type=int, default=1)
+pars.add_argument('--eval-split', '--eval-split', type=str, default='validation',
+                  help='held out split of the dataset the evaluator measures the perplexity on')
+pars.add_argument('--eval-overlap', '--eval-overlap', type=int, default=None,
+                  help='tokens shared by consecutive perplexity windows, half a window if None')
+pars.add_argument('--eval-windows', '--eval-windows', type=int, default=64,
+                  help='perplexity windows evaluated each time (0 for the whole split)')
+pars.add_argument('--eval-batch', '--eval-batch', type=int, default=8)
+pars.add_argument('--eval-workers', '--eval-workers', type=int, default=1)
+pars.add_argument('--profile', '--profile', type=int, default=0,
+                  help='profile the first N training steps, runs the eager model (--compile is ignored)')
 
 options = pars.parse_args()
 
 
+def sample(model: PGT, step: int, board, tokenizer, question: Tensor, eos: int, windows: Optional[StridedWindows],
+           **evaluate_kwargs):
+    """
+    runs in the evaluator process, generates 256 tokens after `question` and measures the perplexity of the held out
+    `windows` (None without a held out split)
+    """
+    device = next(model.parameters()).device
+    predictions = model.generate(idx=question.to(device), eos=eos, generate=256)
+    board.add_text('train/Context', tokenizer.decode(question[0], skip_special_tokens=False), global_step=step)
+    board.add_text('train/GeneratedResponse', tokenizer.decode(predictions[0], skip_special_tokens=False),
+                   global_step=step)
+    if windows is not None:
+        result = evaluate(model, windows, **evaluate_kwargs)
+        board.add_scalar('eval/Loss', result['loss'], global_step=step)
+        board.add_scalar('eval/Perplexity', result['perplexity'], global_step=step)
+
+
 def main(opt):
     def train(input_ids: Optional[Tensor],
               targets: Optional[Tensor],
               attention_mask: Optional[Tensor],
               network: Optional[PGT],
-              optim: Optional[torch.optim.AdamW],
-              loss_function: Optional[torch.nn.CrossEntropyLoss],
-              loss_average: Optional[Tensor],
-              device: Union[torch.device, str]) -> [typing.Union[torch.Tensor],
-                                                    typing.Union[torch.Tensor]]:
+              accumulator: Optional[GradientAccumulator],
+              precision: Optional[PrecisionPolicy],
+              device: Union[torch.device, str]) -> typing.Union[torch.Tensor]:
         targets: Optional[Tensor] = make2d(targets.type(torch.long).to(device))
         input_ids: Optional[Tensor] = make2d(input_ids.type(torch.long).to(device))
         attention_mask: Optional[Tensor] = make2d(attention_mask.to(device))
-        predict = network(inputs=input_ids,
-                          attention_mask=attention_mask)
-        optim.zero_grad(set_to_none=True)
+        with accumulator.no_sync():
+            with precision.autocast():
+                predict = network(inputs=input_ids,
+                                  attention_mask=attention_mask)
 
-        shift_logits = predict[..., :-1, :].contiguous()
-        shift_labels = targets[..., 1:].contiguous()
+            loss_sum, num_tokens = causal_lm_loss(predict, targets, attention_mask=attention_mask)
+            accumulator.backward(loss_sum, num_tokens)
+        loss_prediction = loss_sum.detach() / num_tokens.clamp(min=1)
 
-        loss_prediction = loss_function(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
-
-        loss_average += loss_prediction.item()
-        loss_prediction.backward()
-        optim.step()
-        return loss_prediction, loss_average
+        return loss_prediction
 
+    setup_distributed(opt.backend)
     device_info()
-    if not opt.data_src.startswith('HF-'):
-        data = open(opt.data_src, 'r', encoding='utf8').read().split('<|endoftext|>')
+    parameters = get_config_by_name(opt.model)
+    parameters.device = distributed_device(parameters.device)
+    precision = PrecisionPolicy(opt.precision, device=parameters.device)
+    held_out = None
+    if opt.streaming:
+        dataset = DatasetPGTC(data=None, chunk=parameters.chunk)
+        train_data = StreamingTextDataset(opt.data_src, tokenizer=dataset.tokenizer, seq_len=parameters.chunk,
+                                          prefix=dataset.sos, suffix=dataset.eos,
+                                          keep=is_article_text,
+                                          shuffle_buffer_size=opt.shuffle_buffer, max_records=opt.max_records)
     else:
-        name = opt.data_src.replace('HF-', '')
-        if '/' in name:
-            model_name = name.split('/')
-            data = load_dataset(model_name[0], model_name[1])
+        if not opt.data_src.startswith('HF-'):
+            data = open(opt.data_src, 'r', encoding='utf8').read().split('<|endoftext|>')
         else:
-            data = load_dataset(name)
-        data = data["train"]['text']
-        selected = int(len(data) * 0.1)
-        data = data[:selected]
-    parameters = get_config_by_name(opt.model)
-    dataset = DatasetPGTC(data=data, chunk=parameters.chunk)
+            name = opt.data_src.replace('HF-', '')
+            if '/' in name:
+                model_name = name.split('/')
+                data = load_dataset(model_name[0], model_name[1])
+            else:
+                data = load_dataset(name)
+            if opt.eval_split in data:
+                held_out = data[opt.eval_split]['text']
+            data = data["train"]['text']
+            selected = int(len(data) * 0.1)
+            data = data[:selected]
+        dataset = DatasetPGTC(data=data, chunk=parameters.chunk, cache_dir=opt.token_cache)
+        train_data = dataset
     parameters.vocab_size = dataset.vocab_size
     parameters.vocab_size += 2
     # parameters.device = 'cpu'
     parameters.data_path = opt.data_src
 
     parameters.batch_size = opt.batch
-    dataloader = torch.utils.data.DataLoader(dataset=dataset, batch_size=parameters.batch_size, num_workers=4,
-                                             pin_memory=True)
+    sampler = distributed_sampler(train_data)
+    dataloader = torch.utils.data.DataLoader(dataset=train_data, batch_size=parameters.batch_size, num_workers=4,
+                                             pin_memory=True, sampler=sampler)
     erutils.loggers.show_hyper_parameters(parameters)
 
     fprint('Loading Model ...' if opt.load else 'Creating Model ...')
@@ -94,42 +157,76 @@ def main(opt):
     fprint(
         f'Model Loaded With {model_parameters_size} Million Parameters' if opt.load
         else f'Model Created With {model_parameters_size} Million Parameters')
-    criterion = torch.nn.CrossEntropyLoss()
 
-    if opt.compile:
+    apply_gradient_checkpointing(model, opt.checkpointing, every=opt.checkpoint_every)
+    if opt.compile and not opt.profile:
         model = torch.compile(model)
         fprint(f"Model Compiled Successfully")
 
     question = dataset.encode('USER: hello how are you ?').to(parameters.device)
     question = question['input_ids'].to(parameters.device)
     model = model.to(device=parameters.device)
+    network = distributed_model(model)
     if opt.train:
-
+        accumulator = GradientAccumulator(optimizer, accumulation_steps=opt.accumulate, model=network)
+        checkpoint_writer = AsyncCheckpointWriter(keep_last=opt.keep_checkpoints)
+        metrics = TrainMetrics(flush_every=opt.log_every, device=parameters.device)
+        profiler = ModuleProfiler(model, steps=opt.profile).start() if opt.profile and is_main_process() else None
+        evaluator = None
+        if opt.eval and is_main_process():
+            # sample generation and held out perplexity run on a cpu copy of the model in their own process
+            eval_config = copy.deepcopy(parameters)
+            eval_config.device = 'cpu'
+            windows = None
+            if held_out is not None:
+                # documents as DatasetPGTC trains on them
+                texts = [dataset.sos + d + dataset.eos for d in held_out if d != '' and not d.startswith(' =')]
+                windows = StridedWindows(pack_documents(texts, dataset.tokenizer), seq_len=parameters.chunk,
+                                         overlap=opt.eval_overlap if opt.eval_overlap is not None
+                                         else parameters.chunk // 2, pad_id=dataset.tokenizer.pad_token_id)
+            evaluator = AsyncEvaluator(model, functools.partial(PGT, config=eval_config),
+                                       functools.partial(sample, tokenizer=dataset.tokenizer, question=question.cpu(),
+                                                         eos=dataset.tokenizer.eos_token_id, windows=windows,
+                                                         batch_size=opt.eval_batch, num_workers=opt.eval_workers,
+                                                         max_windows=opt.eval_windows or None),
+                                       log_dir='tensorboard', threads=opt.eval_threads)
         for epoch in range(checkpoints['epoch'] if opt.load else 0, parameters.epochs):
-            loss_avg = 0
-            with tqdm(enumerate(dataloader), colour='white',
-                      total=math.ceil(dataset.__len__() // parameters.batch_size)) as progress_bar:
+            if opt.streaming:
+                train_data.set_epoch(epoch)
+            with tqdm(enumerate(even_batches(dataloader) if opt.streaming else dataloader), colour='white',
+                      disable=not is_main_process(), total=None if opt.streaming else len(dataloader)) \
+                    as progress_bar:
+                metrics.start_epoch(progress_bar, epoch=f'[{epoch}/{parameters.epochs}]', device=parameters.device)
                 for i, (input_ids_t, attention_mask_t) in progress_bar:
-                    loss, loss_avg = train(input_ids=input_ids_t, targets=input_ids_t, network=model, optim=optimizer,
-                                           attention_mask=attention_mask_t,
-                                           loss_average=loss_avg, loss_function=criterion, device=parameters.device)
-                    free_gpu, used_gpu, total_gpu = get_memory(0)
-                    progress_bar.set_postfix(epoch=f'[{epoch}/{parameters.epochs}]', device=parameters.device,
-                                             loss_avg=(loss_avg / (i + 1)),
-                                             loss=loss.item(), free_GPU=free_gpu, used_GPU=used_gpu)
-
+                    loss = train(input_ids=input_ids_t, targets=input_ids_t, network=network,
+                                 accumulator=accumulator, precision=precision,
+                                 attention_mask=attention_mask_t, device=parameters.device)
+                    if profiler is not None and profiler.step():
+                        progress_bar.write(profiler.save('profile'))
+                        profiler = None
+                    metrics.update(Loss=loss)
+                    metrics.step()
+
+                accumulator.flush()
                 print()
-                save_checkpoints(model=model.state_dict(), optimizer=optimizer.state_dict(),
-                                 epochs=parameters.epochs,at=at,
-                                 epoch=epoch + 1, config=opt.model,
-                                 name='model.pt')
-                progress_bar.write('==> MODEL SAVED SUCCESSFULLY')
-                predictions = model.generate(idx=question, eos=dataset.tokenizer.eos_token_id,
-                                             generate=256
-
-                                             )
-                progress_bar.write(f'QUESTION : {dataset.decode(question)}')
-                progress_bar.write(f'PREDICTION : {dataset.decode(predictions)}')
+                if not is_main_process():
+                    continue
+                stalled = checkpoint_writer.save(model=model.state_dict(), optimizer=optimizer.state_dict(),
+                                                 epochs=parameters.epochs,at=at,
+                                                 epoch=epoch + 1, config=opt.model,
+                                                 name='model.pt')
+                progress_bar.write(f'==> MODEL SAVED IN BACKGROUND (training stalled {stalled:.2f}s)')
+                if evaluator is not None:
+                    evaluator.submit(model, step=epoch + 1)
+        if profiler is not None:
+            # training ended before the requested number of steps
+            profiler.stop()
+            fprint(profiler.save('profile'))
+        metrics.close()
+        checkpoint_writer.close()
+        if evaluator is not None:
+            evaluator.close()
+    cleanup_distributed()
 
 
 if __name__ == "__main__":
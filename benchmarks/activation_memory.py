@@ -0,0 +1,165 @@
+import argparse
+import json
+from collections import OrderedDict
+
+import torch
+from erutils.loggers import fprint
+
+from benchmarks.training_throughput import FAMILIES
+from modules.checkpointing import apply_gradient_checkpointing, CHECKPOINT_POLICIES
+from modules.precision import PrecisionPolicy
+from utils.activation_memory import ActivationMemoryTracker, CATEGORIES, parameter_bytes, optimizer_state_bytes, \
+    fit_activation_memory, extrapolate
+from utils.metrics import memory_stats
+
+pars = argparse.ArgumentParser(description='activation memory of one training step of a get_config_by_name config, '
+                                           'per block and per category, plus parameters, gradients and optimizer '
+                                           'state, extrapolated to other batch sizes and sequence lengths')
+pars.add_argument('--config', '--config', type=str, default='LLmP-S', help='name given to get_config_by_name')
+pars.add_argument('--batch', '--batch', type=int, default=1)
+pars.add_argument('--seq-len', '--seq-len', type=int, default=256)
+pars.add_argument('--vocab-size', '--vocab-size', type=int, default=32000)
+pars.add_argument('--hidden-size', '--hidden-size', type=int, default=None, help='overrides the config')
+pars.add_argument('--n-layers', '--n-layers', type=int, default=None, help='overrides the config')
+pars.add_argument('--n-heads', '--n-heads', type=int, default=None, help='overrides the config')
+pars.add_argument('--precision', '--precision', type=str, default='fp32', choices=['fp32', 'bf16'])
+pars.add_argument('--checkpointing', '--checkpointing', type=str, default='none', choices=list(CHECKPOINT_POLICIES))
+pars.add_argument('--checkpoint-every', '--checkpoint-every', type=int, default=2)
+pars.add_argument('--batch-sizes', '--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8],
+                  help='batch sizes of the extrapolation table')
+pars.add_argument('--seq-lens', '--seq-lens', type=int, nargs='+', default=[128, 256, 512, 1024, 2048],
+                  help='sequence lengths of the extrapolation table')
+pars.add_argument('--budget-gb', '--budget-gb', type=float, default=None,
+                  help='memory of the machine, the table marks what does not fit')
+pars.add_argument('--device', '--device', type=str, default='cpu')
+pars.add_argument('--out', '--out', type=str, default=None, help='json file the report is written to')
+
+# checked longest prefix first, LLmPU-S is not an LLmP config
+PREFIXES = (('PGT-J', 'PGT-J'), ('PGT', 'PGT'), ('LLama', 'LLama'), ('LLmPU', 'LLmPU'), ('LLmP', 'LLmP'),
+            ('LLMoU', 'LLMoU'))
+
+MB = 2 ** 20
+GB = 2 ** 30
+
+
+def family_of(config: str) -> str:
+    for prefix, family in PREFIXES:
+        if config.startswith(prefix):
+            return family
+    raise ValueError(f'no model family for config {config}')
+
+
+def model_dims(model: torch.nn.Module) -> set:
+    """
+    sizes of the weight matrices (hidden, feed forward, heads x head dim ...), embeddings excluded (their rows are the
+    vocabulary or the positions)
+    """
+    return {size for module in model.modules() if not isinstance(module, torch.nn.Embedding)
+            for p in module.parameters(recurse=False) if p.ndim >= 2 for size in p.shape}
+
+
+def probe_length(model: torch.nn.Module, seq_len: int) -> int:
+    """
+    shorter sequence length of the fit, odd (model dimensions are even) and none of the model dimensions, so no hidden
+    state of the probe step is [..., probe, probe] like the attention scores
+    """
+    dims = model_dims(model)
+    probe = max(seq_len // 2, 1) | 1
+    while probe > 1 and (probe in dims or probe >= seq_len):
+        probe -= 2
+    return probe
+
+
+def step(model: torch.nn.Module, loss_fn, precision: PrecisionPolicy, opt, seq_len: int) -> ActivationMemoryTracker:
+    """
+    forward and backward of one synthetic batch, the activations are counted before backward frees them
+    """
+    ids = torch.randint(1, opt.vocab_size, (opt.batch, seq_len), generator=torch.Generator().manual_seed(0))
+    ids = ids.to(opt.device)
+    with ActivationMemoryTracker(model, seq_len=seq_len, vocab_size=opt.vocab_size) as tracker:
+        with precision.autocast():
+            loss = loss_fn(model, ids)
+    loss.backward()
+    return tracker
+
+
+def table(rows, title: str) -> str:
+    header = f'{title:<28} ' + ' '.join(f'{c:>16}' for c in CATEGORIES) + f' {"total":>10}'
+    lines = [header, '-' * len(header)]
+    for name, row in rows.items():
+        lines.append(f'{name[-28:]:<28} ' + ' '.join(f'{row[c] / MB:>13.1f} MB' for c in CATEGORIES) +
+                     f' {sum(row.values()) / MB:>7.1f} MB')
+    totals = {c: sum(row[c] for row in rows.values()) for c in CATEGORIES}
+    lines.append(f'{"total":<28} ' + ' '.join(f'{totals[c] / MB:>13.1f} MB' for c in CATEGORIES) +
+                 f' {sum(totals.values()) / MB:>7.1f} MB')
+    return '\n'.join(lines)
+
+
+def main(opt):
+    family = family_of(opt.config)
+    # the family builder of the training suite, sized by the config (flags left to None keep its values)
+    sized = argparse.Namespace(**{**vars(opt), 'seq_lens': [opt.seq_len], 'batch_sizes': [opt.batch]})
+    torch.manual_seed(0)
+    model, loss_fn = FAMILIES[family](sized)
+    model = model.to(opt.device).train()
+    apply_gradient_checkpointing(model, opt.checkpointing, every=opt.checkpoint_every)
+    precision = PrecisionPolicy(opt.precision, device=opt.device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    # a second, shorter step separates the activations growing with seq_len from those growing with seq_len ** 2
+    probe = probe_length(model, opt.seq_len)
+    if opt.seq_len in model_dims(model):
+        fprint(f'seq-len {opt.seq_len} is a dimension of the model, its [..., {opt.seq_len}, {opt.seq_len}] hidden '
+               f'states inside attention count as attention scores, choose another seq-len to separate them')
+    measured = OrderedDict()
+    for seq_len in (probe, opt.seq_len):
+        measured[seq_len] = step(model, loss_fn, precision, opt, seq_len).rows
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    parameters, gradients = parameter_bytes(model)
+    optimizer_state = optimizer_state_bytes(optimizer)
+    static = parameters + gradients + optimizer_state
+    rows = measured[opt.seq_len]
+    activations = sum(sum(row.values()) for row in rows.values())
+
+    fprint(f'{opt.config} ({family}) | batch {opt.batch} x {opt.seq_len} | {opt.precision} | '
+           f'checkpointing {opt.checkpointing} | {sum(p.numel() for p in model.parameters()) / 1e6:.1f}M parameters')
+    print(table(rows, 'activations'))
+    fprint(f'parameters {parameters / MB:.1f} MB | gradients {gradients / MB:.1f} MB | '
+           f'optimizer state {optimizer_state / MB:.1f} MB | activations {activations / MB:.1f} MB')
+    # gradients are allocated while backward frees the activations, so the sum is an upper bound of the peak
+    fprint(f'estimated training step peak {(static + activations) / GB:.2f} GB | measured '
+           + ' '.join(f'{k} {v:.2f}' for k, v in memory_stats(opt.device).items()))
+
+    coefficients = fit_activation_memory(measured, opt.batch)
+    estimates = OrderedDict()
+    for batch in opt.batch_sizes:
+        for seq_len in opt.seq_lens:
+            estimate = extrapolate(coefficients, batch, seq_len)
+            estimates[f'{batch}x{seq_len}'] = dict(
+                activations=sum(sum(row.values()) for row in estimate.values()),
+                attention_scores=sum(row['attention_scores'] for row in estimate.values()),
+                total=static + sum(sum(row.values()) for row in estimate.values()))
+    fprint(f'estimated training step peak in GB (batch x seq_len)'
+           + (f', * does not fit in {opt.budget_gb} GB' if opt.budget_gb is not None else ''))
+    print(f'{"batch":>6} ' + ' '.join(f'{s:>9}' for s in opt.seq_lens))
+    for batch in opt.batch_sizes:
+        cells = []
+        for seq_len in opt.seq_lens:
+            total = estimates[f'{batch}x{seq_len}']['total'] / GB
+            over = opt.budget_gb is not None and total > opt.budget_gb
+            cells.append(f'{total:>8.2f}{"*" if over else " "}')
+        print(f'{batch:>6} ' + ' '.join(cells))
+
+    if opt.out is not None:
+        report = dict(config=opt.config, family=family, batch=opt.batch, seq_len=opt.seq_len,
+                      precision=opt.precision, checkpointing=opt.checkpointing, parameters=parameters,
+                      gradients=gradients, optimizer_state=optimizer_state, activations=rows,
+                      coefficients=coefficients, estimates=estimates)
+        with open(opt.out, 'w') as stream:
+            json.dump(report, stream, indent=2)
+        fprint(f'report written to {opt.out}')
+
+
+if __name__ == "__main__":
+    main(pars.parse_args())
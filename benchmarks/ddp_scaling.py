@@ -0,0 +1,75 @@
+import argparse
+import os
+import time
+
+import torch
+import torch.multiprocessing as mp
+from erutils.loggers import fprint
+
+from utils.distributed import setup_distributed, cleanup_distributed, distributed_model
+from utils.train_step import GradientAccumulator, causal_lm_loss
+
+pars = argparse.ArgumentParser(description='throughput of gloo data parallel training over 1 / 2 / 4 processes')
+pars.add_argument('--processes', '--processes', type=int, nargs='+', default=[1, 2, 4])
+pars.add_argument('--hidden-size', '--hidden-size', type=int, default=256)
+pars.add_argument('--n-layers', '--n-layers', type=int, default=4)
+pars.add_argument('--n-heads', '--n-heads', type=int, default=8)
+pars.add_argument('--vocab-size', '--vocab-size', type=int, default=8192)
+pars.add_argument('--seq-len', '--seq-len', type=int, default=128)
+pars.add_argument('--batch', '--batch', type=int, default=4, help='per process batch size')
+pars.add_argument('--steps', '--steps', type=int, default=10)
+pars.add_argument('--warmup', '--warmup', type=int, default=2)
+pars.add_argument('--bucket-cap-mb', '--bucket-cap-mb', type=int, default=25)
+pars.add_argument('--port', '--port', type=int, default=29511)
+
+
+def worker(rank: int, world_size: int, opt, results):
+    from modules.modeling_LLMoU import LLMoUModel, LLMoUConfig
+
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank),
+                      MASTER_ADDR='127.0.0.1', MASTER_PORT=str(opt.port + world_size))
+    # the cores are split between the processes, otherwise every process would oversubscribe the machine
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    setup_distributed('gloo')
+    torch.manual_seed(0)
+    model = LLMoUModel(LLMoUConfig(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                                   vocab_size=opt.vocab_size, max_sentence_length=opt.seq_len))
+    network = distributed_model(model, bucket_cap_mb=opt.bucket_cap_mb)
+    accumulator = GradientAccumulator(torch.optim.AdamW(model.parameters(), lr=1e-4), model=network)
+    torch.manual_seed(rank + 1)
+    input_ids = torch.randint(0, opt.vocab_size, (opt.batch, opt.seq_len))
+    elapsed = 0.0
+    for step in range(opt.warmup + opt.steps):
+        start = time.perf_counter()
+        with accumulator.no_sync():
+            logits, _ = network(input_ids=input_ids, attention_mask=torch.ones_like(input_ids))
+            accumulator.backward(*causal_lm_loss(logits, input_ids))
+        if step >= opt.warmup:
+            elapsed += time.perf_counter() - start
+    # the slowest rank sets the pace
+    elapsed = torch.tensor(elapsed)
+    if world_size > 1:
+        torch.distributed.all_reduce(elapsed, op=torch.distributed.ReduceOp.MAX)
+    if rank == 0:
+        results.put(elapsed.item())
+    cleanup_distributed()
+
+
+def main(opt):
+    fprint(f'LLMoU | hidden {opt.hidden_size} | layers {opt.n_layers} | {opt.batch} x {opt.seq_len} per process '
+           f'| {os.cpu_count()} cores')
+    fprint(f'{"processes":>10} {"tokens/s":>10} {"speedup":>8} {"efficiency":>11}')
+    context = mp.get_context('spawn')
+    baseline = None
+    for world_size in opt.processes:
+        results = context.SimpleQueue()
+        mp.start_processes(worker, args=(world_size, opt, results), nprocs=world_size, start_method='spawn')
+        elapsed = results.get()
+        tokens_per_second = world_size * opt.batch * opt.seq_len * opt.steps / elapsed
+        baseline = baseline or tokens_per_second / world_size
+        speedup = tokens_per_second / baseline
+        fprint(f'{world_size:>10} {tokens_per_second:>10.1f} {speedup:>7.2f}x {speedup / world_size:>10.0%}')
+
+
+if __name__ == "__main__":
+    main(pars.parse_args())
@@ -0,0 +1,226 @@
+import argparse
+import functools
+import json
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from typing import Dict, List
+
+import torch
+from erutils.loggers import fprint
+
+from benchmarks.training_throughput import FAMILIES as TRAINING_FAMILIES, run_isolated, environment, check_baseline, \
+    preset_config, override
+
+pars = argparse.ArgumentParser(description='time to first token, inter token latency and tokens/s of every generate '
+                                           'method over prompt length x output length, greedy and sampling, written '
+                                           'as json and compared against a stored baseline')
+pars.add_argument('--families', '--families', type=str, nargs='+', default=None,
+                  help='families to run, all of them by default')
+pars.add_argument('--hidden-size', '--hidden-size', type=int, default=256)
+pars.add_argument('--n-layers', '--n-layers', type=int, default=2)
+pars.add_argument('--n-heads', '--n-heads', type=int, default=4)
+pars.add_argument('--vocab-size', '--vocab-size', type=int, default=4096)
+pars.add_argument('--prompt-lens', '--prompt-lens', type=int, nargs='+', default=[16, 64])
+pars.add_argument('--output-lens', '--output-lens', type=int, nargs='+', default=[16, 64])
+pars.add_argument('--batch', '--batch', type=int, default=1)
+pars.add_argument('--modes', '--modes', type=str, nargs='+', default=['greedy', 'sampling'],
+                  choices=['greedy', 'sampling'])
+pars.add_argument('--temperature', '--temperature', type=float, default=0.8)
+pars.add_argument('--top-p', '--top-p', type=float, default=0.95)
+pars.add_argument('--repeats', '--repeats', type=int, default=3)
+pars.add_argument('--warmup', '--warmup', type=int, default=1)
+pars.add_argument('--device', '--device', type=str, default='cpu')
+pars.add_argument('--threads', '--threads', type=int, default=None)
+pars.add_argument('--out', '--out', type=str, default=None, help='json file the results are written to')
+pars.add_argument('--baseline', '--baseline', type=str, default=None,
+                  help='json file of an earlier run, the process exits with 1 when a metric regressed')
+pars.add_argument('--tolerance', '--tolerance', type=float, default=0.1,
+                  help='relative change of a metric that is reported as a regression')
+
+HIGHER_IS_BETTER = ('tokens_per_s',)
+LOWER_IS_BETTER = ('ttft_ms', 'itl_p50_ms', 'itl_p90_ms', 'itl_p99_ms')
+
+FAMILIES = tuple(TRAINING_FAMILIES) + ('CC_PGT',)
+
+# these generate methods always sample from the softmax, they have no greedy mode
+SAMPLING_ONLY = ('PGT', 'PGT-J', 'CC_PGT', 'PTTGenerative')
+
+# the decoder of PTTGenerative cross attends a buffer as long as the prompt, generate fills it
+PROMPT_SIZED = ('PTTGenerative',)
+
+
+def build_cc_pgt(opt):
+    from modules.models import CC_PGT
+
+    config = override(preset_config('PGT-s', opt), num_embedding=opt.hidden_size, num_heads=opt.n_heads,
+                      num_layers=opt.n_layers, chunk=max(opt.seq_lens), max_position_embeddings=max(opt.seq_lens))
+    config.hidden_size, config.embd_pdrop = config.num_embedding, config.embedded_dropout
+    return CC_PGT(config), None
+
+
+def build(family: str, opt, context: int) -> torch.nn.Module:
+    """
+    the model of the training suite, sized for `context` tokens and `opt.batch` sequences
+    """
+    sized = argparse.Namespace(**{**vars(opt), 'seq_lens': [context], 'batch_sizes': [opt.batch]})
+    model, _ = build_cc_pgt(sized) if family == 'CC_PGT' else TRAINING_FAMILIES[family](sized)
+    return model
+
+
+def generate(family: str, model: torch.nn.Module, prompt: torch.Tensor, new_tokens: int, greedy: bool, opt):
+    """
+    runs the generate method of the family until `new_tokens` tokens are produced (eos never stops it), a
+    PROMPT_SIZED family always produces prompt length - 1 tokens
+    """
+    temperature = 0 if greedy else opt.temperature
+    if family in ('LLmP', 'LLMoU'):
+        kwargs = dict(pad_id=0) if family == 'LLmP' else {}
+        for _ in model.generate(prompt, eos_id=-1, max_gen_len=new_tokens, temperature=temperature, top_p=opt.top_p,
+                                **kwargs):
+            pass
+    elif family == 'LLama':
+        model.generate(prompts=prompt.tolist(), max_gen_len=new_tokens, pad_id=0, eos_id=-1,
+                       temperature=temperature, top_p=opt.top_p)
+    elif family in ('PGT', 'PGT-J', 'CC_PGT'):
+        model.generate(prompt, generate=new_tokens, temp=opt.temperature, eos=-1)
+    elif family == 'PTTGenerative':
+        # the prompt is the encoder input, the decoder fills a buffer of the prompt length after a start token (a
+        # buffer of padding only would mask every key of its first position)
+        model.eos = -1
+        buffer = torch.zeros_like(prompt)
+        buffer[:, 0] = prompt[:, 0]
+        model.generate(prompt, buffer, temp=opt.temperature)
+    elif family == 'LLmPU':
+        model.generate(input_ids=prompt, attention_mask=torch.ones_like(prompt), max_new_tokens=new_tokens,
+                       min_new_tokens=new_tokens, do_sample=not greedy, temperature=opt.temperature,
+                       top_p=opt.top_p)
+    else:
+        raise ValueError(f'no generate runner for {family}')
+
+
+def timed_forward(model: torch.nn.Module, stamps: List[float]):
+    """
+    every forward pass of a generate loop produces one token, the end of each pass is recorded in `stamps`
+    (the generate methods call `self.forward` directly, so module hooks would not fire)
+    """
+    forward = model.forward
+    synchronize = next(model.parameters()).is_cuda
+
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        output = forward(*args, **kwargs)
+        if synchronize:
+            torch.cuda.synchronize()
+        stamps.append(time.perf_counter())
+        return output
+
+    model.forward = wrapper
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q / 100 * (len(values) - 1)))] if values else 0.0
+
+
+def measure(family: str, model: torch.nn.Module, stamps: List[float], opt, prompt_len: int, new_tokens: int,
+            greedy: bool) -> Dict[str, float]:
+    """
+    time to first token and tokens/s are medians over the repeats, inter token latencies are pooled over them
+    """
+    prompt = torch.randint(1, opt.vocab_size, (opt.batch, prompt_len),
+                           generator=torch.Generator().manual_seed(0)).to(opt.device)
+    ttft, throughput, latencies, produced = [], [], [], 0
+    for repeat in range(opt.warmup + opt.repeats):
+        stamps.clear()
+        torch.manual_seed(repeat)
+        start = time.perf_counter()
+        generate(family, model, prompt, new_tokens, greedy, opt)
+        end = time.perf_counter()
+        if repeat < opt.warmup or not stamps:
+            continue
+        ttft.append(stamps[0] - start)
+        throughput.append(len(stamps) * opt.batch / (end - start))
+        latencies.extend(b - a for a, b in zip(stamps, stamps[1:]))
+        produced = len(stamps)
+    latencies_ms = [latency * 1e3 for latency in latencies]
+    return dict(ttft_ms=_percentile(ttft, 50) * 1e3, itl_p50_ms=_percentile(latencies_ms, 50),
+                itl_p90_ms=_percentile(latencies_ms, 90), itl_p99_ms=_percentile(latencies_ms, 99),
+                itl_mean_ms=sum(latencies_ms) / max(len(latencies_ms), 1), tokens_per_s=_percentile(throughput, 50),
+                tokens=produced)
+
+
+def worker(family: str, opt, results):
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    try:
+        torch.manual_seed(0)
+        model = build(family, opt, max(opt.prompt_lens) + max(opt.output_lens)).to(opt.device).eval()
+        stamps = []
+        timed_forward(model, stamps)
+        result = dict(parameters=sum(p.numel() for p in model.parameters()), shapes=OrderedDict())
+        skipped = []
+        if family in PROMPT_SIZED:
+            skipped.append(f'{family}.generate produces prompt length - 1 tokens, output lengths are ignored')
+            if opt.batch > 1:
+                # the sampled tokens of a batch do not fit the buffer column they are written to
+                skipped.append(f'{family}.generate only runs a batch of 1')
+        with torch.no_grad():
+            for mode in opt.modes:
+                if mode == 'greedy' and family in SAMPLING_ONLY:
+                    skipped.append(f'{family}.generate has no greedy mode')
+                    continue
+                if family in PROMPT_SIZED and opt.batch > 1:
+                    continue
+                for prompt_len in opt.prompt_lens:
+                    for new_tokens in [prompt_len - 1] if family in PROMPT_SIZED else opt.output_lens:
+                        result['shapes'][f'{mode} {prompt_len}x{new_tokens}'] = measure(
+                            family, model, stamps, opt, prompt_len, new_tokens, greedy=mode == 'greedy')
+        if skipped:
+            result['skipped'] = ' | '.join(skipped)
+    except Exception as error:
+        result = dict(error=f'{type(error).__name__}: {error}'.splitlines()[0][:300])
+        traceback.print_exc(file=sys.stderr)
+    results.put(result)
+
+
+def main(opt):
+    families = opt.families or list(FAMILIES)
+    unknown = set(families) - set(FAMILIES)
+    if unknown:
+        raise ValueError(f'unknown families {sorted(unknown)}, choose from {list(FAMILIES)}')
+    report = dict(
+        environment=environment(opt),
+        settings=dict(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                      vocab_size=opt.vocab_size, prompt_lens=opt.prompt_lens, output_lens=opt.output_lens,
+                      batch=opt.batch, modes=opt.modes, temperature=opt.temperature, top_p=opt.top_p,
+                      repeats=opt.repeats),
+        families=OrderedDict()
+    )
+    fprint(f'hidden {opt.hidden_size} | layers {opt.n_layers} | heads {opt.n_heads} | vocab {opt.vocab_size} | '
+           f'batch {opt.batch} | {report["environment"]["threads"]} threads')
+    fprint(f'{"family":<14} {"mode":<9} {"prompt x out":>12} {"TTFT ms":>9} {"ITL p50":>9} {"ITL p90":>9} '
+           f'{"ITL p99":>9} {"tok/s":>9}')
+    for family in families:
+        result = run_isolated(worker, family, opt)
+        report['families'][family] = result
+        if 'error' in result:
+            fprint(f'{family:<14} failed : {result["error"]}')
+            continue
+        for shape, metrics in result['shapes'].items():
+            mode, size = shape.split(' ')
+            fprint(f'{family:<14} {mode:<9} {size:>12} {metrics["ttft_ms"]:>9.2f} {metrics["itl_p50_ms"]:>9.2f} '
+                   f'{metrics["itl_p90_ms"]:>9.2f} {metrics["itl_p99_ms"]:>9.2f} {metrics["tokens_per_s"]:>9.1f}')
+        if 'skipped' in result:
+            fprint(f'{family:<14} {result["skipped"]}')
+    if opt.out is not None:
+        with open(opt.out, 'w') as stream:
+            json.dump(report, stream, indent=2)
+        fprint(f'results written to {opt.out}')
+    if opt.baseline is not None:
+        check_baseline(report, opt.baseline, opt.tolerance, HIGHER_IS_BETTER, LOWER_IS_BETTER)
+
+
+if __name__ == "__main__":
+    main(pars.parse_args())
@@ -0,0 +1,107 @@
+import argparse
+import time
+
+import torch
+from erutils.loggers import fprint
+
+from modules.checkpointing import apply_gradient_checkpointing, CHECKPOINT_POLICIES
+from utils.train_step import causal_lm_loss
+
+pars = argparse.ArgumentParser(description='activation memory and step time of the gradient checkpointing policies')
+pars.add_argument('--model', '--model', type=str, default='LLMoU', choices=['LLmP', 'LLMoU', 'LLama'])
+pars.add_argument('--hidden-size', '--hidden-size', type=int, default=512)
+pars.add_argument('--n-layers', '--n-layers', type=int, default=8)
+pars.add_argument('--n-heads', '--n-heads', type=int, default=8)
+pars.add_argument('--vocab-size', '--vocab-size', type=int, default=8192)
+pars.add_argument('--seq-lens', '--seq-lens', type=int, nargs='+', default=[128, 256, 512])
+pars.add_argument('--batch', '--batch', type=int, default=4)
+pars.add_argument('--every', '--every', type=int, default=2)
+pars.add_argument('--steps', '--steps', type=int, default=3)
+pars.add_argument('--device', '--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def build(opt, seq_len: int):
+    if opt.model == 'LLmP':
+        from modules.models import LLmP, LLmPConfig
+
+        config = LLmPConfig(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                            vocab_size=opt.vocab_size, max_sentence_length=seq_len, device=opt.device)
+        return LLmP(config)
+    if opt.model == 'LLama':
+        from modules.modelling_LLAmA import LLamaModel, LLamaConfig
+
+        config = LLamaConfig(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                             vocab_size=opt.vocab_size, max_sentence_length=seq_len, device=opt.device)
+        return LLamaModel(config)
+    from modules.modeling_LLMoU import LLMoUModel, LLMoUConfig
+
+    config = LLMoUConfig(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                         vocab_size=opt.vocab_size, max_sentence_length=seq_len)
+    return LLMoUModel(config)
+
+
+def forward(opt, model, input_ids):
+    if opt.model == 'LLama':
+        # LLamaModel only returns the logits of the last position
+        return model(input_ids, pos_start=0).sum()
+    logits, _ = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids))
+    loss_sum, num_tokens = causal_lm_loss(logits, input_ids)
+    return loss_sum / num_tokens
+
+
+def saved_activation_bytes(opt, model, input_ids) -> int:
+    """
+    bytes autograd keeps alive for the backward pass (each storage counted once), device independent so the table
+    means the same on cpu; tensors saved inside a checkpointed module are dropped and never reach this hook
+    """
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = forward(opt, model, input_ids)
+    parameter_ptrs = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return sum(size for ptr, size in storages.items() if ptr not in parameter_ptrs)
+
+
+def step_time(opt, model, input_ids) -> float:
+    if opt.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(opt.steps):
+        forward(opt, model, input_ids).backward()
+        model.zero_grad(set_to_none=True)
+    if opt.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / opt.steps
+
+
+def main(opt):
+    cuda = opt.device.startswith('cuda')
+    fprint(f'{opt.model} | hidden {opt.hidden_size} | layers {opt.n_layers} | batch {opt.batch} | {opt.device}')
+    fprint(f'{"policy":>10} {"seq":>6} {"saved MB":>10} {"peak MB":>9} {"step s":>8} {"mem":>6} {"time":>6}')
+    for seq_len in opt.seq_lens:
+        torch.manual_seed(0)
+        model = build(opt, seq_len).to(opt.device).train()
+        input_ids = torch.randint(0, opt.vocab_size, (opt.batch, seq_len), device=opt.device)
+        baseline = None
+        for policy in CHECKPOINT_POLICIES:
+            apply_gradient_checkpointing(model, policy, every=opt.every)
+            step_time(opt, model, input_ids)
+            if cuda:
+                torch.cuda.reset_peak_memory_stats()
+            saved = saved_activation_bytes(opt, model, input_ids)
+            peak = torch.cuda.max_memory_allocated() / 1e6 if cuda else float('nan')
+            seconds = step_time(opt, model, input_ids)
+            baseline = baseline or (saved, seconds)
+            fprint(f'{policy:>10} {seq_len:>6} {saved / 1e6:>10.1f} {peak:>9.1f} {seconds:>8.3f} '
+                   f'{saved / baseline[0]:>5.2f}x {seconds / baseline[1]:>5.2f}x')
+
+
+if __name__ == "__main__":
+    main(pars.parse_args())
@@ -0,0 +1,58 @@
+import argparse
+import time
+
+import torch
+from erutils.loggers import fprint
+
+from utils.utils import DatasetPGT, make_window_pairs
+
+pars = argparse.ArgumentParser(description='DatasetPGT.init: per-window re-tokenization vs one-shot windowing')
+pars.add_argument('--data-src', '--data-src', type=str, default='data/PGT-DATA-V2.txt')
+pars.add_argument('--chunk', '--chunk', type=int, default=184)
+pars.add_argument('--legacy-windows', '--legacy-windows', type=int, default=8)
+
+
+def legacy_init(dataset: DatasetPGT, windows: int) -> float:
+    """
+    old DatasetPGT.init body, limited to the first `windows` windows since the full run is quadratic
+    :return: seconds per window
+    """
+    data_list = torch.tensor([])
+    start = time.perf_counter()
+    for ipa in range(windows):
+        data = dataset.tokenizer.encode_plus(
+            text=dataset.src[dataset.chunk * (ipa + 1):],
+            add_special_tokens=True,
+            return_attention_mask=True,
+            return_tensors='pt',
+            padding='do_not_pad',
+            truncation=False,
+            verbose=False
+        )['input_ids'][:, :dataset.chunk]
+        data_list = torch.cat([data_list, torch.cat([data[:, 0:-2], data[:, 1:-1]], dim=-2).unsqueeze(0)], dim=-3)
+    return (time.perf_counter() - start) / windows
+
+
+def main(opt):
+    text = open(opt.data_src, 'r', encoding='utf8').read()
+    dataset = DatasetPGT(chunk=opt.chunk, call_init=False, pt_data=False)
+    dataset.src = text
+
+    start = time.perf_counter()
+    tokens = dataset.tokenizer.encode_plus(text=text, return_tensors='pt', truncation=False,
+                                           verbose=False)['input_ids']
+    tokenize_time = time.perf_counter() - start
+    start = time.perf_counter()
+    pairs = make_window_pairs(tokens, dataset.chunk)
+    window_time = time.perf_counter() - start
+
+    per_window = legacy_init(dataset, opt.legacy_windows)
+    total_windows = pairs.shape[0]
+    fprint(f'corpus        : {len(text) / 1e6:.2f} M chars | {tokens.numel()} tokens | {total_windows} windows')
+    fprint(f'one-shot      : tokenize {tokenize_time:.3f} s | windowing {window_time * 1e3:.3f} ms')
+    fprint(f'legacy (est.) : {per_window:.3f} s/window | ~{per_window * total_windows:.1f} s for the whole corpus')
+    fprint(f'speedup       : ~{per_window * total_windows / (tokenize_time + window_time):.0f}x')
+
+
+if __name__ == "__main__":
+    main(pars.parse_args())
@@ -0,0 +1,76 @@
+import argparse
+import time
+
+import torch
+from erutils.loggers import fprint
+
+from modules.precision import PrecisionPolicy
+from utils.train_step import GradientAccumulator, causal_lm_loss
+
+pars = argparse.ArgumentParser(description='training throughput of --precision fp32 vs bf16 (CPU autocast)')
+pars.add_argument('--model', '--model', type=str, default='LLmP', choices=['LLmP', 'LLMoU'])
+pars.add_argument('--hidden-size', '--hidden-size', type=int, default=512)
+pars.add_argument('--n-layers', '--n-layers', type=int, default=4)
+pars.add_argument('--n-heads', '--n-heads', type=int, default=8)
+pars.add_argument('--vocab-size', '--vocab-size', type=int, default=8192)
+pars.add_argument('--seq-len', '--seq-len', type=int, default=256)
+pars.add_argument('--batch', '--batch', type=int, default=4)
+pars.add_argument('--steps', '--steps', type=int, default=10)
+pars.add_argument('--warmup', '--warmup', type=int, default=2)
+pars.add_argument('--threads', '--threads', type=int, default=None)
+
+
+def build(opt):
+    if opt.model == 'LLmP':
+        from modules.models import LLmP, LLmPConfig
+
+        config = LLmPConfig(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                            vocab_size=opt.vocab_size, max_sentence_length=opt.seq_len, device='cpu')
+        return LLmP(config)
+    from modules.modeling_LLMoU import LLMoUModel, LLMoUConfig
+
+    config = LLMoUConfig(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                         vocab_size=opt.vocab_size, max_sentence_length=opt.seq_len)
+    return LLMoUModel(config)
+
+
+def run(opt, precision: str):
+    """
+    :return: tokens per second and the loss of the first step
+    """
+    # same seed, so both precisions start from the same weights and see the same batch
+    torch.manual_seed(0)
+    model = build(opt)
+    policy = PrecisionPolicy(precision, device='cpu')
+    accumulator = GradientAccumulator(torch.optim.AdamW(model.parameters(), lr=1e-4))
+    input_ids = torch.randint(0, opt.vocab_size, (opt.batch, opt.seq_len))
+    attention_mask = torch.ones_like(input_ids)
+    first_loss = None
+    elapsed = 0.0
+    for step in range(opt.warmup + opt.steps):
+        start = time.perf_counter()
+        with policy.autocast():
+            logits, _ = model(input_ids=input_ids, attention_mask=attention_mask)
+        loss_sum, num_tokens = causal_lm_loss(logits, input_ids, attention_mask=attention_mask)
+        accumulator.backward(loss_sum, num_tokens)
+        if first_loss is None:
+            first_loss = (loss_sum / num_tokens).item()
+        if step >= opt.warmup:
+            elapsed += time.perf_counter() - start
+    return opt.steps * opt.batch * opt.seq_len / elapsed, first_loss
+
+
+def main(opt):
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    fprint(f'{opt.model} | hidden {opt.hidden_size} | layers {opt.n_layers} | batch {opt.batch} x {opt.seq_len} '
+           f'| {torch.get_num_threads()} threads')
+    fp32_tps, fp32_loss = run(opt, 'fp32')
+    bf16_tps, bf16_loss = run(opt, 'bf16')
+    fprint(f'fp32 : {fp32_tps:10.1f} tokens/s | first loss {fp32_loss:.4f}')
+    fprint(f'bf16 : {bf16_tps:10.1f} tokens/s | first loss {bf16_loss:.4f}')
+    fprint(f'bf16 / fp32 : {bf16_tps / fp32_tps:.2f}x')
+
+
+if __name__ == "__main__":
+    main(pars.parse_args())
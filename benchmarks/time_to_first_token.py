@@ -0,0 +1,115 @@
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import torch
+import torch.multiprocessing as mp
+from erutils.loggers import fprint
+
+from utils.empty_init import init_empty_weights, assign_weights
+from utils.sharded_weights import ShardedWeights, export_sharded
+
+pars = argparse.ArgumentParser(description='time to first token of tools/using_LLmP.py style loading, random init + '
+                                           'load_state_dict vs meta construction + assigned weights')
+pars.add_argument('--model', '--model', type=str, default='LLmP', choices=['LLmP', 'LLMoU'])
+pars.add_argument('--hidden-size', '--hidden-size', type=int, default=1024)
+pars.add_argument('--n-layers', '--n-layers', type=int, default=12)
+pars.add_argument('--n-heads', '--n-heads', type=int, default=16)
+pars.add_argument('--vocab-size', '--vocab-size', type=int, default=32000)
+pars.add_argument('--prompt-len', '--prompt-len', type=int, default=32)
+pars.add_argument('--modes', '--modes', type=str, nargs='+', default=['init', 'empty', 'export'],
+                  choices=['init', 'empty', 'export'])
+pars.add_argument('--directory', '--directory', type=str, default=None,
+                  help='where the checkpoint and the export are written, a temporary directory by default')
+
+MODES = dict(init='random init + load_state_dict', empty='meta + assign checkpoint', export='meta + assign mmap export')
+
+
+def model_and_config(opt):
+    if opt.model == 'LLmP':
+        from modules.models import LLmP, LLmPConfig
+
+        return LLmP, LLmPConfig(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                                vocab_size=opt.vocab_size, max_sentence_length=opt.prompt_len * 2, device='cpu')
+    from modules.modeling_LLMoU import LLMoUModel, LLMoUConfig
+
+    return LLMoUModel, LLMoUConfig(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                                   vocab_size=opt.vocab_size, max_sentence_length=opt.prompt_len * 2)
+
+
+def first_token(opt, model: torch.nn.Module) -> torch.Tensor:
+    tokens = torch.randint(1, opt.vocab_size, (1, opt.prompt_len), generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        if opt.model == 'LLmP':
+            generator = model.generate(tokens, eos_id=-1, pad_id=0, max_gen_len=1, temperature=0)
+        else:
+            generator = model.generate(tokens, eos_id=-1, max_gen_len=1, temperature=0)
+        return next(iter(generator))
+
+
+def worker(mode: str, opt, checkpoint: str, export: str, results):
+    # imports are not part of the measurement, they cost the same in every mode
+    model_class, config = model_and_config(opt)
+    start = time.perf_counter()
+    if mode == 'init':
+        model = model_class(config)
+        loaded = torch.load(checkpoint, 'cpu')
+        model.load_state_dict(loaded['model'])
+        del loaded
+    else:
+        with init_empty_weights():
+            model = model_class(config)
+        weights = torch.load(checkpoint, 'cpu')['model'] if mode == 'empty' else ShardedWeights(export)
+        assign_weights(model, weights)
+        del weights
+    loaded = time.perf_counter() - start
+    model.eval()
+    token = first_token(opt, model)
+    results.put((loaded, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                 token.item()))
+
+
+def main(opt):
+    directory = opt.directory or tempfile.mkdtemp(prefix='ttft-')
+    os.makedirs(directory, exist_ok=True)
+    checkpoint = os.path.join(directory, f'{opt.model}-model.pt')
+    export = os.path.join(directory, f'{opt.model}-export')
+    torch.manual_seed(0)
+    model_class, config = model_and_config(opt)
+    model = model_class(config)
+    # a training checkpoint also carries the optimizer state (AdamW: two more copies of the weights)
+    torch.save(dict(model=model.state_dict(),
+                    optimizer=dict(state={i: dict(exp_avg=torch.zeros_like(p), exp_avg_sq=torch.zeros_like(p))
+                                          for i, p in enumerate(model.parameters())})), checkpoint)
+    export_sharded(model.state_dict(), export, max_shard_bytes=256 << 20)
+    size = sum(p.numel() for p in model.parameters())
+    del model
+    fprint(f'{opt.model} | {size / 1e6:.1f}M parameters | prompt {opt.prompt_len} tokens | '
+           f'{torch.get_num_threads()} threads')
+    fprint(f'{"mode":<32} {"load s":>8} {"first token s":>14} {"peak RSS MB":>12}')
+    context = mp.get_context('spawn')
+    tokens = set()
+    try:
+        for mode in opt.modes:
+            results = context.SimpleQueue()
+            # a fresh process per mode, nothing is cached from the previous one except the page cache
+            process = context.Process(target=worker, args=(mode, opt, checkpoint, export, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f'{mode} failed with exit code {process.exitcode}')
+            loaded, ttft, rss, token = results.get()
+            tokens.add(token)
+            fprint(f'{MODES[mode]:<32} {loaded:>8.2f} {ttft:>14.2f} {rss:>12.0f}')
+    finally:
+        if opt.directory is None:
+            shutil.rmtree(directory)
+    if len(tokens) > 1:
+        fprint(f'the modes generated different first tokens {tokens}')
+
+
+if __name__ == "__main__":
+    main(pars.parse_args())
@@ -0,0 +1,341 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple, Any
+
+import torch
+import torch.multiprocessing as mp
+from erutils.loggers import fprint
+
+from utils.metrics import memory_stats
+from utils.train_step import token_loss, causal_lm_loss
+
+pars = argparse.ArgumentParser(description='forward / backward / optimizer step throughput, peak memory and compile '
+                                           'time of every model family on synthetic data, written as json and '
+                                           'compared against a stored baseline')
+pars.add_argument('--families', '--families', type=str, nargs='+', default=None,
+                  help='families to run, all of them by default')
+pars.add_argument('--hidden-size', '--hidden-size', type=int, default=256)
+pars.add_argument('--n-layers', '--n-layers', type=int, default=2)
+pars.add_argument('--n-heads', '--n-heads', type=int, default=4)
+pars.add_argument('--vocab-size', '--vocab-size', type=int, default=4096)
+pars.add_argument('--batch-sizes', '--batch-sizes', type=int, nargs='+', default=[1, 4])
+pars.add_argument('--seq-lens', '--seq-lens', type=int, nargs='+', default=[64, 128])
+pars.add_argument('--steps', '--steps', type=int, default=5)
+pars.add_argument('--warmup', '--warmup', type=int, default=1)
+pars.add_argument('--compile', '--compile', type=bool, default=False)
+pars.add_argument('--device', '--device', type=str, default='cpu')
+pars.add_argument('--threads', '--threads', type=int, default=None)
+pars.add_argument('--out', '--out', type=str, default=None, help='json file the results are written to')
+pars.add_argument('--baseline', '--baseline', type=str, default=None,
+                  help='json file of an earlier run, the process exits with 1 when a metric regressed')
+pars.add_argument('--tolerance', '--tolerance', type=float, default=0.1,
+                  help='relative change of a metric that is reported as a regression')
+
+# higher is better for throughput, lower is better for memory and compile time
+HIGHER_IS_BETTER = ('forward_tokens_per_s', 'backward_tokens_per_s', 'optimizer_steps_per_s', 'step_tokens_per_s')
+LOWER_IS_BETTER = ('peak_memory_mb', 'compile_s')
+
+# builders return the model and a function computing the loss of a batch of token ids
+Builder = Callable[[Any], Tuple[torch.nn.Module, Callable[[torch.nn.Module, torch.Tensor], torch.Tensor]]]
+
+
+def _mean_loss(loss_sum: torch.Tensor, num_tokens: torch.Tensor) -> torch.Tensor:
+    return loss_sum / num_tokens.clamp(min=1)
+
+
+def preset_config(preset: str, opt):
+    """
+    the `get_config_by_name` preset of the family, or `opt.config` when the options name one
+    """
+    from utils.utils import get_config_by_name
+
+    return get_config_by_name(getattr(opt, 'config', None) or preset, vocab_size=opt.vocab_size, device=opt.device)
+
+
+def override(config, **values):
+    """
+    sets the given config attributes, a None value keeps the one of the preset
+    """
+    for name, value in values.items():
+        if value is not None:
+            setattr(config, name, value)
+    return config
+
+
+def build_pgt(opt):
+    from modules.models import PGT
+
+    config = override(preset_config('PGT-s', opt), num_embedding=opt.hidden_size, num_heads=opt.n_heads,
+                      num_layers=opt.n_layers, chunk=max(opt.seq_lens))
+    return PGT(config), lambda model, ids: _mean_loss(*causal_lm_loss(model(ids), ids))
+
+
+def build_pgt_j(opt):
+    from modules.models import PGT_J
+
+    config = override(preset_config('PGT-J-S', opt), num_embedding=opt.hidden_size, num_heads=opt.n_heads,
+                      num_layers=opt.n_layers, chunk=max(opt.seq_lens))
+    return PGT_J(config), lambda model, ids: _mean_loss(*causal_lm_loss(model(ids), ids))
+
+
+def build_llama(opt):
+    from modules.modelling_LLAmA import LLamaModel
+
+    config = override(preset_config('LLama', opt), hidden_size=opt.hidden_size, n_heads=opt.n_heads,
+                      n_layers=opt.n_layers, max_sentence_length=max(opt.seq_lens),
+                      max_batch_size=max(opt.batch_sizes), device=opt.device)
+    # LLamaModel only returns the logits of the last position, LLama-train.py predicts the last token
+    return LLamaModel(config), lambda model, ids: _mean_loss(*token_loss(model(tokens=ids, pos_start=0), ids[:, -1]))
+
+
+def build_llmp(opt):
+    from modules.models import LLmP
+
+    config = override(preset_config('LLmP-S', opt), hidden_size=opt.hidden_size, n_heads=opt.n_heads,
+                      n_layers=opt.n_layers, max_sentence_length=max(opt.seq_lens), device=opt.device)
+    return LLmP(config), lambda model, ids: _mean_loss(*causal_lm_loss(model(input_ids=ids, attention_mask=None)[0],
+                                                                      ids))
+
+
+def build_llmou(opt):
+    from modules.modeling_LLMoU import LLMoUModel
+
+    config = override(preset_config('LLMoU-S', opt), hidden_size=opt.hidden_size, n_heads=opt.n_heads,
+                      n_layers=opt.n_layers, max_sentence_length=max(opt.seq_lens), device=opt.device)
+    return LLMoUModel(config), lambda model, ids: _mean_loss(*causal_lm_loss(model(input_ids=ids)[0], ids))
+
+
+def build_llmpu(opt):
+    from modules.modeling_LLmPU import LLmPUForConditionalGeneration
+
+    config = override(preset_config('LLmPU-S', opt), d_model=opt.hidden_size, num_heads=opt.n_heads,
+                      num_layers=opt.n_layers, num_decoder_layers=opt.n_layers, max_length=max(opt.seq_lens))
+    if opt.hidden_size is not None:
+        config.d_kv, config.d_ff = config.d_model // config.num_heads, config.d_model * 4
+
+    def loss(model, ids):
+        # the same sequence is encoded and decoded, the decoder predicts its next token
+        # LLmPUConfig has none of the output_* defaults of a PretrainedConfig, they are passed explicitly
+        logits = model(input_ids=ids, attention_mask=torch.ones_like(ids), decoder_input_ids=ids,
+                       output_attentions=False, output_hidden_states=False, return_dict=True)['logits']
+        return _mean_loss(*causal_lm_loss(logits, ids))
+
+    return LLmPUForConditionalGeneration(config, device=opt.device), loss
+
+
+def build_ptt_generative(opt):
+    from modules.models import PTTGenerative
+
+    model = PTTGenerative(vocab_size=opt.vocab_size, chunk=max(opt.seq_lens), embedded=opt.hidden_size,
+                          number_of_heads=opt.n_heads, number_of_layers=opt.n_layers, pad_index=0, eos=1)
+    # the loss of PTTGenerative is summed over the batch
+    return model, lambda m, ids: m(ids, ids, target=ids)[1] / ids.shape[0]
+
+
+FAMILIES: Dict[str, Builder] = OrderedDict([
+    ('PGT', build_pgt),
+    ('PGT-J', build_pgt_j),
+    ('LLama', build_llama),
+    ('LLmP', build_llmp),
+    ('LLMoU', build_llmou),
+    ('LLmPU', build_llmpu),
+    ('PTTGenerative', build_ptt_generative),
+])
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(opt, model: torch.nn.Module, loss_fn, optimizer: torch.optim.Optimizer, batch: int,
+            seq_len: int) -> Dict[str, float]:
+    """
+    times forward (loss included), backward and optimizer step separately, the first step is reported on its own
+    (it includes the compilation of a compiled model)
+    """
+    device = torch.device(opt.device)
+    # token 0 is the padding id of every family
+    ids = torch.randint(1, opt.vocab_size, (batch, seq_len), generator=torch.Generator().manual_seed(0)).to(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    times = {'forward': [], 'backward': [], 'optimizer': []}
+    first_step = 0.0
+    for step in range(1 + opt.warmup + opt.steps):
+        _synchronize(device)
+        start = time.perf_counter()
+        loss = loss_fn(model, ids)
+        _synchronize(device)
+        forward = time.perf_counter()
+        loss.backward()
+        _synchronize(device)
+        backward = time.perf_counter()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        _synchronize(device)
+        end = time.perf_counter()
+        if step == 0:
+            first_step = end - start
+        elif step > opt.warmup:
+            times['forward'].append(forward - start)
+            times['backward'].append(backward - forward)
+            times['optimizer'].append(end - backward)
+    tokens = batch * seq_len
+    forward, backward, optimizer_step = (sum(v) / len(v) for v in times.values())
+    result = dict(forward_tokens_per_s=tokens / forward, backward_tokens_per_s=tokens / backward,
+                  optimizer_steps_per_s=1 / optimizer_step,
+                  step_tokens_per_s=tokens / (forward + backward + optimizer_step),
+                  first_step_s=first_step, loss=loss.item(),
+                  peak_memory_mb=max(memory_stats(device).values()) * 1e3)
+    if opt.compile:
+        result['compile_s'] = max(first_step - (forward + backward + optimizer_step), 0.0)
+    return result
+
+
+def error_message(error: Exception) -> str:
+    return f'{type(error).__name__}: {error}'.splitlines()[0][:300]
+
+
+def worker(family: str, opt, results):
+    # a fresh process per family, the peak RSS of one family does not hide the next one
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    try:
+        torch.manual_seed(0)
+        model, loss_fn = FAMILIES[family](opt)
+        model = model.to(opt.device).train()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+        result = dict(parameters=sum(p.numel() for p in model.parameters()), shapes=OrderedDict())
+        if opt.compile:
+            model = torch.compile(model)
+        # ascending by tokens, so the cpu peak RSS read after a shape belongs to the largest shape so far
+        shapes = sorted(((b, s) for b in opt.batch_sizes for s in opt.seq_lens), key=lambda shape: shape[0] * shape[1])
+        for batch, seq_len in shapes:
+            # a shape the family fails on is reported on its own, the other shapes are still measured
+            try:
+                result['shapes'][f'{batch}x{seq_len}'] = measure(opt, model, loss_fn, optimizer, batch, seq_len)
+            except Exception as error:
+                result['shapes'][f'{batch}x{seq_len}'] = dict(error=error_message(error))
+                traceback.print_exc(file=sys.stderr)
+                optimizer.zero_grad(set_to_none=True)
+        result['peak_memory_mb'] = max(memory_stats(opt.device).values()) * 1e3
+    except Exception as error:
+        result = dict(error=error_message(error))
+        traceback.print_exc(file=sys.stderr)
+    results.put(result)
+
+
+def run_isolated(worker: Callable, family: str, opt) -> Dict[str, Any]:
+    """
+    runs `worker(family, opt, results)` in a fresh spawned process, a crash is reported as an error of the family
+    """
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    process = context.Process(target=worker, args=(family, opt, results))
+    process.start()
+    process.join()
+    return results.get() if process.exitcode == 0 else dict(error=f'exit code {process.exitcode}')
+
+
+def environment(opt) -> Dict[str, Any]:
+    return dict(torch=torch.__version__, python=platform.python_version(), machine=platform.machine(),
+                device=opt.device, threads=opt.threads or torch.get_num_threads())
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float,
+            higher_is_better: Tuple[str, ...] = HIGHER_IS_BETTER,
+            lower_is_better: Tuple[str, ...] = LOWER_IS_BETTER) -> List[str]:
+    """
+    :return: one line per metric of the baseline that got worse than `tolerance` (relative) in `current`
+    """
+    regressions = []
+    for family, base in baseline['families'].items():
+        if 'error' in base:
+            continue
+        now = current['families'].get(family)
+        if now is None:
+            continue
+        if 'error' in now:
+            regressions.append(f'{family} : {now["error"]}')
+            continue
+        for shape, base_metrics in base['shapes'].items():
+            metrics = now['shapes'].get(shape)
+            if metrics is None or 'error' in base_metrics:
+                continue
+            if 'error' in metrics:
+                regressions.append(f'{family} {shape} : {metrics["error"]}')
+                continue
+            for name, base_value in base_metrics.items():
+                value = metrics.get(name)
+                if value is None or not base_value:
+                    continue
+                change = (value - base_value) / base_value
+                if (name in higher_is_better and change < -tolerance) or \
+                        (name in lower_is_better and change > tolerance):
+                    regressions.append(f'{family} {shape} {name} : {base_value:.2f} -> {value:.2f} ({change:+.1%})')
+    return regressions
+
+
+def check_baseline(report: Dict[str, Any], path: str, tolerance: float,
+                   higher_is_better: Tuple[str, ...] = HIGHER_IS_BETTER,
+                   lower_is_better: Tuple[str, ...] = LOWER_IS_BETTER):
+    """
+    prints the regressions against the report stored in `path` and exits with 1 when there is any
+    """
+    with open(path, 'r') as stream:
+        baseline = json.load(stream)
+    if baseline.get('settings') != report['settings'] or baseline.get('environment') != report['environment']:
+        fprint('the baseline was recorded with other settings or on another machine, numbers may not compare')
+    regressions = compare(report, baseline, tolerance, higher_is_better, lower_is_better)
+    for line in regressions:
+        fprint(f'REGRESSION {line}')
+    if regressions:
+        sys.exit(1)
+    fprint(f'no regression against {path} (tolerance {tolerance:.0%})')
+
+
+def main(opt):
+    families = opt.families or list(FAMILIES)
+    unknown = set(families) - set(FAMILIES)
+    if unknown:
+        raise ValueError(f'unknown families {sorted(unknown)}, choose from {list(FAMILIES)}')
+    report = dict(
+        environment=environment(opt),
+        settings=dict(hidden_size=opt.hidden_size, n_layers=opt.n_layers, n_heads=opt.n_heads,
+                      vocab_size=opt.vocab_size, batch_sizes=opt.batch_sizes, seq_lens=opt.seq_lens,
+                      steps=opt.steps, warmup=opt.warmup, compile=opt.compile),
+        families=OrderedDict()
+    )
+    fprint(f'hidden {opt.hidden_size} | layers {opt.n_layers} | heads {opt.n_heads} | vocab {opt.vocab_size} | '
+           f'{report["environment"]["threads"]} threads | compile {opt.compile}')
+    fprint(f'{"family":<14} {"shape":>8} {"fwd tok/s":>11} {"bwd tok/s":>11} {"opt step/s":>11} '
+           f'{"step tok/s":>11} {"first s":>8} {"peak MB":>9}')
+    for family in families:
+        result = run_isolated(worker, family, opt)
+        report['families'][family] = result
+        if 'error' in result:
+            fprint(f'{family:<14} failed : {result["error"]}')
+            continue
+        for shape, metrics in result['shapes'].items():
+            if 'error' in metrics:
+                fprint(f'{family:<14} {shape:>8} failed : {metrics["error"]}')
+                continue
+            fprint(f'{family:<14} {shape:>8} {metrics["forward_tokens_per_s"]:>11.1f} '
+                   f'{metrics["backward_tokens_per_s"]:>11.1f} {metrics["optimizer_steps_per_s"]:>11.1f} '
+                   f'{metrics["step_tokens_per_s"]:>11.1f} {metrics["first_step_s"]:>8.2f} '
+                   f'{metrics["peak_memory_mb"]:>9.0f}')
+    if opt.out is not None:
+        with open(opt.out, 'w') as stream:
+            json.dump(report, stream, indent=2)
+        fprint(f'results written to {opt.out}')
+    if opt.baseline is not None:
+        check_baseline(report, opt.baseline, opt.tolerance)
+
+
+if __name__ == "__main__":
+    main(pars.parse_args())
@@ -7,6 +7,7 @@ import torch
 from transformers import AutoTokenizer, BasicTokenizer
 
 from modules.modeling_LLmPU import LLmPUForConditionalGeneration, LLmPUConfig
+from utils.sharded_weights import ShardedWeights, load_sharded
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +25,14 @@ def load_llmpu(config_path: Union[os.PathLike, str], model_ckpt: Union[os.PathLi
     model = LLmPUForConditionalGeneration(config=config)
     logger.info(f'Model Created Successfully')
     logger.info(f'Loading Model from {model_ckpt}')
-    ckpt = torch.load(model_ckpt)
-    # logger.info(f'Available Options on last save are : {[k for k, v in ckpt.items()]}')
-    model.load_state_dict(ckpt)
+    if ShardedWeights.is_export(model_ckpt):
+        # weights are mapped and copied shard by shard instead of unpickling the whole checkpoint first
+        load_sharded(model, model_ckpt)
+    else:
+        ckpt = torch.load(model_ckpt, 'cpu')
+        # logger.info(f'Available Options on last save are : {[k for k, v in ckpt.items()]}')
+        model.load_state_dict(ckpt)
+        del ckpt
     logger.info(f'Model Loaded Successfully')
 
     return model, tokenizer
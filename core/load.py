@@ -6,6 +6,7 @@ from erutils.utils import read_yaml
 from erutils.loggers import fprint
 
 from modules.models import PTTMultiHeadAttention
+from utils.char_codec import CharCodec
 
 
 def load(config_path: typing.Union[str, os.PathLike], path_model: typing.Union[str, os.PathLike],
@@ -30,22 +31,13 @@ def load(config_path: typing.Union[str, os.PathLike], path_model: typing.Union[s
         txt = f'\033[1;36m | \033[1;32m{k} : \033[1;36m{v}'
         print(txt, ' ' * abs(len(txt) - 100), '|')
 
-    with open(data_path, 'r') as stream:
-        text = stream.read()
-
-    chars = sorted(list(set(text)))
+    codec = CharCodec.from_config(cfg.get('vocab_path', os.path.splitext(data_path)[0] + '-vocab.json'), data_path)
 
     fprint(f'DEVICE : {device}')
 
-    s_to_i = {ch: i for i, ch in enumerate(chars)}
-
-    i_to_s = {i: ch for i, ch in enumerate(chars)}
-
-    encode = lambda s: [s_to_i[c] for c in s]
-    decode = lambda l: ''.join([i_to_s[i] for i in l])
+    decode = codec.decode
 
-    text = torch.tensor(encode(text), dtype=torch.long if device == 'cuda' else torch.int).to(device)
-    m = PTTMultiHeadAttention(vocab_size=len(chars), chunk_size=chunk_size, number_of_embedded=number_of_embedded,
+    m = PTTMultiHeadAttention(vocab_size=len(codec), chunk_size=chunk_size, number_of_embedded=number_of_embedded,
                               head_size=head_size,
                               number_of_layers=number_of_layers,
                               number_of_head=number_of_head).to(device)
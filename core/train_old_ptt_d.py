@@ -5,6 +5,8 @@ import torch
 from erutils.loggers import fprint
 from erutils.utils import read_yaml
 
+from modules.precision import PrecisionPolicy
+from utils.char_codec import CharCodec
 from utils.utils import save_checkpoints,GB
 
 
@@ -25,6 +27,10 @@ def train(config_path: typing.Union[str, os.PathLike],
     head_size = cfg['head_size']
     number_of_embedded = cfg['number_of_embedded']
 
+    vocab_path = cfg.get('vocab_path', os.path.splitext(data_path)[0] + '-vocab.json')
+    sampling = cfg.get('sampling', 'random')
+    prefetch = cfg.get('prefetch', 0)
+    precision = PrecisionPolicy(cfg.get('precision', 'fp32'), device=device)
     load_weights = cfg['load_weights']
     path_weights = cfg['path_weights']
     for k, v in cfg.items():
@@ -37,20 +43,14 @@ def train(config_path: typing.Union[str, os.PathLike],
     split = int(0.9 * len(text))
 
     # attar_print(data_length=len(text))
-    chars = sorted(list(set(text)))
+    codec = CharCodec.from_text(text)
+    codec.save(vocab_path)
+    fprint(f'len Chars : {len(codec)}\n', end='\n')
+    fprint(f'Saved Char Vocab to {vocab_path} ~ Successfully !!\n')
 
-    fprint(f'len Chars : {len(chars)}\n', end='\n')
-    s_to_i = {ch: i for i, ch in enumerate(chars)}
-    fprint('Created String to integer Vocab ~ Successfully !!\n')
-    i_to_s = {i: ch for i, ch in enumerate(chars)}
-    fprint('Created integer to String Vocab ~ Successfully  !!\n')
-
-    # encode = lambda s: [i_to_s[c] for c in s]
-    encode = lambda s: [s_to_i[c] for c in s]
-
-    # decode = lambda l: ''.join([s_to_i[c] for c in l])
-    decode = lambda l: ''.join([i_to_s[i] for i in l])
-    text = torch.tensor(encode(text), dtype=torch.long)
+    encode = codec.encode
+    decode = codec.decode
+    text = codec.encode_tensor(text)
 
     train_data = text[:split]
     eval_data = text[split:]
@@ -73,7 +73,8 @@ def train(config_path: typing.Union[str, os.PathLike],
     else:
         fprint(f'[SKIP] PreShow Status is OFF ! ')
 
-    get_batch = GB(train_data=train_data, eval_data=eval_data, batch_size=batch_size, chunk_size=chunk_size)
+    get_batch = GB(train_data=train_data, eval_data=eval_data, batch_size=batch_size, chunk_size=chunk_size,
+                   sampling=sampling, prefetch=prefetch, seed=seed if set_seed else None)
 
     # xb, yb = get_batch('train')
     # for b in range(batch_size):
@@ -82,7 +83,7 @@ def train(config_path: typing.Union[str, os.PathLike],
     #         target = yb[b, t]
     #         print(f"when input is {context.tolist()} the target: {target}")
 
-    m = PTTMultiHeadAttention(vocab_size=len(chars), chunk_size=chunk_size, number_of_embedded=number_of_embedded,
+    m = PTTMultiHeadAttention(vocab_size=len(codec), chunk_size=chunk_size, number_of_embedded=number_of_embedded,
                               head_size=head_size,
                               number_of_layers=number_of_layers,
                               number_of_head=number_of_head)
@@ -119,13 +120,15 @@ def train(config_path: typing.Union[str, os.PathLike],
 
             if mode not in ['eval', 'test']:
                 m.train()
-                predict, loss = m(x, y)
+                with precision.autocast():
+                    predict, loss = m(x, y)
                 optimizer.zero_grad(set_to_none=True)
                 loss.backward()
                 optimizer.step()
             else:
                 m.eval()
-                predict, loss = m(x, y)
+                with precision.autocast():
+                    predict, loss = m(x, y)
                 last_eval_loss = loss.item()
             fprint(
                 f'\rEpoch [{epoch + 1}/{epochs}] | Loss : [{loss.item()}] | Mode : [{mode}] | Last Evaluation Loss : [{last_eval_loss}]',
@@ -1,14 +1,10 @@
-def main():
-    data = open('PGT.txt', 'r', encoding='utf8').read()
-    data = data.split('<|endoftext|>')
-    f = ''
-    print(data)
-    for i in range(0, len(data), 2):
-        try:
-            f += '<|endoftext|>' + data[i+1] + data[i + 2]
-        except:
-            pass
-    open('TPAP.txt', 'w', encoding='utf8').write(f)
+from utils.convert_corpus import convert_corpus
+
+
+# run from the repository root: python -m data.fixing (or use python -m utils.convert_corpus --mode tpap)
+
+def main(path: str = 'data/PGT.txt', out: str = 'data/TPAP.txt'):
+    return convert_corpus(path, out, mode='tpap')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+import functools
+import logging
+from typing import Optional, List
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+logger = logging.getLogger(__name__)
+
+# none      : keep every activation (default)
+# block     : recompute every transformer block in the backward pass
+# every_k   : recompute every k-th block only (blocks 0, k, 2k, ...)
+# attention : recompute only the attention of every block, the mlp activations are kept
+CHECKPOINT_POLICIES = ('none', 'block', 'every_k', 'attention')
+
+
+def _checkpointed_forward(module: nn.Module, forward, *args, **kwargs):
+    if module.training and torch.is_grad_enabled():
+        # non reentrant checkpointing takes keyword arguments and restores the rng state, so dropout matches the
+        # first forward pass
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return forward(*args, **kwargs)
+
+
+def _wrap(module: nn.Module):
+    if 'forward' in module.__dict__:
+        return
+    module.forward = functools.partial(_checkpointed_forward, module, module.forward)
+
+
+def _unwrap(module: nn.Module):
+    module.__dict__.pop('forward', None)
+
+
+def is_checkpointed(module: nn.Module) -> bool:
+    forward = module.__dict__.get('forward')
+    return isinstance(forward, functools.partial) and forward.func is _checkpointed_forward
+
+
+def checkpoint_blocks(model: nn.Module) -> List[nn.Module]:
+    """
+    transformer blocks of `model` in forward order, a block is any module naming its attention sub module in
+    `checkpoint_attention`
+    """
+    return [m for m in model.modules() if hasattr(type(m), 'checkpoint_attention')]
+
+
+def apply_gradient_checkpointing(model: nn.Module, policy: Optional[str] = 'block', every: int = 2) -> int:
+    """
+    recomputes the activations of the selected modules in the backward pass instead of storing them, only while the
+    model is training; parameters and state dict keys do not change, so it can be applied before or after loading a
+    checkpoint (but before `torch.compile`)
+    :param model: LLmP, LLMoUModel, LLamaModel, PGT or any model built from blocks with `checkpoint_attention`
+    :param policy: one of CHECKPOINT_POLICIES
+    :param every: k for the `every_k` policy
+    :return: number of checkpointed modules
+    """
+    policy = policy or 'none'
+    if policy not in CHECKPOINT_POLICIES:
+        raise ValueError(f'policy must be one of {CHECKPOINT_POLICIES}, got {policy}')
+    if every < 1:
+        raise ValueError(f'every must be at least 1, got {every}')
+    blocks = checkpoint_blocks(model)
+    for block in blocks:
+        _unwrap(block)
+        _unwrap(getattr(block, block.checkpoint_attention))
+    if policy == 'block':
+        targets = blocks
+    elif policy == 'every_k':
+        targets = blocks[::every]
+    elif policy == 'attention':
+        targets = [getattr(block, block.checkpoint_attention) for block in blocks]
+    else:
+        targets = []
+    for target in targets:
+        _wrap(target)
+    if hasattr(model, 'gradient_checkpointing'):
+        model.gradient_checkpointing = policy != 'none'
+    logger.debug(f'gradient checkpointing {policy} on {len(targets)} / {len(blocks)} blocks')
+    return len(targets)
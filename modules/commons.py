@@ -459,7 +459,7 @@ class MultiCNNAttention(nn.Module):
             if len(attention_mask.shape) == 2:
                 attention_mask = attention_mask[:, None, None, :]
             attn_weight = attn_weight + attention_mask
-        attn_weight = nn.functional.softmax(attn_weight, dim=-1)
+        attn_weight = nn.functional.softmax(attn_weight, dim=-1, dtype=torch.float32)
         attn_weight = self.attn_dropout(attn_weight)
         attn_weight = attn_weight.type(value.dtype)
         if head_mask is not None:
@@ -495,6 +495,9 @@ class PGTMLP(nn.Module):
 
 
 class PGTBlock(nn.Module):
+    # attention sub module, see modules.checkpointing
+    checkpoint_attention = 'h_1'
+
     def __init__(self, config, layer_idx_1=None):
         super(PGTBlock, self).__init__()
 
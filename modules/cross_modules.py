@@ -47,7 +47,7 @@ class PMSNorm(nn.Module):
         return nrm
 
     def forward(self, x):
-        x = self.norm(x)
+        x = self.norm(x.float()).type_as(x)
         return x * self.weight
 
 
@@ -69,16 +69,17 @@ class Attention(nn.Module):
     def forward(self, x: Optional[torch.Tensor], alibi: Optional[torch.Tensor],
                 attention_mask: Optional[torch.Tensor] = None) -> Optional[torch.Tensor]:
         batch_, seq_len_, _ = x.shape
+        # the permuted heads are only contiguous for a batch of 1, reshape copies them for larger batches
         # [batch, seq_len , num_heads, head_dim] -> [batch, num_heads, head_dim, seq_len]
-        query = self.wq(x).view(batch_, seq_len_, self.local_rank, self.head_dim).permute(0, 2, 1, 3).view(
+        query = self.wq(x).view(batch_, seq_len_, self.local_rank, self.head_dim).permute(0, 2, 1, 3).reshape(
             batch_ * self.local_rank, seq_len_, self.head_dim
         )
         # [batch, seq_len , num_heads, head_dim] -> [batch, num_heads, seq_len, head_dim]
-        value = self.wv(x).view(batch_, seq_len_, self.local_rank, self.head_dim).permute(0, 2, 1, 3).view(
+        value = self.wv(x).view(batch_, seq_len_, self.local_rank, self.head_dim).permute(0, 2, 1, 3).reshape(
             batch_ * self.local_rank, seq_len_, self.head_dim
         )
         # [batch, seq_len , num_heads, head_dim] -> [batch, num_heads, seq_len, head_dim]
-        key = self.wk(x).view(batch_, seq_len_, self.local_rank, self.head_dim).permute(0, 2, 3, 1).view(
+        key = self.wk(x).view(batch_, seq_len_, self.local_rank, self.head_dim).permute(0, 2, 3, 1).reshape(
             batch_ * self.local_rank, self.head_dim, seq_len_)
         _, _, key_len_ = key.shape
 
@@ -94,7 +95,7 @@ class Attention(nn.Module):
         _, _, s, h = attention.shape
         if attention_mask is not None:
             attention += attention_mask[:, :, :, :h]
-        attention = nn.functional.softmax(attention, dim=-1)
+        attention = nn.functional.softmax(attention, dim=-1, dtype=torch.float32).type_as(value)
         attention = self.drop(attention).view(batch_ * self.local_rank, seq_len_, key_len_)
         comb = torch.bmm(attention, value).view(batch_, -1, self.hidden_size)
         return self.wo(comb)
@@ -1,12 +1,15 @@
-import json
 import os
+from itertools import islice
 from logging import getLogger
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Iterator
 
 import torch
 import transformers
 from torch.utils.data import Dataset
-from tqdm.auto import tqdm
+
+from utils.json_stream import iter_json_array
+from utils.pretokenize import PreEncoded
+from utils.token_cache import load_or_pretokenize
 
 logger = getLogger(__name__)
 
@@ -19,13 +22,39 @@ class Tokens:
     atn_end = '<|ETN|>'
 
 
+PARAGRAPH = 'paragraph:'
+QUESTION = 'question:'
+
+
+def multirc_texts(records, agent: str, eos: str) -> List[str]:
+    """
+    super_glue/multirc records as the LLmP / LLMoU datasets train on them (held out splits are formatted the same)
+    """
+    return [f'{PARAGRAPH} {dt["paragraph"]} {QUESTION} {dt["question"]} {agent} {dt["answer"]} {eos}'
+            for dt in records]
+
+
+def _squeeze_whitespace(text: str) -> str:
+    return ' '.join(text.split())
+
+
 class DatasetLLmPU(Dataset):
-    def __init__(self, tokenizer, source_len, target_len, source_text, target_text):
+    def __init__(self, tokenizer, source_len, target_len, source_text, target_text, pre_encode: Optional[str] = 'lazy'):
+        """
+        :param pre_encode: 'eager' encodes every pair up front, 'lazy' encodes a pair the first time it is read and
+         keeps the ids for later epochs, None calls the tokenizer on every read
+        """
         self.tokenizer = tokenizer
         self.source_len = source_len
         self.target_len = target_len
         self.target_text = target_text
         self.source_text = source_text
+        self.pre_encode = pre_encode
+        if pre_encode is not None:
+            self.source = PreEncoded(tokenizer, source_text, max_length=source_len, mode=pre_encode,
+                                     normalize=_squeeze_whitespace)
+            self.target = PreEncoded(tokenizer, target_text, max_length=target_len, mode=pre_encode,
+                                     normalize=_squeeze_whitespace)
 
     def __len__(self):
         return len(self.target_text)
@@ -35,11 +64,16 @@ class DatasetLLmPU(Dataset):
         :param index:
         :return: 'source_ids','source_mask','target_ids'
         """
-        source_text = str(self.source_text[index])
-        target_text = str(self.target_text[index])
-
-        source_text = ' '.join(source_text.split())
-        target_text = ' '.join(target_text.split())
+        if self.pre_encode is not None:
+            source_ids, source_mask = self.source[index]
+            target_ids, _ = self.target[index]
+            return {
+                'source_ids': source_ids.unsqueeze(0),
+                'source_mask': source_mask.unsqueeze(0),
+                'target_ids': target_ids.unsqueeze(0),
+            }
+        source_text = _squeeze_whitespace(str(self.source_text[index]))
+        target_text = _squeeze_whitespace(str(self.target_text[index]))
 
         source = self.tokenizer.batch_encode_plus([source_text], max_length=self.source_len, pad_to_max_length=True,
                                                   truncation=True, padding="max_length", return_tensors='pt')
@@ -59,30 +93,24 @@ class DatasetLLmPU(Dataset):
 
 class DatasetLLama(Dataset, Tokens):
     def __init__(self, data: Optional[List[str]],
-                 tokenizer: Optional[transformers.GPT2Tokenizer], max_length: Optional[int] = 768):
+                 tokenizer: Optional[transformers.GPT2Tokenizer], max_length: Optional[int] = 768,
+                 cache_dir: Optional[Union[os.PathLike, str]] = None):
         self.tokenizer = tokenizer
 
-        self.input_ids = []
         self.max_length = max_length
-        logger.info('Tokenizing Data')
-        pbar = tqdm(enumerate(data))
-        failed = 0
-        for i, txt in pbar:
-            if txt != '' and not txt.startswith(' ='):
-                pbar.set_postfix(failed=failed, collected=i + 1 - failed)
-
-                encodings_dict = tokenizer(self.sos + txt + self.eos, truncation=True,
-                                           max_length=max_length, padding="do_not_pad")
-
-                self.input_ids.append(torch.tensor(encodings_dict['input_ids']))
-            else:
-                failed += 1
+        self.tokenized = None
+        if data is not None:
+            logger.info('Tokenizing Data')
+            texts = [self.sos + txt + self.eos for txt in data if txt != '' and not txt.startswith(' =')]
+            logger.info(f'Collected {len(texts)} Examples [failed : {len(data) - len(texts)}]')
+            self.tokenized = load_or_pretokenize(tokenizer, texts, max_length=max_length, padding='do_not_pad',
+                                                 cache_dir=cache_dir, dataset=type(self).__name__)
 
     def __len__(self):
-        return len(self.input_ids)
+        return len(self.tokenized) if self.tokenized is not None else 0
 
     def __getitem__(self, idx):
-        return self.input_ids[idx]
+        return self.tokenized.ids(idx)
 
     def encode(self, text):
         enc_trg = self.tokenizer.encode_plus(
@@ -100,7 +128,7 @@ class DatasetLLama(Dataset, Tokens):
 class DatasetLLmP(Dataset, Tokens):
     def __init__(self, data: Union[dict[List], str],
                  tokenizer: Optional[transformers.GPT2Tokenizer], max_length: Optional[int] = 256,
-                 till: Optional[int] = 5000):
+                 till: Optional[int] = 5000, cache_dir: Optional[Union[os.PathLike, str]] = None):
         self.tokenizer = tokenizer
 
         tokenizer.add_special_tokens(
@@ -110,31 +138,22 @@ class DatasetLLmP(Dataset, Tokens):
             os.mkdir('tokenizer_model/LLmP-C')
         agent = '<LLmP> :'
         self.agent = agent
-        paragraph = 'paragraph:'
-        question = 'question:'
         tokenizer.add_tokens(agent)
-        tokenizer.add_tokens(paragraph)
-        tokenizer.add_tokens(question)
+        tokenizer.add_tokens(PARAGRAPH)
+        tokenizer.add_tokens(QUESTION)
         tokenizer.save_pretrained('tokenizer_model/LLmP-C')
-        self.attention_mask = []
-        self.input_ids = []
         self.max_length = max_length
         chosen = data['train']
         till = till if till is not None else len(chosen)
-        tqdm_pr = tqdm(iterable=enumerate(chosen), total=till)
-        for ia, dt in tqdm_pr:
-            string = f'{paragraph} {dt["paragraph"]} {question} {dt["question"]} {agent} {dt["answer"]} {self.eos}'
-            encodings_dict = tokenizer.encode_plus(string, max_length=max_length, truncation=True, return_tensors='pt',
-                                                   padding="max_length")
-            self.attention_mask.append(encodings_dict['attention_mask'])
-            self.input_ids.append(encodings_dict['input_ids'])
-            if ia == till:
-                break
+        texts = multirc_texts(islice(chosen, till + 1), agent=agent, eos=self.eos)
+        self.tokenized = load_or_pretokenize(tokenizer, texts, max_length=max_length, padding='max_length',
+                                             cache_dir=cache_dir, dataset=type(self).__name__)
+
     def __len__(self):
-        return len(self.input_ids)
+        return len(self.tokenized)
 
     def __getitem__(self, idx):
-        return self.input_ids[idx], self.attention_mask[idx]
+        return self.tokenized.ids(idx).unsqueeze(0), self.tokenized.mask(idx).unsqueeze(0)
 
     def encode(self, text):
         enc_trg = self.tokenizer.encode_plus(
@@ -150,7 +169,8 @@ class DatasetLLmP(Dataset, Tokens):
 
 class DatasetLLmPChat(Dataset, Tokens):
     def __init__(self, data: Union[os.PathLike, str],
-                 tokenizer: Optional[transformers.GPT2Tokenizer], max_length: Optional[int] = 256):
+                 tokenizer: Optional[transformers.GPT2Tokenizer], max_length: Optional[int] = 256,
+                 cache_dir: Optional[Union[os.PathLike, str]] = None):
         self.tokenizer = tokenizer
         # tokenizer.add_special_tokens(
         #     {'pad_token': self.pad, 'eos_token': self.eos, 'bos_token': self.sos}
@@ -159,35 +179,29 @@ class DatasetLLmPChat(Dataset, Tokens):
         #     os.mkdir('tokenizer_model/LLmP-C')
         # tokenizer.add_tokens('<LLmP> :')
         # tokenizer.save_pretrained('tokenizer_model/LLmP-C')
-        self.attention_mask = []
         self.agent = '<LLmP> :'
-        self.input_ids = []
         self.max_length = max_length
-        data = json.load(open(data, 'r'))
-        conv = []
-        for S in data:
-            for c in S['dialog']:
-                conv.append(c['text'])
-        tqdm_pr = tqdm(iterable=range(len(conv)))
-        tqdm_pr.set_description('Cleaning Data ')
-        preprocessed_data = []
-        for c in tqdm_pr:
-            try:
-                preprocessed_data.append(self.sos + conv[c] + '<LLmP> :' + conv[c + 1] + self.eos)
-            except IndexError:
-                pass
-        tqdm_pr = tqdm(iterable=preprocessed_data)
-        for string in tqdm_pr:
-            encodings_dict = tokenizer.encode_plus(string, max_length=max_length, truncation=True, return_tensors='pt',
-                                                   padding="max_length")
-            self.attention_mask.append(encodings_dict['attention_mask'])
-            self.input_ids.append(encodings_dict['input_ids'])
+        self.tokenized = load_or_pretokenize(tokenizer, lambda: self.iter_pairs(data), max_length=max_length,
+                                             padding='max_length', cache_dir=cache_dir,
+                                             dataset=type(self).__name__)
+
+    def iter_pairs(self, path: Union[os.PathLike, str]) -> Iterator[str]:
+        """
+        streams the dialogs of `path` and yields every turn joined with the one after it, turns are chained across
+        dialogs the same way the flat conversation list used to be
+        """
+        previous = None
+        for session in iter_json_array(path):
+            for turn in session['dialog']:
+                if previous is not None:
+                    yield self.sos + previous + '<LLmP> :' + turn['text'] + self.eos
+                previous = turn['text']
 
     def __len__(self):
-        return len(self.input_ids)
+        return len(self.tokenized)
 
     def __getitem__(self, idx):
-        return self.input_ids[idx], self.attention_mask[idx]
+        return self.tokenized.ids(idx).unsqueeze(0), self.tokenized.mask(idx).unsqueeze(0)
 
     def encode(self, text):
         enc_trg = self.tokenizer.encode_plus(
@@ -205,7 +219,7 @@ class DatasetLLmPChat(Dataset, Tokens):
 class DatasetLLMoU(Dataset, Tokens):
     def __init__(self, data: Union[dict[List], str],
                  tokenizer: Optional[transformers.GPT2Tokenizer], max_length: Optional[int] = 256,
-                 till: Optional[int] = 5000):
+                 till: Optional[int] = 5000, cache_dir: Optional[Union[os.PathLike, str]] = None):
         self.tokenizer = tokenizer
 
         tokenizer.add_special_tokens(
@@ -215,33 +229,22 @@ class DatasetLLMoU(Dataset, Tokens):
             os.mkdir('tokenizer_model/LLMoU-C')
         agent = '<LLMoU> :'
         self.agent = agent
-        paragraph = 'paragraph:'
-        question = 'question:'
         tokenizer.add_tokens(agent)
-        tokenizer.add_tokens(paragraph)
-        tokenizer.add_tokens(question)
+        tokenizer.add_tokens(PARAGRAPH)
+        tokenizer.add_tokens(QUESTION)
         tokenizer.save_pretrained('tokenizer_model/LLMoU-C')
-        self.attention_mask = []
-        self.input_ids = []
         self.max_length = max_length
         chosen = data['train']
         till = till if till is not None else len(chosen)
-        tqdm_pr = tqdm(iterable=enumerate(chosen), total=till * 2)
-        for ia, dt in tqdm_pr:
-
-            string = f'{paragraph} {dt["paragraph"]} {question} {dt["question"]} {agent} {dt["answer"]} {self.eos}'
-            encodings_dict = tokenizer.encode_plus(string, max_length=max_length, truncation=True,
-                                                   return_tensors='pt',
-                                                   padding="max_length")
-            self.attention_mask.append(encodings_dict['attention_mask'])
-            self.input_ids.append(encodings_dict['input_ids'])
-            if ia == till:
-                break
+        texts = multirc_texts(islice(chosen, till + 1), agent=agent, eos=self.eos)
+        self.tokenized = load_or_pretokenize(tokenizer, texts, max_length=max_length, padding='max_length',
+                                             cache_dir=cache_dir, dataset=type(self).__name__)
+
     def __len__(self):
-        return len(self.input_ids)
+        return len(self.tokenized)
 
     def __getitem__(self, idx):
-        return self.input_ids[idx], self.attention_mask[idx]
+        return self.tokenized.ids(idx).unsqueeze(0), self.tokenized.mask(idx).unsqueeze(0)
 
     def encode(self, text):
         enc_trg = self.tokenizer.encode_plus(
@@ -90,9 +90,7 @@ class LLMoUPMSNorm(nn.Module):
         return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
 
     def forward(self, x):
-        if x.dtype != self.config.dtype:
-            x = x.type(self.config.dtype)
-        hidden = self.norm(x)
+        hidden = self.norm(x.float()).type_as(x)
 
         return self.weight * hidden
 
@@ -139,9 +137,9 @@ class LLMoUAttention(nn.Module):
 
         key, query, value = self._split_heads(kqv)
         batch, q_len, _, _ = query.shape
-        key = key.permute(0, 2, 3, 1).view(batch * self.n_heads, self.head_dim, q_len)
-        query = query.permute(0, 2, 1, 3).view(batch * self.n_heads, q_len, self.head_dim)
-        value = value.permute(0, 2, 1, 3).view(batch * self.n_heads, q_len, self.head_dim)
+        key = key.permute(0, 2, 3, 1).reshape(batch * self.n_heads, self.head_dim, q_len)
+        query = query.permute(0, 2, 1, 3).reshape(batch * self.n_heads, q_len, self.head_dim)
+        value = value.permute(0, 2, 1, 3).reshape(batch * self.n_heads, q_len, self.head_dim)
 
         if layer_past is not None:
             key_c, val_c = layer_past
@@ -160,7 +158,7 @@ class LLMoUAttention(nn.Module):
 
         input_dtype = attention_scores.dtype
 
-        attention_scores = attention_scores.to(torch.float) if input_dtype == torch.float16 else attention_scores
+        attention_scores = attention_scores.to(torch.float)
         attn_weights = torch.masked_fill(attention_scores, attention_mask, torch.finfo(attention_scores.dtype).min)
         attention_probs = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(input_dtype)
 
@@ -200,6 +198,9 @@ class LLMoUMLP(nn.Module):
 
 
 class LLMoUBlock(nn.Module):
+    # attention sub module, see modules.checkpointing
+    checkpoint_attention = 'self_attention'
+
     def __init__(self, config: LLMoUConfig):
         super(LLMoUBlock, self).__init__()
         self.ln1 = LLMoUPMSNorm(config)
@@ -218,7 +219,7 @@ class LLMoUBlock(nn.Module):
                 ):
         layer_norm_output = self.ln1(hidden_state)
         residual = layer_norm_output if self.config.use_ln_for_residual else hidden_state
-        attention_out = self.self_attention.forward(
+        attention_out = self.self_attention(
             layer_norm_output,
             attention_mask=attention_mask,
             layer_past=layer_past,
@@ -20,6 +20,9 @@ def sample_top_p(probs, p):
 
 
 class LLmPBlock(nn.Module):
+    # attention sub module, see modules.checkpointing
+    checkpoint_attention = 'block'
+
     def __init__(self, config: Optional[LLmPConfig], layer_index: Optional[int] = None):
         super(LLmPBlock, self).__init__()
         self.dropout = nn.Dropout(config.hidden_dropout)
@@ -10,6 +10,8 @@ from torch.utils.checkpoint import checkpoint
 from transformers import GenerationMixin, GenerationConfig
 from erutils.lightning import BaseModelOutput, BaseModelOutputWithPastAndCrossAttentions, ModelOutput
 
+from modules.precision import mask_dtype
+
 logger = logging.getLogger(__name__)
 
 
@@ -776,6 +778,19 @@ class LLmPUBlock(nn.Module):
             self.layer.append(LLmPULayerCrossAttention(config))
 
         self.layer.append(LLmPULayerFF(config))
+        # `torch.isinf(...).any()` waits for the device on every call, only done to report overflows when debugging
+        self.debug_inf_checks = getattr(config, 'debug_inf_checks', False)
+
+    def _clamp_inf(self, hidden_states):
+        """
+        fp16 activations are clamped to the finite range without checking for inf first, so no host sync per block
+        """
+        if hidden_states.dtype != torch.float16:
+            return hidden_states
+        if self.debug_inf_checks and torch.isinf(hidden_states).any():
+            logger.warning(f'inf in the fp16 hidden states of {type(self).__name__}, clamping')
+        clamp_value = torch.finfo(hidden_states.dtype).max - 1000
+        return torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
 
     def forward(
             self,
@@ -822,9 +837,7 @@ class LLmPUBlock(nn.Module):
         hidden_states, present_key_value_state = self_attention_outputs[:2]
         attention_outputs = self_attention_outputs[2:]
 
-        if hidden_states.dtype == torch.float16 and torch.isinf(hidden_states).any():
-            clamp_value = torch.finfo(hidden_states.dtype).max - 1000
-            hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+        hidden_states = self._clamp_inf(hidden_states)
 
         do_cross_attention = self.is_decoder and encoder_hidden_states is not None
         if do_cross_attention:
@@ -847,9 +860,7 @@ class LLmPUBlock(nn.Module):
             )
             hidden_states = cross_attention_outputs[0]
 
-            if hidden_states.dtype == torch.float16 and torch.isinf(hidden_states).any():
-                clamp_value = torch.finfo(hidden_states.dtype).max - 1000
-                hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+            hidden_states = self._clamp_inf(hidden_states)
 
             if present_key_value_state is not None:
                 present_key_value_state = present_key_value_state + cross_attention_outputs[1]
@@ -858,9 +869,7 @@ class LLmPUBlock(nn.Module):
 
         hidden_states = self.layer[-1](hidden_states)
 
-        if hidden_states.dtype == torch.float16 and torch.isinf(hidden_states).any():
-            clamp_value = torch.finfo(hidden_states.dtype).max - 1000
-            hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+        hidden_states = self._clamp_inf(hidden_states)
 
         outputs = (hidden_states,)
 
@@ -875,7 +884,6 @@ class LLmPUBlock(nn.Module):
 class LLmPUStack(nn.Module):
     def __init__(self, config, embed_tokens=None):
         super().__init__()
-        self.dtype = torch.float16
         self.embed_tokens = embed_tokens
         self.is_decoder = config.is_decoder
         self.config = config
@@ -890,6 +898,10 @@ class LLmPUStack(nn.Module):
         self.gradient_checkpointing = False
         self.main_input_name = 'input_ids'
 
+    @property
+    def dtype(self) -> torch.dtype:
+        return mask_dtype(self)
+
     def get_input_embeddings(self):
         return self.embed_tokens
 
@@ -920,7 +932,7 @@ class LLmPUStack(nn.Module):
     ) -> torch.Tensor:
 
         if dtype is None:
-            dtype = torch.float16
+            dtype = self.dtype
 
         if attention_mask.dim() == 3:
             extended_attention_mask = attention_mask[:, None, :, :]
@@ -44,7 +44,7 @@ class PMSNorm(nn.Module):
         return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
 
     def forward(self, x: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
-        x = self.pms(x.float())
+        x = self.pms(x.float()).type_as(x)
         return x * self.weight
 
 
@@ -142,13 +142,16 @@ class LLamaAttention(nn.Module):
         if mask is not None:
             _, _, s, h = attention.shape
             attention += mask[:, :, :s, :h]
-        attention = nn.functional.softmax(attention, dim=-1)
+        attention = nn.functional.softmax(attention, dim=-1, dtype=torch.float32).type_as(value)
         # after matmul [batch, num_heads, seq_len , head_dim]
         comb = torch.matmul(attention, value).permute(0, 2, 1, 3).contiguous().view(batch_, seq_len_, -1)
         return self.wo(comb)
 
 
 class LLamaBlock(nn.Module):
+    # attention sub module, see modules.checkpointing
+    checkpoint_attention = 'attention'
+
     def __init__(self, config: LLamaConfig, layer_id: int):
         super(LLamaBlock, self).__init__()
         self.layer_id: int = layer_id
@@ -228,7 +231,7 @@ class LLamaModel(nn.Module):
 
         total_len = min(params.max_sentence_length, max_gen_len + max_prompt_size)
 
-        tokens = torch.full((batch_size, total_len), pad_id).cuda().long()
+        tokens = torch.full((batch_size, total_len), pad_id, device=self.wte.weight.device).long()
         for k, t in enumerate(prompt_tokens):
             tokens[k, : len(t)] = torch.tensor(t).long()
         input_text_mask = tokens != pad_id
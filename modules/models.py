@@ -285,8 +285,8 @@ class PGT(nn.Module):
 
         self.embed_dim = config.num_embedding
 
-        self.wte = nn.Embedding(config.vocab_size, self.embed_dim).cuda()
-        self.wpe = nn.Embedding(config.chunk, self.embed_dim).cuda()
+        self.wte = nn.Embedding(config.vocab_size, self.embed_dim)
+        self.wpe = nn.Embedding(config.chunk, self.embed_dim)
         self.chunk = config.chunk
         self.drop = nn.Dropout(config.embedded_dropout)
         # self.h = nn.ModuleList(
@@ -680,8 +680,10 @@ class LLmP(nn.Module):
         # self.freq = self.freq.to(input_ids.device)
         # chosen_freq = self.freq[:seq_len]
         # logger.debug(f'chosen_freq : {chosen_freq.shape}')
+        # built from the additive mask the bias is 0 on every attended key (trained checkpoints never saw a position
+        # bias) and inf / nan on padded keys, which would make the whole softmax nan, the mask already removes them
         alibi = build_alibi_tensor(attention_mask=attention_mask.view(attention_mask.size()[0], -1), dtype=self.dtype,
-                                   number_of_heads=self.config.n_heads)
+                                   number_of_heads=self.config.n_heads).nan_to_num(nan=0.0, posinf=0.0, neginf=0.0)
 
         x = self.wte_ln(self.wte(input_ids))
         logger.debug(f'word tokenizing shape ==> : {x.shape}')
@@ -0,0 +1,58 @@
+import contextlib
+from typing import Optional, Union
+
+import torch
+
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+}
+
+
+class PrecisionPolicy:
+    """
+    mixed precision the same way for every model
+
+    parameters (and so the optimizer state) stay fp32 master weights, `autocast` runs the matmuls of the forward
+    pass in the compute dtype and the models keep softmax, rms norms and the additive attention masks in fp32;
+    the loss is computed outside of `autocast` from fp32 logits
+    """
+
+    def __init__(self, precision: str = 'fp32', device: Union[torch.device, str] = 'cpu'):
+        if precision not in PRECISIONS:
+            raise ValueError(f'precision must be one of {list(PRECISIONS)}, got {precision}')
+        self.precision = precision
+        self.compute_dtype: Optional[torch.dtype] = PRECISIONS[precision]
+        self.device_type = torch.device(device).type
+
+    @property
+    def enabled(self) -> bool:
+        return self.compute_dtype is not None
+
+    def autocast(self):
+        if not self.enabled:
+            # cpu autocast warns (and turns itself off) for anything but bf16, so fp32 is a plain no-op context
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device_type, dtype=self.compute_dtype)
+
+    def prepare_config(self, config):
+        """
+        keeps the weights in fp32 when autocast takes care of the compute dtype (configs with a `dtype` field
+        would otherwise create the whole model in that dtype)
+        """
+        if self.enabled and hasattr(config, 'dtype'):
+            config.dtype = torch.float32
+        return config
+
+    def __repr__(self):
+        return f'PrecisionPolicy(precision={self.precision}, device_type={self.device_type})'
+
+
+def mask_dtype(module: torch.nn.Module) -> torch.dtype:
+    """
+    dtype additive attention masks are built in, the dtype of the (master) weights and never a compute dtype
+    """
+    for param in module.parameters():
+        if param.is_floating_point():
+            return param.dtype
+    return torch.float32
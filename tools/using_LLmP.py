@@ -9,12 +9,16 @@ from transformers import AutoTokenizer
 
 from modules.dataset import DatasetLLmP, Tokens
 from modules.models import LLmP
+from utils.empty_init import init_empty_weights, assign_weights
+from utils.sharded_weights import ShardedWeights
 from utils.utils import get_config_by_name, count_model_parameters, device_info
 
 pars = argparse.ArgumentParser()
 pars.add_argument('--model', '--model', type=str, default='LLmP-ML')
 pars.add_argument('--agent-name', '--agent-name', type=str, default='<LLmP> :')
 pars.add_argument('--tokenizer', '--tokenizer', type=str, default='tokenizer_model/LLmP-C')
+pars.add_argument('--weights', '--weights', type=str, default=None,
+                  help='checkpoint or sharded export (python -m utils.sharded_weights), default <model>-model.pt')
 opt = pars.parse_args()
 
 
@@ -28,11 +32,13 @@ def _main(options):
     config.vocab_size += 5
     # config.device = 'cpu'
     fprint('Loading Model ...')
-    model: LLmP = LLmP(config=config).to('cpu')
-    loaded = torch.load(f'{options.model}-model.pt', 'cpu')
-    model.load_state_dict(loaded['model'])
-    del loaded
-    model = model.to(config.device)
+    with init_empty_weights():
+        model: LLmP = LLmP(config=config)
+    weights = options.weights or f'{options.model}-model.pt'
+    # an export stays memory mapped, a training checkpoint is unpickled and its optimizer state dropped
+    weights = ShardedWeights(weights) if ShardedWeights.is_export(weights) else torch.load(weights, 'cpu')['model']
+    model = assign_weights(model, weights, device=config.device)
+    del weights
     fprint(f'Model Loaded With {count_model_parameters(model)} Million Parameters')
 
     print('🧠Let Have Conversation Dude')
@@ -0,0 +1,191 @@
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple, List
+
+import torch
+from torch import nn
+from torch.utils._pytree import tree_flatten
+
+from modules.checkpointing import is_checkpointed
+from utils.profiling import ModuleProfiler
+
+# attention_scores : [..., seq, seq] tensors saved inside the attention modules (scores, probabilities, masks)
+# attention / mlp  : everything else saved inside the attention / feed forward modules of a block
+# logits           : [..., vocab] tensors (lm head output, its float copy and the softmax of the loss)
+# other            : norms, residuals and embeddings
+# weight_copies    : low precision copies of the weights autocast keeps for backward (independent of the batch)
+CATEGORIES = ('attention_scores', 'attention', 'mlp', 'logits', 'other', 'weight_copies')
+
+# activations of the model outside of its blocks (embeddings, final norm, lm head, loss)
+MODEL_ROW = 'model'
+
+
+def _storage_key(tensor: torch.Tensor) -> Tuple[int, int]:
+    storage = tensor.untyped_storage()
+    return storage.data_ptr(), storage.nbytes()
+
+
+class ActivationMemoryTracker:
+    """
+    bytes of the tensors autograd keeps from the forward pass for the backward pass (the activations that are all
+    alive when backward starts), per transformer block and per category; tensors sharing a storage are counted once,
+    parameters and buffers are not counted
+
+    >>> with ActivationMemoryTracker(model, seq_len=256, vocab_size=32000) as tracker:
+    ...     loss = loss_fn(model, input_ids)
+    >>> tracker.rows  # {'h.0': {'attention_scores': ..., 'attention': ..., ...}, ..., 'model': {...}}
+    >>> loss.backward()
+
+    with gradient checkpointing, a checkpointed module keeps its inputs instead of its activations, those inputs are
+    counted (as `other`) for the module
+    """
+
+    def __init__(self, model: nn.Module, seq_len: int, vocab_size: int):
+        """
+        :param seq_len: sequence length of the batch, [..., seq_len, seq_len] tensors saved inside an attention module
+            are attention scores (a seq_len equal to a model dimension makes its hidden states look the same)
+        :param vocab_size: [..., vocab_size] tensors are logits
+        """
+        self.model = model
+        self.seq_len = seq_len
+        self.vocab_size = vocab_size
+        self.rows: Dict[str, Dict[str, int]] = OrderedDict()
+        self.stack: List[Tuple[str, str]] = []
+        self.seen = set()
+        self.weights: Dict[Tuple[int, ...], torch.dtype] = {}
+        self.handles = []
+        self.hooks = None
+
+    def _row(self) -> str:
+        blocks = [name for name, kind in self.stack if kind == 'block']
+        return blocks[-1] if blocks else MODEL_ROW
+
+    def _category(self, tensor: torch.Tensor) -> str:
+        shape = tensor.shape
+        if tuple(shape) in self.weights and tensor.dtype != self.weights[tuple(shape)]:
+            return 'weight_copies'
+        if len(shape) and shape[-1] == self.vocab_size:
+            return 'logits'
+        kinds = [kind for _, kind in self.stack if kind != 'block']
+        kind = kinds[-1] if kinds else 'other'
+        # residuals / mlp activations of a model whose hidden size is seq_len are [..., seq, seq] too
+        if kind == 'attention' and len(shape) >= 2 and shape[-1] == shape[-2] == self.seq_len:
+            return 'attention_scores'
+        return kind
+
+    def _add(self, tensor: torch.Tensor, category: Optional[str] = None):
+        if tensor.device.type == 'meta' or tensor.is_sparse:
+            return
+        key = _storage_key(tensor)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        row = self.rows.setdefault(self._row(), OrderedDict((c, 0) for c in CATEGORIES))
+        row[category or self._category(tensor)] += key[1]
+
+    def _pack(self, tensor: torch.Tensor) -> torch.Tensor:
+        self._add(tensor)
+        return tensor
+
+    def _pre_forward(self, name: str, kind: str):
+        def hook(module, args):
+            self.stack.append((name, kind))
+            if is_checkpointed(module) and module.training and torch.is_grad_enabled():
+                for tensor in tree_flatten(args)[0]:
+                    if isinstance(tensor, torch.Tensor):
+                        self._add(tensor, 'other')
+
+        return hook
+
+    def _post_forward(self, name: str, kind: str):
+        def hook(module, args, output):
+            if (name, kind) in self.stack:
+                self.stack.remove((name, kind))
+
+        return hook
+
+    def __enter__(self) -> 'ActivationMemoryTracker':
+        # parameters and buffers live for the whole training run, they are not activations
+        self.seen = {_storage_key(t) for t in list(self.model.parameters()) + list(self.model.buffers())}
+        # a linear layer saves its (cast) weight transposed
+        self.weights = {tuple(shape): p.dtype for p in self.model.parameters() for shape in (p.shape, p.shape[::-1])}
+        self.rows[MODEL_ROW] = OrderedDict((c, 0) for c in CATEGORIES)
+        for module, stats in ModuleProfiler.targets(self.model).items():
+            self.handles.append(module.register_forward_pre_hook(self._pre_forward(stats.name, stats.kind)))
+            self.handles.append(module.register_forward_hook(self._post_forward(stats.name, stats.kind)))
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.hooks.__exit__(*exc)
+        self.hooks = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.stack.clear()
+        # the blocks first, in forward order, the rest of the model last
+        self.rows.move_to_end(MODEL_ROW)
+
+    def totals(self) -> Dict[str, int]:
+        return OrderedDict((c, sum(row[c] for row in self.rows.values())) for c in CATEGORIES)
+
+    def total(self) -> int:
+        return sum(self.totals().values())
+
+
+def parameter_bytes(model: nn.Module) -> Tuple[int, int]:
+    """
+    :return: bytes of the parameters and of their gradients
+    """
+    parameters = list(model.parameters())
+    return (sum(p.numel() * p.element_size() for p in parameters),
+            sum(p.numel() * p.element_size() for p in parameters if p.requires_grad))
+
+
+def optimizer_state_bytes(optimizer: torch.optim.Optimizer) -> int:
+    """
+    bytes of the optimizer state (exp_avg / exp_avg_sq of AdamW ...), available after the first step, the local
+    shard of a ShardedOptimizer
+    """
+    state = getattr(optimizer, 'optimizer', optimizer).state
+    return sum(t.numel() * t.element_size() for s in state.values() for t in s.values() if isinstance(t, torch.Tensor))
+
+
+def fit_activation_memory(measured: Dict[int, Dict[str, Dict[str, int]]], batch: int) \
+        -> Dict[str, Dict[str, Tuple[float, float, float]]]:
+    """
+    fits bytes = batch * (a * seq_len + b * seq_len ** 2) + c per row and category from two sequence lengths measured
+    with the same batch size, activations are linear in the batch size, only weight copies have a constant c
+    :param measured: {seq_len: tracker.rows} for exactly two sequence lengths
+    :return: {row: {category: (a, b, c)}}
+    """
+    if len(measured) != 2:
+        raise ValueError(f'two sequence lengths are needed to fit, got {sorted(measured)}')
+    (s1, rows_1), (s2, rows_2) = sorted(measured.items())
+    coefficients = OrderedDict()
+    for row in rows_2:
+        coefficients[row] = OrderedDict()
+        for category in CATEGORIES:
+            if category == 'weight_copies':
+                coefficients[row][category] = (0.0, 0.0, float(rows_2[row][category]))
+                continue
+            y1 = rows_1.get(row, {}).get(category, 0) / batch
+            y2 = rows_2[row][category] / batch
+            quadratic = (y2 * s1 - y1 * s2) / (s1 * s2 * (s2 - s1))
+            linear = (y1 - quadratic * s1 ** 2) / s1
+            if quadratic < 0 or linear < 0:
+                # not a clean linear + quadratic growth (bytes rounded by the allocator, shape dependent kernels),
+                # scale the larger measurement linearly
+                quadratic, linear = 0.0, y2 / s2
+            coefficients[row][category] = (linear, quadratic, 0.0)
+    return coefficients
+
+
+def extrapolate(coefficients: Dict[str, Dict[str, Tuple[float, float, float]]], batch: int,
+                seq_len: int) -> Dict[str, Dict[str, float]]:
+    """
+    :return: estimated activation bytes {row: {category: bytes}} of a batch of `batch` x `seq_len` tokens
+    """
+    return OrderedDict((row, OrderedDict((category, batch * (a * seq_len + b * seq_len ** 2) + c)
+                                         for category, (a, b, c) in categories.items()))
+                       for row, categories in coefficients.items())
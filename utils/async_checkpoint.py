@@ -0,0 +1,137 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Optional, Union, Any, Callable
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot(obj: Any) -> Any:
+    """
+    copy of `obj` with every tensor copied to cpu memory (nested dicts, lists and tuples are followed), so training
+    can go on changing the parameters and optimizer state while the copy is written
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj: Any, name: Union[str, os.PathLike]):
+    """
+    torch.save into a temporary file next to `name` and renames it, a crash while writing never leaves a truncated
+    checkpoint behind
+    """
+    name = os.fspath(name)
+    tmp = f'{name}.tmp-{os.getpid()}'
+    try:
+        torch.save(obj, tmp)
+        os.replace(tmp, name)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def rotate(name: Union[str, os.PathLike], keep_last: int, file_of: Optional[Callable[[str], str]] = None):
+    """
+    name -> name.1 -> name.2 ... so the newest checkpoint always is `name` and at most `keep_last` are kept
+    (`model.pt`, `model.1.pt`, ...)
+    :param file_of: maps a checkpoint name to the file actually rotated, a file belonging to `model.1.pt`
+        (`shard_name`: `model.rank1.pt` -> `model.1.rank1.pt`) is found from that name
+    """
+    name = os.fspath(name)
+    root, ext = os.path.splitext(name)
+    older = [name] + [f'{root}.{k}{ext}' for k in range(1, keep_last)]
+    if file_of is not None:
+        older = [file_of(n) for n in older]
+    if keep_last > 1 and os.path.exists(older[-1]):
+        os.remove(older[-1])
+    for k in range(len(older) - 1, 0, -1):
+        if os.path.exists(older[k - 1]):
+            os.replace(older[k - 1], older[k])
+
+
+class AsyncCheckpointWriter:
+    """
+    `save_checkpoints` in a background thread, the training loop only waits for the state to be copied to cpu
+    memory (and for the previous checkpoint if it is still being written)
+    """
+
+    def __init__(self, keep_last: int = 1, max_pending: int = 1):
+        """
+        :param keep_last: number of checkpoints kept per name, older ones are renamed to `name.1`, `name.2`, ...
+        :param max_pending: snapshots held in memory at most, `save` blocks beyond that
+        """
+        if keep_last < 1:
+            raise ValueError(f'keep_last must be at least 1, got {keep_last}')
+        self.keep_last = keep_last
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.error: Optional[BaseException] = None
+        self.stalled = 0.0
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+        # a daemon thread dies with the interpreter, queued checkpoints are written before that
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            name, file_of, state = item
+            try:
+                start = time.perf_counter()
+                if self.keep_last > 1:
+                    rotate(name, self.keep_last, file_of)
+                name = file_of(name) if file_of is not None else name
+                atomic_save(state, name)
+                self.written += 1
+                logger.info(f'checkpoint {name} written in {time.perf_counter() - start:.2f}s')
+            except BaseException as error:
+                self.error = error
+            finally:
+                del state
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def save(self, name: Union[str, os.PathLike], file_of: Optional[Callable[[str], str]] = None,
+             **kwargs) -> float:
+        """
+        same arguments as `save_checkpoints`, returns as soon as the state is snapshotted
+        :param file_of: the state is written to `file_of(name)` and rotated along with `name`, e.g. `shard_name` for
+            the optimizer shard of a rank, so `shard_name(model.1.pt)` is the shard of the older checkpoint
+        :return: seconds the caller was stalled
+        """
+        self._raise()
+        start = time.perf_counter()
+        self.queue.put((os.fspath(name), file_of, snapshot(kwargs)))
+        stalled = time.perf_counter() - start
+        self.stalled += stalled
+        return stalled
+
+    def wait(self):
+        """
+        blocks until every queued checkpoint is on disk
+        """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
@@ -0,0 +1,135 @@
+import atexit
+import logging
+import os
+import time
+import traceback
+from typing import Optional, Callable, Dict, Any, Sequence
+
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+
+from utils.empty_init import init_empty_weights, assign_weights
+from utils.sharded_weights import strip_wrapper_prefixes
+
+logger = logging.getLogger(__name__)
+
+
+def shared_weights(model: nn.Module) -> Dict[str, torch.Tensor]:
+    """
+    cpu copy of the state dict of `model` (the compiled / DDP wrapper prefixes removed) in shared memory, a worker
+    process reads it without the tensors being pickled
+    """
+    state = strip_wrapper_prefixes(getattr(model, '_orig_mod', model).state_dict())
+    return {key: value.detach().to('cpu', copy=True).share_memory_() for key, value in state.items()}
+
+
+def _worker(factory: Callable[[], nn.Module], evaluate: Callable, weights: Dict[str, torch.Tensor], idle, requests,
+            log_dir: Optional[str], device: str, threads: int, cores: Optional[Sequence[int]]):
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    board = None
+    if log_dir is not None:
+        from torch.utils.tensorboard import SummaryWriter
+
+        board = SummaryWriter(log_dir=log_dir, filename_suffix='-evaluator')
+    with init_empty_weights():
+        model = factory()
+    while True:
+        step = requests.get()
+        if step is None:
+            break
+        try:
+            # the trainer only writes the shared weights while the worker is idle, on cpu they are used in place
+            model = assign_weights(model, weights, device=device).eval()
+            with torch.no_grad():
+                evaluate(model, step, board)
+            if board is not None:
+                board.flush()
+        except Exception:
+            # a failing evaluation is reported, training and the next evaluation go on
+            logger.error(f'evaluation of step {step} failed\n{traceback.format_exc()}')
+        finally:
+            idle.set()
+    if board is not None:
+        board.close()
+
+
+class AsyncEvaluator:
+    """
+    runs `evaluate(model, step, board)` (sample generation, perplexity ...) in a separate process on its own cores,
+    the training loop only waits for the weights to be copied into shared memory
+
+    >>> evaluator = AsyncEvaluator(model, functools.partial(LLmP, config=cpu_config), sample, log_dir=...)
+    >>> evaluator.submit(model, step=at)  # every N steps, skipped while the previous evaluation still runs
+    >>> evaluator.close()
+
+    `factory` and `evaluate` are pickled into the worker, they have to be module level functions or
+    `functools.partial` of them
+    """
+
+    def __init__(self, model: nn.Module, factory: Callable[[], nn.Module], evaluate: Callable[..., Any],
+                 log_dir: Optional[str] = None, device: str = 'cpu', threads: int = 1,
+                 cores: Optional[Sequence[int]] = None):
+        """
+        :param model: training model (compiled / DDP wrapped or not), its state dict sets the shared buffers
+        :param factory: builds the model in the worker, on the meta device, the weights are assigned to it
+        :param evaluate: called with the model in eval mode under no_grad, the step and a SummaryWriter (None without
+            log_dir)
+        :param log_dir: tensorboard directory the worker writes to, next to the one of the training loop
+        :param device: device the worker evaluates on
+        :param threads: torch threads of the worker
+        :param cores: cpu cores the worker is pinned to (linux), left to the scheduler when None
+        """
+        context = mp.get_context('spawn')
+        self.weights = shared_weights(model)
+        self.idle = context.Event()
+        self.idle.set()
+        self.requests = context.Queue()
+        self.submitted = 0
+        self.skipped = 0
+        self.stalled = 0.0
+        # not a daemon, the evaluation may load its batches with DataLoader workers
+        self.process = context.Process(target=_worker, name='evaluator',
+                                       args=(factory, evaluate, self.weights, self.idle, self.requests,
+                                             log_dir, device, threads, cores))
+        self.process.start()
+        atexit.register(self.close)
+
+    def busy(self) -> bool:
+        return not self.idle.is_set()
+
+    @torch.no_grad()
+    def submit(self, model: nn.Module, step: int) -> bool:
+        """
+        copies the current weights of `model` into shared memory and starts an evaluation of them, nothing happens
+        while the previous evaluation still runs (training never queues up behind the evaluator)
+        :return: True when an evaluation was started
+        """
+        if not self.process.is_alive():
+            raise RuntimeError(f'evaluator process exited with code {self.process.exitcode}')
+        if self.busy():
+            self.skipped += 1
+            return False
+        start = time.perf_counter()
+        state = strip_wrapper_prefixes(getattr(model, '_orig_mod', model).state_dict())
+        for key, value in state.items():
+            self.weights[key].copy_(value)
+        self.stalled += time.perf_counter() - start
+        self.idle.clear()
+        self.requests.put(step)
+        self.submitted += 1
+        return True
+
+    def close(self, timeout: Optional[float] = None):
+        """
+        waits for the running evaluation and stops the worker
+        """
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        logger.debug(f'evaluator : {self.submitted} evaluations, {self.skipped} skipped, '
+                     f'training stalled {self.stalled:.2f}s')
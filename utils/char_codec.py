@@ -0,0 +1,71 @@
+import json
+import os
+from typing import Union, List
+
+import numpy as np
+import torch
+
+
+class CharCodec:
+    """
+    character level vocabulary for the PTT poetry models
+
+    characters are sorted by code point (the same order as `sorted(set(text))`) and both directions are numpy
+    lookups, so encoding a corpus is one `frombuffer` + one gather instead of a python loop over characters
+    """
+
+    def __init__(self, chars: Union[str, List[str]]):
+        self.chars = np.frombuffer(''.join(chars).encode('utf-32-le'), dtype=np.uint32).copy()
+        self.table = np.full(int(self.chars.max()) + 1 if len(self.chars) else 1, -1, dtype=np.int64)
+        self.table[self.chars] = np.arange(len(self.chars), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.chars)
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.chars)
+
+    @classmethod
+    def from_text(cls, text: str) -> "CharCodec":
+        points = np.unique(np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32))
+        return cls(points.tobytes().decode('utf-32-le'))
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike]) -> "CharCodec":
+        with open(path, 'r', encoding='utf8') as stream:
+            return cls(json.load(stream)['chars'])
+
+    @classmethod
+    def from_config(cls, vocab_path: Union[str, os.PathLike], data_path: Union[str, os.PathLike]) -> "CharCodec":
+        """
+        loads the persisted vocabulary, the corpus is only read (and the vocabulary written) the first time
+        """
+        if vocab_path is not None and os.path.exists(vocab_path):
+            return cls.load(vocab_path)
+        with open(data_path, 'r') as stream:
+            codec = cls.from_text(stream.read())
+        if vocab_path is not None:
+            codec.save(vocab_path)
+        return codec
+
+    def save(self, path: Union[str, os.PathLike]):
+        with open(path, 'w', encoding='utf8') as stream:
+            json.dump({'chars': self.chars.tobytes().decode('utf-32-le')}, stream, ensure_ascii=False)
+
+    def encode(self, text: str) -> np.ndarray:
+        points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        if len(points) and points.max() >= len(self.table):
+            raise KeyError(f'character {chr(points.max())!r} is not in the vocabulary')
+        ids = self.table[points]
+        if len(ids) and ids.min() < 0:
+            raise KeyError(f'character {chr(points[ids.argmin()])!r} is not in the vocabulary')
+        return ids
+
+    def encode_tensor(self, text: str, dtype: torch.dtype = torch.long) -> torch.Tensor:
+        return torch.from_numpy(self.encode(text)).to(dtype)
+
+    def decode(self, ids: Union[List[int], np.ndarray, torch.Tensor]) -> str:
+        if isinstance(ids, torch.Tensor):
+            ids = ids.cpu().numpy()
+        return self.chars[np.asarray(ids, dtype=np.int64)].tobytes().decode('utf-32-le')
@@ -0,0 +1,113 @@
+import argparse
+import os
+from itertools import islice
+from typing import Optional, Union, Iterable, Iterator, Tuple
+
+from erutils.loggers import fprint
+
+from utils.token_shards import iter_documents, TokenShardWriter, tokenize_into
+
+EOT = '<|endoftext|>'
+
+
+def _pairs(docs: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    (d0, d1), (d2, d3), ... an unpaired last document is dropped
+    """
+    docs = iter(docs)
+    for first in docs:
+        second = next(docs, None)
+        if second is None:
+            return
+        yield first, second
+
+
+def pgt_documents(docs: Iterable[str]) -> Iterator[str]:
+    for first, second in _pairs(docs):
+        yield first
+        yield second
+
+
+def pgt_j_documents(docs: Iterable[str]) -> Iterator[str]:
+    yield from docs
+
+
+def tpap_documents(docs: Iterable[str]) -> Iterator[str]:
+    for first, second in _pairs(islice(docs, 1, None)):
+        yield first + second
+
+
+# mode -> (input separator, documents, text written before / after every document, text between documents)
+MODES = {
+    # data/SEP_TO_CV.pgt: `[SEP]` separated question / answer pairs -> both halves as their own document
+    'pgt': ('[SEP]', pgt_documents, '', EOT, ''),
+    # data/SEP_TO_CV.pgt_j: every `[SEP]` document closed by the eos marker
+    'pgt_j': ('[SEP]', pgt_j_documents, '', EOT, ' '),
+    # data/fixing.main: PGT.txt -> TPAP.txt, question and answer of a pair merged into one document
+    'tpap': (EOT, tpap_documents, EOT, '', ''),
+}
+
+
+def convert_corpus(src: Union[str, os.PathLike], out: Optional[Union[str, os.PathLike]], mode: str = 'pgt',
+                   shards: Optional[Union[str, os.PathLike]] = None, tokenizer: str = 'gpt2',
+                   shard_tokens: int = 1 << 28, batch_size: int = 1024,
+                   buffer_size: int = 1 << 20) -> int:
+    """
+    rewrites `src` in the layout of `mode` reading and writing chunk by chunk, so the time is linear in the corpus
+    size and memory does not depend on it
+    :param src: input text file
+    :param out: output text file, None only writes shards
+    :param mode: one of MODES
+    :param shards: also tokenize the converted documents into token shards in this directory
+    :param tokenizer: tokenizer for the shards
+    :param shard_tokens: maximum tokens per shard
+    :param batch_size: documents per tokenizer call
+    :param buffer_size: characters read from `src` at once
+    :return: number of documents written
+    """
+    if mode not in MODES:
+        raise ValueError(f'mode must be one of {list(MODES)}, got {mode}')
+    sep, documents, prefix, suffix, joiner = MODES[mode]
+    stream = open(out, 'w', encoding='utf8', buffering=buffer_size) if out is not None else None
+    count = 0
+
+    def write(docs: Iterable[str]) -> Iterator[str]:
+        nonlocal count
+        for doc in docs:
+            if stream is not None:
+                stream.write((joiner if count else '') + prefix + doc + suffix)
+            count += 1
+            yield doc
+
+    converted = write(documents(iter_documents(src, sep=sep, buffer_size=buffer_size)))
+    try:
+        if shards is None:
+            for _ in converted:
+                pass
+        else:
+            from transformers import AutoTokenizer
+
+            tok = AutoTokenizer.from_pretrained(tokenizer, use_fast=True)
+            metadata = dict(source=os.fspath(src), tokenizer=tokenizer, mode=mode)
+            with TokenShardWriter(shards, vocab_size=len(tok), shard_tokens=shard_tokens, metadata=metadata) as writer:
+                tokenize_into(writer, tok, converted, batch_size=batch_size)
+    finally:
+        if stream is not None:
+            stream.close()
+    fprint(f'Converted {count} documents from {src} ({mode})')
+    return count
+
+
+if __name__ == "__main__":
+    pars = argparse.ArgumentParser(description='streaming corpus conversion (replaces data/SEP_TO_CV.py and '
+                                               'data/fixing.py)')
+    pars.add_argument('--src', '--src', type=str, default='data/PGT-DATA.txt')
+    pars.add_argument('--out', '--out', type=str, default='data/PGT-DATA-V2.txt')
+    pars.add_argument('--mode', '--mode', type=str, default='pgt', choices=list(MODES))
+    pars.add_argument('--shards', '--shards', type=str, default=None)
+    pars.add_argument('--tokenizer', '--tokenizer', type=str, default='gpt2')
+    pars.add_argument('--shard-tokens', '--shard-tokens', type=int, default=1 << 28)
+    pars.add_argument('--batch-size', '--batch-size', type=int, default=1024)
+    opt = pars.parse_args()
+    convert_corpus(opt.src, opt.out, mode=opt.mode, shards=opt.shards, tokenizer=opt.tokenizer,
+                   shard_tokens=opt.shard_tokens, batch_size=opt.batch_size)
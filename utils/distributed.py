@@ -0,0 +1,126 @@
+import logging
+import os
+from typing import Optional, Union, Any, Iterable, Iterator
+
+import torch
+import torch.distributed as dist
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, IterableDataset, DistributedSampler
+
+logger = logging.getLogger(__name__)
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def setup_distributed(backend: Optional[str] = 'gloo') -> bool:
+    """
+    joins the process group described by the `torchrun` environment (RANK, WORLD_SIZE, MASTER_ADDR, ...), a plain
+    `python train.py` run has no WORLD_SIZE and stays single process
+    :param backend: gloo (cpu and cuda) or nccl (cuda only)
+    :return: True when running with more than one process
+    """
+    if is_distributed():
+        return get_world_size() > 1
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    dist.init_process_group(backend=backend)
+    logger.info(f'rank {get_rank()} / {get_world_size()} joined the {backend} process group')
+    return True
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def distributed_device(device: Union[torch.device, str]) -> Union[torch.device, str]:
+    """
+    one cuda device per process (LOCAL_RANK), cpu stays cpu
+    """
+    if is_distributed() and torch.device(device).type == 'cuda':
+        return f'cuda:{int(os.environ.get("LOCAL_RANK", 0))}'
+    return device
+
+
+def distributed_model(model: nn.Module, bucket_cap_mb: int = 25) -> nn.Module:
+    """
+    wraps `model` in DistributedDataParallel when running with more than one process, gradients are reduced in
+    buckets of `bucket_cap_mb` as soon as the backward pass has filled them, so communication overlaps with the rest
+    of the backward pass; keep using the unwrapped model for generation and `state_dict`
+    """
+    if get_world_size() == 1:
+        return model
+    device = next(model.parameters()).device
+    return DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None,
+                                   bucket_cap_mb=bucket_cap_mb, gradient_as_bucket_view=True)
+
+
+def distributed_sampler(dataset: Dataset, shuffle: bool = False, seed: int = 0) -> Optional[DistributedSampler]:
+    """
+    :param shuffle: the train scripts do not shuffle, so neither does the sampler by default (call `set_epoch` on
+        the sampler every epoch when shuffling)
+    :return: a sampler giving every rank its own part of `dataset`, None for a single process or an iterable
+        dataset (those shard by rank themselves, see utils.streaming)
+    """
+    if get_world_size() == 1 or isinstance(dataset, IterableDataset):
+        return None
+    return DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed)
+
+
+def even_batches(batches: Iterable) -> Iterator:
+    """
+    stops every rank as soon as one rank runs out of batches, iterable datasets shard unevenly over ranks and a rank
+    that keeps stepping alone would wait forever in the gradient all-reduce
+    """
+    if get_world_size() == 1:
+        yield from batches
+        return
+    iterator = iter(batches)
+    while True:
+        batch = next(iterator, None)
+        has_batch = torch.tensor([0 if batch is None else 1])
+        dist.all_reduce(has_batch, op=dist.ReduceOp.MIN)
+        if has_batch.item() == 0:
+            return
+        yield batch
+
+
+def broadcast_object(obj: Any, src: int = 0) -> Any:
+    """
+    `obj` of rank `src` on every rank (output paths and the like that only one rank may create)
+    """
+    if get_world_size() == 1:
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def barrier():
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def all_reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    """
+    in place mean of `tensor` over all ranks
+    """
+    if get_world_size() > 1:
+        dist.all_reduce(tensor)
+        tensor.div_(get_world_size())
+    return tensor
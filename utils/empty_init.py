@@ -0,0 +1,102 @@
+import contextlib
+import logging
+from typing import Optional, Union, Dict, List
+
+import torch
+from torch import nn
+
+from utils.sharded_weights import ShardedWeights, strip_wrapper_prefixes
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def init_empty_weights():
+    """
+    models built inside this context get their parameters on the meta device, so neither the default
+    `reset_parameters` of the layers nor the `_init_weights` of the model touch any memory; buffers and plain tensor
+    attributes (causal masks, rotary frequencies) are still created for real since checkpoints do not hold all of them
+
+    >>> with init_empty_weights():
+    ...     model = LLmP(config)
+    >>> assign_weights(model, torch.load(path, 'cpu')['model'])
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module: nn.Module, name: str, param: Optional[nn.Parameter]):
+        # tied weights are assigned a parameter that already is on meta and must stay the same object
+        if param is not None and param.device.type != 'meta':
+            param = nn.Parameter(param.to('meta'), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+@torch.no_grad()
+def assign_weights(model: nn.Module, weights: Union[Dict[str, torch.Tensor], ShardedWeights],
+                   device: Optional[Union[torch.device, str]] = None, strict: bool = True) -> nn.Module:
+    """
+    makes the tensors of `weights` the parameters of `model` instead of copying them into freshly allocated ones,
+    tensors that already have the right device and dtype are used as they are (for a `ShardedWeights` export they
+    stay memory mapped and are paged in on first use)
+    :param model: model built under `init_empty_weights` (a normally built one works too, its weights are dropped)
+    :param weights: state dict (`checkpoints['model']`) or an opened sharded export
+    :param device: device of the parameters, the device of `weights` when None
+    :param strict: raise on missing or unexpected keys like `load_state_dict`, otherwise missing parameters are
+        left allocated but uninitialized
+    """
+    if isinstance(weights, dict):
+        weights = strip_wrapper_prefixes(weights)
+    keys = set(weights.keys())
+    # tied parameters are reached under every name, state dicts may hold any of them
+    aliases: Dict[int, List[str]] = {}
+    for key, param in model.named_parameters(remove_duplicate=False):
+        aliases.setdefault(id(param), []).append(key)
+    assigned: Dict[int, nn.Parameter] = {}
+    missing, used = [], set()
+    for module_name, module in model.named_modules(remove_duplicate=False):
+        prefix = f'{module_name}.' if module_name else ''
+        for name, param in list(module._parameters.items()):
+            if param is None:
+                continue
+            if id(param) not in assigned:
+                names = aliases[id(param)]
+                used.update(k for k in names if k in keys)
+                key = next((k for k in names if k in keys), None)
+                target_device = device or (param.device if param.device.type != 'meta' else None)
+                if key is not None:
+                    tensor = weights[key]
+                    if tensor.shape != param.shape:
+                        raise RuntimeError(f'size mismatch for {key}: {tuple(tensor.shape)} in the checkpoint, '
+                                           f'{tuple(param.shape)} in the model')
+                    tensor = tensor.to(device=target_device or tensor.device, dtype=param.dtype)
+                else:
+                    missing.append(names[0])
+                    tensor = torch.empty_like(param, device=target_device or 'cpu')
+                assigned[id(param)] = nn.Parameter(tensor, requires_grad=param.requires_grad)
+            module._parameters[name] = assigned[id(param)]
+        for name, buffer in module._buffers.items():
+            key = prefix + name
+            if buffer is None or name in module._non_persistent_buffers_set:
+                continue
+            if key in keys:
+                buffer.copy_(weights[key])
+                used.add(key)
+            else:
+                missing.append(key)
+        if device is not None:
+            for name, buffer in module._buffers.items():
+                if buffer is not None:
+                    module._buffers[name] = buffer.to(device)
+    unexpected = sorted(keys - used)
+    if strict and (missing or unexpected):
+        raise RuntimeError(f'error assigning weights to {type(model).__name__}, missing keys {missing}, '
+                           f'unexpected keys {unexpected}')
+    if missing:
+        logger.warning(f'{len(missing)} parameters of {type(model).__name__} are not in the checkpoint and left '
+                       f'uninitialized : {missing}')
+    return model
@@ -0,0 +1,232 @@
+import argparse
+import contextlib
+import importlib
+import math
+import time
+from typing import Optional, Callable, Dict, Iterable, List, Union
+
+import torch
+from torch import nn
+from torch.utils.data import Dataset, DataLoader, Subset
+
+from modules.precision import PrecisionPolicy
+from utils.train_step import causal_lm_loss
+
+
+def pack_documents(texts: Iterable[str], tokenizer, batch_size: int = 1000) -> torch.Tensor:
+    """
+    held out documents tokenized and concatenated into one token stream, windows cut from it are full of text
+    instead of padding (documents should carry their own sos / eos text, as in training)
+    :param batch_size: documents given to the tokenizer at once
+    """
+    texts = [text for text in texts if text]
+    ids: List[int] = []
+    for start in range(0, len(texts), batch_size):
+        for tokens in tokenizer(texts[start:start + batch_size], add_special_tokens=False)['input_ids']:
+            ids.extend(tokens)
+    return torch.tensor(ids, dtype=torch.long)
+
+
+class StridedWindows(Dataset):
+    """
+    windows of `seq_len` tokens starting every `seq_len - overlap` tokens of a token stream, the first `overlap`
+    tokens of a window were scored by the previous window and only give context, so with an overlap of at least one
+    token every token of the stream (but the first) is scored exactly once, with at least `overlap` tokens before it
+
+    an item is (input_ids, attention_mask, labels) of `seq_len` tokens, labels are -100 where nothing is scored,
+    the last window ends with the stream (the tokens it shares with the previous window only give context) so that
+    only a stream shorter than `seq_len` is padded with `pad_id` (LLmP mixes positions, padding changes its logits)
+    """
+
+    def __init__(self, tokens: torch.Tensor, seq_len: int, overlap: int = 0, pad_id: int = 0):
+        if seq_len < 2:
+            raise ValueError(f'seq_len must be at least 2, got {seq_len}')
+        if not 0 <= overlap < seq_len:
+            raise ValueError(f'overlap must be in [0, {seq_len}), got {overlap}')
+        self.tokens = tokens.reshape(-1).long()
+        self.seq_len = seq_len
+        self.overlap = overlap
+        self.stride = seq_len - overlap
+        self.pad_id = pad_id
+
+    def __len__(self) -> int:
+        if self.tokens.numel() < 2:
+            return 0
+        return 1 + math.ceil(max(self.tokens.numel() - self.seq_len, 0) / self.stride)
+
+    def __getitem__(self, index: int):
+        start = min(index * self.stride, max(self.tokens.numel() - self.seq_len, 0))
+        window = self.tokens[start:start + self.seq_len]
+        input_ids = torch.full((self.seq_len,), self.pad_id, dtype=torch.long)
+        input_ids[:window.numel()] = window
+        attention_mask = torch.zeros(self.seq_len, dtype=torch.long)
+        attention_mask[:window.numel()] = 1
+        labels = input_ids.masked_fill(attention_mask == 0, -100)
+        if index > 0:
+            # everything before the end of the previous window was scored by it
+            labels[:index * self.stride + self.overlap - start] = -100
+        return input_ids, attention_mask, labels
+
+
+def lm_logits(model: nn.Module, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """
+    logits of the causal language models of this repo, LLmP and LLMoU return (logits, past key values), PGT the
+    logits alone
+    """
+    output = model(input_ids, attention_mask=attention_mask)
+    return output[0] if isinstance(output, tuple) else output
+
+
+def evaluate(model: nn.Module, windows: Union[StridedWindows, torch.Tensor], seq_len: Optional[int] = None,
+             overlap: int = 0, batch_size: int = 8, num_workers: int = 0,
+             device: Optional[Union[torch.device, str]] = None, precision: Optional[PrecisionPolicy] = None,
+             max_windows: Optional[int] = None,
+             forward: Callable[[nn.Module, torch.Tensor, torch.Tensor], torch.Tensor] = lm_logits) \
+        -> Dict[str, float]:
+    """
+    windowed perplexity of `model` over held out text, batches of packed windows are loaded by `num_workers`
+    processes and run under inference_mode, the model is put back in training mode afterwards if it was
+    :param model: the plain model (not the DDP wrapper, every rank would wait for the others in backward)
+    :param windows: StridedWindows, or a token stream cut into windows of `seq_len` tokens overlapping by `overlap`
+    :param device: device of the model parameters when None
+    :param max_windows: only the first windows are evaluated (a quick estimate during training)
+    :param forward: returns the [batch, seq_len, vocab] logits for (model, input_ids, attention_mask)
+    :return: mean loss over the scored tokens, perplexity, number of tokens and windows, tokens per second
+    """
+    if not isinstance(windows, Dataset):
+        if seq_len is None:
+            raise ValueError('seq_len is needed to cut a token stream into windows')
+        windows = StridedWindows(windows, seq_len=seq_len, overlap=overlap)
+    if max_windows is not None and len(windows) > max_windows:
+        windows = Subset(windows, range(max_windows))
+    device = torch.device(device) if device is not None else next(model.parameters()).device
+    loader = DataLoader(windows, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                        pin_memory=device.type == 'cuda')
+    training = model.training
+    model.eval()
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    num_tokens = torch.zeros((), dtype=torch.long, device=device)
+    start = time.perf_counter()
+    try:
+        with torch.inference_mode():
+            for input_ids, attention_mask, labels in loader:
+                input_ids = input_ids.to(device, non_blocking=True)
+                attention_mask = attention_mask.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+                with precision.autocast() if precision is not None else contextlib.nullcontext():
+                    logits = forward(model, input_ids, attention_mask)
+                batch_loss, batch_tokens = causal_lm_loss(logits.float(), labels, attention_mask=attention_mask)
+                # summed on the device, one synchronization at the end
+                loss_sum += batch_loss.double()
+                num_tokens += batch_tokens
+    finally:
+        model.train(training)
+    tokens = int(num_tokens.item())
+    loss = loss_sum.item() / max(tokens, 1)
+    return dict(loss=loss, perplexity=math.exp(min(loss, 100)), tokens=tokens, windows=len(windows),
+                tokens_per_s=tokens / max(time.perf_counter() - start, 1e-9))
+
+
+# config name prefix -> (module, model class, embedding key giving the vocab size, context length field,
+# tokenizer, text before every document, agent of the multirc template), checked in order
+MODELS = (
+    ('LLMoU', ('modules.modeling_LLMoU', 'LLMoUModel', 'word_embeddings.weight', 'max_sentence_length',
+               'tokenizer_model/LLMoU-C', '', '<LLMoU> :')),
+    ('LLmPU', None),
+    ('LLmP', ('modules.models', 'LLmP', 'wte.weight', 'max_sentence_length', 'tokenizer_model/LLmP-C', '',
+              '<LLmP> :')),
+    ('PGT-J', None),
+    ('PGT', ('modules.models', 'PGT', 'wte.weight', 'chunk', 'gpt2', '<|startoftext|>', None)),
+)
+
+
+def model_entry(name: str):
+    for prefix, entry in MODELS:
+        if name.startswith(prefix):
+            if entry is None:
+                break
+            return entry
+    raise ValueError(f'no causal language model for config {name}, choose an LLmP, LLMoU or PGT config '
+                     f'(LLmPU is an encoder decoder, PGT-J has no layers and LLama only returns the last logits)')
+
+
+def load_model(checkpoints: Dict, name: Optional[str] = None, device: Union[torch.device, str] = 'cpu') -> nn.Module:
+    """
+    model of a checkpoint written by the train scripts, built without initialization and sized by its weights
+    :param checkpoints: torch.load of the checkpoint
+    :param name: config name, the one stored in the checkpoint when None
+    """
+    from utils.empty_init import init_empty_weights, assign_weights
+    from utils.sharded_weights import strip_wrapper_prefixes
+    from utils.utils import get_config_by_name
+
+    name = name or checkpoints['config']
+    module, cls, embedding = model_entry(name)[:3]
+    weights = strip_wrapper_prefixes(checkpoints['model'])
+    config = get_config_by_name(name)
+    config.vocab_size = weights[embedding].shape[0]
+    config.device = device
+    with init_empty_weights():
+        model = getattr(importlib.import_module(module), cls)(config=config)
+    return assign_weights(model, weights, device=device).eval()
+
+
+def held_out_texts(data_src: str, split: str = 'validation', text_field: str = 'text', sos: str = '',
+                   eos: str = '<|endoftext|>', agent: Optional[str] = None) -> List[str]:
+    """
+    documents of a text file (separated by <|endoftext|>) or of the `split` of a huggingface dataset (HF-name or
+    HF-name/config) between `sos` and `eos`, super_glue/multirc records are formatted as LLmP / LLMoU train on them
+    """
+    if not data_src.startswith('HF-'):
+        from utils.token_shards import iter_documents
+
+        return [sos + text + eos for text in iter_documents(data_src) if text.strip()]
+    from datasets import load_dataset
+    from modules.dataset import multirc_texts
+
+    data = load_dataset(*data_src.replace('HF-', '').split('/'))[split]
+    if text_field in data.column_names:
+        return [sos + text + eos for text in data[text_field] if text.strip()]
+    if agent is None:
+        raise ValueError(f'{data_src} has no {text_field} field')
+    return multirc_texts(data, agent=agent, eos=eos)
+
+
+if __name__ == "__main__":
+    from erutils.loggers import fprint
+    from transformers import AutoTokenizer
+
+    pars = argparse.ArgumentParser(description='windowed perplexity of a checkpoint on held out text')
+    pars.add_argument('--weight', '--weight', type=str, required=True)
+    pars.add_argument('--model', '--model', type=str, default=None, help='config name, the checkpoint one if None')
+    pars.add_argument('--data-src', '--data-src', type=str, default='HF-wikitext/wikitext-2-raw-v1')
+    pars.add_argument('--split', '--split', type=str, default='validation')
+    pars.add_argument('--text-field', '--text-field', type=str, default='text')
+    pars.add_argument('--tokenizer', '--tokenizer', type=str, default=None)
+    pars.add_argument('--seq-len', '--seq-len', type=int, default=None, help='context length of the config if None')
+    pars.add_argument('--overlap', '--overlap', type=int, default=None, help='half of seq-len if None')
+    pars.add_argument('--batch', '--batch', type=int, default=8)
+    pars.add_argument('--workers', '--workers', type=int, default=2)
+    pars.add_argument('--max-windows', '--max-windows', type=int, default=None)
+    pars.add_argument('--precision', '--precision', type=str, default='fp32', choices=['fp32', 'bf16'])
+    pars.add_argument('--device', '--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    opt = pars.parse_args()
+
+    eval_checkpoints = torch.load(opt.weight, 'cpu')
+    eval_name = opt.model or eval_checkpoints['config']
+    eval_model = load_model(eval_checkpoints, eval_name, device=opt.device)
+    del eval_checkpoints
+    _, _, _, context, tokenizer_path, sos, agent = model_entry(eval_name)
+    tokenizer = AutoTokenizer.from_pretrained(opt.tokenizer or tokenizer_path, bos_token='<|startoftext|>',
+                                              eos_token='<|endoftext|>', pad_token='<|pad|>')
+    texts = held_out_texts(opt.data_src, opt.split, opt.text_field, sos=sos, eos=tokenizer.eos_token, agent=agent)
+    eval_seq_len = opt.seq_len or getattr(eval_model.config, context)
+    eval_windows = StridedWindows(pack_documents(texts, tokenizer),
+                                  seq_len=eval_seq_len,
+                                  overlap=opt.overlap if opt.overlap is not None else eval_seq_len // 2,
+                                  pad_id=tokenizer.pad_token_id)
+    fprint(f'{eval_name} | {len(texts)} documents | {eval_windows.tokens.numel()} tokens | '
+           f'{len(eval_windows)} windows of {eval_seq_len} overlapping by {eval_windows.overlap}')
+    result = evaluate(eval_model, eval_windows, batch_size=opt.batch, num_workers=opt.workers,
+                      precision=PrecisionPolicy(opt.precision, device=opt.device), max_windows=opt.max_windows)
+    fprint(' | '.join(f'{k} {v:.4f}' if isinstance(v, float) else f'{k} {v}' for k, v in result.items()))
@@ -0,0 +1,61 @@
+import json
+import os
+import re
+from typing import Union, Iterator, Any
+
+_SKIP = re.compile(r'[\s,]*')
+_WHITESPACE = re.compile(r'\s*')
+
+
+def iter_json_array(path: Union[str, os.PathLike], buffer_size: int = 1 << 20) -> Iterator[Any]:
+    """
+    yields the elements of a top level json array one at a time, the file is read in chunks of `buffer_size`
+    characters and only the element being decoded is held in memory (plus one chunk)
+    :param path: path to a json file holding a list
+    :param buffer_size: number of characters to read at once
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf8') as stream:
+        buffer, pos, eof = '', 0, False
+
+        def refill():
+            nonlocal buffer, pos, eof
+            chunk = stream.read(buffer_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        refill()
+        pos = _SKIP.match(buffer, pos).end()
+        while pos == len(buffer) and not eof:
+            refill()
+            pos = _SKIP.match(buffer, pos).end()
+        if buffer[pos:pos + 1] != '[':
+            raise ValueError(f'{path} does not hold a json array')
+        pos += 1
+        while True:
+            pos = _SKIP.match(buffer, pos).end()
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f'{path} ended before the json array was closed')
+                refill()
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                refill()
+                continue
+            after = _WHITESPACE.match(buffer, end).end()
+            if after == len(buffer) or buffer[after] not in ',]':
+                # a number cut by the end of the chunk decodes fine but short, only trust an element followed by
+                # a delimiter
+                if eof:
+                    raise ValueError(f'{path} has no , or ] after the element at character {pos}')
+                refill()
+                continue
+            yield element
+            pos = after
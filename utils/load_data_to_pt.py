@@ -4,7 +4,7 @@ import typing
 import torch
 from erutils.loggers import fprint
 
-from utils import DatasetPGT, get_config_by_name
+from utils.utils import DatasetPGT, get_config_by_name, make_window_pairs
 
 
 # c = ''.join(f'{h}/' for h in os.getcwd().split('\\')[:-1])
@@ -29,15 +29,11 @@ def txt_2_pt(data_path: typing.Union[os.PathLike, str] = '../data/PGT-DATA-V2.tx
         return_tensors='pt',
         padding='do_not_pad',
         # max_length=self.chunk,
-        truncation=False
+        truncation=False,
+        verbose=False
     )['input_ids']
     chunk = 186
-    v = torch.tensor([])
-    for index in range(chunk, tkn.shape[1], chunk):
-        q = tkn[:, index - chunk:index - 2]
-        a = tkn[:, index - chunk + 1:index - 1]
-        v = torch.cat([v, torch.cat([q, a], dim=-2).unsqueeze(0)],
-                      dim=-3)
+    v = make_window_pairs(tkn, chunk)
     print(f'VD : {v.shape}')
     torch.save(v, '../data/Data-conversation.pth')
     print('Saved Successfully')
@@ -0,0 +1,136 @@
+import collections
+import resource
+import sys
+from typing import Optional, Union, Dict, Any, Deque, Tuple, List
+
+import torch
+
+
+def memory_stats(device: Union[torch.device, str]) -> Dict[str, float]:
+    """
+    memory in GB without synchronizing the device, cuda reads the caching allocator counters (instead of
+    `torch.cuda.mem_get_info`), cpu reports the peak resident set size of the process
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return dict(allocated_GB=torch.cuda.memory_allocated(device) / 1e9,
+                    peak_GB=torch.cuda.max_memory_allocated(device) / 1e9)
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return dict(peak_RSS_GB=peak / 1e9)
+
+
+class TrainMetrics:
+    """
+    training metrics summed on the device, every `flush_every` steps the sums are copied to the host in one
+    non blocking transfer and written to tensorboard / the progress bar once the copy has landed (at the latest on the
+    next flush), so the training loop never waits for the device because of logging
+
+    >>> metrics = TrainMetrics(board, flush_every=50, device=device)
+    >>> metrics.start_epoch(progress_bar, epoch=f'[{epoch}/{epochs}]')
+    >>> metrics.update(Loss=loss)
+    >>> metrics.step(global_step)
+    """
+
+    def __init__(self, board: Optional[Any] = None, flush_every: int = 50,
+                 device: Optional[Union[torch.device, str]] = None, prefix: Optional[str] = 'train'):
+        """
+        :param board: tensorboard SummaryWriter, None on ranks that do not log
+        :param flush_every: steps between two copies to the host
+        :param device: device whose memory is reported, nothing is reported when None
+        """
+        if flush_every < 1:
+            raise ValueError(f'flush_every must be at least 1, got {flush_every}')
+        self.board = board
+        self.flush_every = flush_every
+        self.device = device
+        self.prefix = prefix
+        self.progress_bar = None
+        self.postfix: Dict[str, Any] = {}
+        self.window: Dict[str, torch.Tensor] = {}
+        self.total: Dict[str, torch.Tensor] = {}
+        self.window_steps = 0
+        self.total_steps = 0
+        self.steps = 0
+        self.pending: Deque[Tuple[List[str], torch.Tensor, Optional[Any], int, int, int]] = collections.deque()
+        self.last: Dict[str, float] = {}
+
+    def start_epoch(self, progress_bar: Optional[Any] = None, **postfix):
+        """
+        running averages start over, `postfix` (epoch, device, ...) is shown next to the metrics
+        """
+        self.flush()
+        self.total = {}
+        self.total_steps = 0
+        self.progress_bar = progress_bar
+        self.postfix = postfix
+
+    def update(self, **values: Union[torch.Tensor, float]):
+        """
+        adds the values of this step, tensors stay on their device (detached, no `.item()`)
+        """
+        for name, value in values.items():
+            value = value.detach().float() if isinstance(value, torch.Tensor) else torch.tensor(float(value))
+            self.window[name] = self.window[name] + value if name in self.window else value
+            self.total[name] = self.total[name] + value if name in self.total else value
+
+    def step(self, global_step: Optional[int] = None) -> bool:
+        """
+        :return: True when this step flushed
+        """
+        self.steps += 1
+        self.window_steps += 1
+        self.total_steps += 1
+        if self.steps % self.flush_every != 0:
+            return False
+        self.flush(global_step)
+        return True
+
+    def flush(self, global_step: Optional[int] = None):
+        """
+        starts the copy of the current window and writes every earlier window whose copy is done
+        """
+        global_step = self.steps if global_step is None else global_step
+        if self.window:
+            names = list(self.window)
+            values = torch.stack([self.window[k] for k in names] + [self.total[k] for k in names])
+            event = None
+            if values.is_cuda:
+                host = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+                host.copy_(values, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                values = host
+            self.pending.append((names, values, event, self.window_steps, self.total_steps, global_step))
+            self.window = {}
+            self.window_steps = 0
+        while self.pending and (self.pending[0][2] is None or self.pending[0][2].query()):
+            names, values, _, window_steps, total_steps, step = self.pending.popleft()
+            self._write(names, values, window_steps, total_steps, step)
+
+    def close(self) -> Dict[str, float]:
+        """
+        waits for every pending copy and writes it
+        :return: the last written values
+        """
+        self.flush()
+        while self.pending:
+            names, values, event, window_steps, total_steps, step = self.pending.popleft()
+            if event is not None:
+                event.synchronize()
+            self._write(names, values, window_steps, total_steps, step)
+        return self.last
+
+    def _write(self, names: List[str], values: torch.Tensor, window_steps: int, total_steps: int, global_step: int):
+        values = values.tolist()
+        scalars = {}
+        for index, name in enumerate(names):
+            scalars[name] = values[index] / max(window_steps, 1)
+            scalars[f'avg-{name}'] = values[len(names) + index] / max(total_steps, 1)
+        memory = memory_stats(self.device) if self.device is not None else {}
+        self.last = {**scalars, **memory}
+        if self.board is not None:
+            for name, value in self.last.items():
+                self.board.add_scalar(f'{self.prefix}/{name}', scalar_value=value, global_step=global_step)
+        if self.progress_bar is not None:
+            self.progress_bar.set_postfix(**self.postfix, **self.last)
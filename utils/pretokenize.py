@@ -0,0 +1,244 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Optional, Sequence, List, Tuple, Callable, Iterable
+
+import numpy as np
+import torch
+from tqdm.auto import tqdm
+
+logger = logging.getLogger(__name__)
+
+_worker_tokenizer = None
+
+
+class TokenizedArrays:
+    """
+    result of `pretokenize`
+
+    padded mode keeps `input_ids` / `attention_mask` as [num_examples, max_length] arrays,
+    ragged mode (padding='do_not_pad') keeps every example back to back in `input_ids` with `offsets` marking
+    where each one starts (num_examples + 1 entries) and no attention mask
+    """
+
+    def __init__(self, input_ids: np.ndarray, attention_mask: Optional[np.ndarray] = None,
+                 offsets: Optional[np.ndarray] = None):
+        self.input_ids = input_ids
+        self.attention_mask = attention_mask
+        self.offsets = offsets
+
+    @property
+    def ragged(self) -> bool:
+        return self.offsets is not None
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.ragged else self.input_ids.shape[0]
+
+    def ids(self, index: int) -> torch.Tensor:
+        if self.ragged:
+            return torch.from_numpy(self.input_ids[self.offsets[index]:self.offsets[index + 1]]).long()
+        return torch.from_numpy(self.input_ids[index]).long()
+
+    def mask(self, index: int) -> torch.Tensor:
+        return torch.from_numpy(self.attention_mask[index]).long()
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    # each worker is already one process per core, nested rust threads only fight over the same cores
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    _worker_tokenizer = tokenizer
+
+
+def _encode(tokenizer, texts: List[str], max_length: Optional[int], padding: str,
+            add_special_tokens: bool) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+    enc = tokenizer(texts, max_length=max_length, truncation=max_length is not None, padding=padding,
+                    add_special_tokens=add_special_tokens, return_attention_mask=padding != 'do_not_pad')
+    if padding == 'do_not_pad':
+        lengths = np.fromiter((len(ids) for ids in enc['input_ids']), dtype=np.int64, count=len(texts))
+        flat = np.fromiter((t for ids in enc['input_ids'] for t in ids), dtype=np.int32, count=int(lengths.sum()))
+        return flat, None, lengths
+    return np.asarray(enc['input_ids'], dtype=np.int32), np.asarray(enc['attention_mask'], dtype=np.uint8), None
+
+
+def _encode_in_worker(texts: List[str], max_length: Optional[int], padding: str, add_special_tokens: bool):
+    return _encode(_worker_tokenizer, texts, max_length, padding, add_special_tokens)
+
+
+def pretokenize(tokenizer, texts: Sequence[str], max_length: Optional[int] = None, padding: str = 'max_length',
+                add_special_tokens: bool = True, batch_size: int = 4096, num_proc: Optional[int] = None,
+                parallel_threshold: int = 200_000, desc: str = 'Tokenizing Data') -> TokenizedArrays:
+    """
+    tokenizes `texts` with the batched tokenizer call and writes the ids straight into preallocated int arrays
+    :param tokenizer: a (preferably fast) huggingface tokenizer
+    :param texts: already formatted examples
+    :param max_length: truncate (and with padding='max_length' pad) every example to this length
+    :param padding: 'max_length' or 'do_not_pad'
+    :param add_special_tokens: passed to the tokenizer
+    :param batch_size: examples per tokenizer call
+    :param num_proc: worker processes, None picks os.cpu_count() once `texts` is larger than `parallel_threshold`
+    :param parallel_threshold: minimum number of examples before a process pool is used
+    :param desc: progress bar description
+    """
+    if padding not in ('max_length', 'do_not_pad'):
+        raise ValueError(f'padding must be max_length or do_not_pad, got {padding}')
+    if padding == 'max_length' and max_length is None:
+        raise ValueError('max_length is required for padding="max_length"')
+    if not getattr(tokenizer, 'is_fast', False):
+        logger.warning(f'{type(tokenizer).__name__} is not a fast tokenizer, batched tokenization will be slow')
+    total = len(texts)
+    if num_proc is None:
+        num_proc = (os.cpu_count() or 1) if total >= parallel_threshold else 1
+    batches = [(start, list(texts[start:start + batch_size])) for start in range(0, total, batch_size)]
+    kwargs = dict(max_length=max_length, padding=padding, add_special_tokens=add_special_tokens)
+
+    if padding == 'max_length':
+        input_ids = np.empty((total, max_length), dtype=np.int32)
+        attention_mask = np.empty((total, max_length), dtype=np.uint8)
+    else:
+        input_ids, attention_mask = None, None
+    ragged_parts = [None] * len(batches)
+    lengths = np.zeros(total, dtype=np.int64)
+
+    def collect(index, start, result):
+        ids, mask, lens = result
+        if padding == 'max_length':
+            input_ids[start:start + len(ids)] = ids
+            attention_mask[start:start + len(ids)] = mask
+        else:
+            ragged_parts[index] = ids
+            lengths[start:start + len(lens)] = lens
+
+    pbar = tqdm(total=total, desc=desc)
+    if num_proc > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=num_proc, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+            futures = [pool.submit(_encode_in_worker, chunk, **kwargs) for _, chunk in batches]
+            for index, ((start, chunk), future) in enumerate(zip(batches, futures)):
+                collect(index, start, future.result())
+                pbar.update(len(chunk))
+    else:
+        for index, (start, chunk) in enumerate(batches):
+            collect(index, start, _encode(tokenizer, chunk, **kwargs))
+            pbar.update(len(chunk))
+    pbar.close()
+
+    if padding == 'max_length':
+        return TokenizedArrays(input_ids=input_ids, attention_mask=attention_mask)
+    offsets = np.zeros(total + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.empty(int(offsets[-1]), dtype=np.int32)
+    for (start, _), part in zip(batches, ragged_parts):
+        flat[offsets[start]:offsets[start] + len(part)] = part
+    return TokenizedArrays(input_ids=flat, offsets=offsets)
+
+
+def _grow(array: np.ndarray, needed: int) -> np.ndarray:
+    if needed <= len(array):
+        return array
+    grown = np.empty((max(needed, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def pretokenize_iter(tokenizer, texts: Iterable[str], max_length: Optional[int] = None,
+                     padding: str = 'max_length', add_special_tokens: bool = True, batch_size: int = 4096,
+                     desc: str = 'Tokenizing Data') -> TokenizedArrays:
+    """
+    `pretokenize` for an iterator of texts of unknown length, only `batch_size` texts are held at once and the
+    id arrays grow as batches come in
+    """
+    if padding not in ('max_length', 'do_not_pad'):
+        raise ValueError(f'padding must be max_length or do_not_pad, got {padding}')
+    if padding == 'max_length' and max_length is None:
+        raise ValueError('max_length is required for padding="max_length"')
+    texts = iter(texts)
+    if padding == 'max_length':
+        input_ids = np.empty((batch_size, max_length), dtype=np.int32)
+        attention_mask = np.empty((batch_size, max_length), dtype=np.uint8)
+    else:
+        input_ids, attention_mask = np.empty(batch_size * 64, dtype=np.int32), None
+    lengths = np.empty(batch_size, dtype=np.int64)
+    total, filled = 0, 0
+    pbar = tqdm(desc=desc)
+    while True:
+        chunk = list(islice(texts, batch_size))
+        if not chunk:
+            break
+        ids, mask, lens = _encode(tokenizer, chunk, max_length=max_length, padding=padding,
+                                  add_special_tokens=add_special_tokens)
+        if padding == 'max_length':
+            input_ids = _grow(input_ids, total + len(ids))
+            attention_mask = _grow(attention_mask, total + len(ids))
+            input_ids[total:total + len(ids)] = ids
+            attention_mask[total:total + len(ids)] = mask
+        else:
+            input_ids = _grow(input_ids, filled + len(ids))
+            input_ids[filled:filled + len(ids)] = ids
+            lengths = _grow(lengths, total + len(lens))
+            lengths[total:total + len(lens)] = lens
+            filled += len(ids)
+        total += len(chunk)
+        pbar.update(len(chunk))
+    pbar.close()
+
+    if padding == 'max_length':
+        return TokenizedArrays(input_ids=input_ids[:total], attention_mask=attention_mask[:total])
+    offsets = np.zeros(total + 1, dtype=np.int64)
+    np.cumsum(lengths[:total], out=offsets[1:])
+    return TokenizedArrays(input_ids=input_ids[:filled], offsets=offsets)
+
+
+class PreEncoded:
+    """
+    per-example encoding cache for datasets that used to call the tokenizer in `__getitem__`
+
+    ids and masks live in fixed [num_examples, max_length] tensors, `mode='eager'` fills them up front with
+    `pretokenize`, `mode='lazy'` fills a row the first time it is requested; in lazy mode the tensors are in shared
+    memory so rows encoded inside DataLoader workers are visible to every other worker and to later epochs
+    """
+
+    def __init__(self, tokenizer, texts: Sequence, max_length: int, pad_to_max_length: bool = True,
+                 mode: str = 'lazy', normalize: Optional[Callable[[str], str]] = None):
+        if mode not in ('lazy', 'eager'):
+            raise ValueError(f'mode must be lazy or eager, got {mode}')
+        self.tokenizer = tokenizer
+        self.texts = texts
+        self.max_length = max_length
+        self.pad_to_max_length = pad_to_max_length
+        self.normalize = normalize if normalize is not None else str
+        total = len(texts)
+        pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        if mode == 'eager':
+            tokenized = pretokenize(tokenizer, [self.normalize(str(t)) for t in texts], max_length=max_length,
+                                    padding='max_length', desc='Pre-Encoding')
+            self.input_ids = torch.from_numpy(tokenized.input_ids)
+            self.attention_mask = torch.from_numpy(tokenized.attention_mask)
+            self.lengths = self.attention_mask.sum(-1, dtype=torch.int32)
+            self.filled = torch.ones(total, dtype=torch.bool)
+        else:
+            self.input_ids = torch.full((total, max_length), pad_id, dtype=torch.int32).share_memory_()
+            self.attention_mask = torch.zeros((total, max_length), dtype=torch.uint8).share_memory_()
+            self.lengths = torch.zeros(total, dtype=torch.int32).share_memory_()
+            self.filled = torch.zeros(total, dtype=torch.bool).share_memory_()
+
+    def __len__(self):
+        return len(self.filled)
+
+    def _encode(self, index: int):
+        enc = self.tokenizer(self.normalize(str(self.texts[index])), max_length=self.max_length, truncation=True,
+                             padding='max_length', return_attention_mask=True)
+        self.input_ids[index] = torch.tensor(enc['input_ids'], dtype=torch.int32)
+        self.attention_mask[index] = torch.tensor(enc['attention_mask'], dtype=torch.uint8)
+        self.lengths[index] = sum(enc['attention_mask'])
+        # flag last, a reader in another worker never sees a half written row as filled
+        self.filled[index] = True
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :return: int64 ids and attention mask, max_length long or trimmed to the example when not padding
+        """
+        if not self.filled[index]:
+            self._encode(index)
+        length = self.max_length if self.pad_to_max_length else int(self.lengths[index])
+        return self.input_ids[index, :length].long(), self.attention_mask[index, :length].long()
@@ -0,0 +1,271 @@
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Union, Dict, List, Any
+
+import torch
+from torch import nn
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+logger = logging.getLogger(__name__)
+
+
+def _numel(shape) -> int:
+    return math.prod(shape) if len(shape) else 1
+
+
+def _matmul_flops(func, args, out) -> int:
+    """
+    multiply-adds * 2 of the matrix products the models run (linear layers, attention scores, Conv1D, convolutions)
+    """
+    name = func.overloadpacket.__name__
+    if name in ('mm', 'addmm'):
+        a, b = (args[0], args[1]) if name == 'mm' else (args[1], args[2])
+        return 2 * a.shape[0] * a.shape[1] * b.shape[1]
+    if name in ('bmm', 'baddbmm'):
+        a, b = (args[0], args[1]) if name == 'bmm' else (args[1], args[2])
+        return 2 * a.shape[0] * a.shape[1] * a.shape[2] * b.shape[2]
+    if name == 'convolution':
+        weight = args[1]
+        return 2 * out.numel() * _numel(weight.shape[1:])
+    if name in ('_scaled_dot_product_efficient_attention', '_scaled_dot_product_flash_attention'):
+        query, key = args[0], args[1]
+        return 4 * query.shape[0] * query.shape[1] * query.shape[2] * key.shape[2] * query.shape[3]
+    return 0
+
+
+class ModuleStats:
+    def __init__(self, name: str, kind: str):
+        self.name = name
+        self.kind = kind
+        self.calls = 0
+        self.forward_seconds = 0.0
+        self.backward_seconds = 0.0
+        self.forward_flops = 0
+        self.backward_flops = 0
+        self.allocated_bytes = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
+
+class _Counter(TorchDispatchMode):
+    """
+    attributes the flops and the bytes of every tensor an op creates to the modules that are running
+    """
+
+    def __init__(self, profiler: 'ModuleProfiler'):
+        super(_Counter, self).__init__()
+        self.profiler = profiler
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        forward, backward = self.profiler.forward_stack, self.profiler.backward_open
+        if not forward and not backward:
+            return out
+        flops = _matmul_flops(func, args, out)
+        # views and in place ops return storage of their inputs, only new storage is counted as allocated
+        inputs = {t.untyped_storage().data_ptr() for t in tree_flatten(args)[0] if isinstance(t, torch.Tensor)}
+        allocated = sum(t.untyped_storage().nbytes() for t in tree_flatten(out)[0]
+                        if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs)
+        for stats in forward:
+            stats.forward_flops += flops
+            stats.allocated_bytes += allocated
+        for stats in backward:
+            stats.backward_flops += flops
+        return out
+
+
+class ModuleProfiler:
+    """
+    forward / backward hooks on every transformer block (LLmPBlock, LLMoUBlock, LLamaBlock, PGTBlock, LLmPUBlock,
+    ... any module whose class name ends with `Block`) and on their attention and mlp sub modules, recording wall
+    time, matmul flops and the bytes of the tensors they create, exported as a chrome trace (chrome://tracing or
+    https://ui.perfetto.dev) and a per layer table
+
+    opt-in only: every op goes through a python dispatch mode and cuda is synchronized around every hook, so the
+    profiled steps run slower than the others; profile the eager model (hooks do not survive `torch.compile`)
+
+    backward spans start when the gradient of a module output is ready and end when the gradient of its input is,
+    a module input that also feeds a residual connection therefore includes the rest of that residual branch
+    """
+
+    def __init__(self, model: nn.Module, steps: int = 1, synchronize: bool = True):
+        """
+        :param model: the unwrapped model (not the compiled one)
+        :param steps: number of `step` calls to record, the profiler stops itself after them
+        :param synchronize: synchronize cuda in every hook so times belong to the module that launched the kernels
+        """
+        if steps < 1:
+            raise ValueError(f'steps must be at least 1, got {steps}')
+        self.model = model
+        self.steps = steps
+        self.synchronize = synchronize and any(p.is_cuda for p in model.parameters())
+        self.stats: Dict[nn.Module, ModuleStats] = OrderedDict()
+        self.forward_stack: List[ModuleStats] = []
+        self.backward_open: List[ModuleStats] = []
+        self.events: List[Dict[str, Any]] = []
+        self.handles = []
+        self.counter: Optional[_Counter] = None
+        self.recorded = 0
+        self.step_start = 0.0
+        self.origin = 0.0
+
+    @staticmethod
+    def targets(model: nn.Module) -> Dict[nn.Module, ModuleStats]:
+        """
+        blocks and the sub modules of every block that hold parameters (norms excluded)
+        """
+        targets = OrderedDict()
+        for name, module in model.named_modules():
+            if not type(module).__name__.endswith('Block'):
+                continue
+            targets[module] = ModuleStats(name, 'block')
+            children = []
+            for child_name, child in module.named_children():
+                # LLmPUBlock keeps its attention and feed forward layers in a ModuleList
+                if isinstance(child, (nn.ModuleList, nn.ModuleDict)):
+                    children.extend((f'{child_name}.{n}', c) for n, c in child.named_children())
+                else:
+                    children.append((child_name, child))
+            for child_name, child in children:
+                kind = type(child).__name__.lower()
+                if 'norm' in kind or next(child.parameters(), None) is None:
+                    continue
+                targets[child] = ModuleStats(f'{name}.{child_name}', 'attention' if 'attention' in kind else 'mlp')
+        return targets
+
+    def _now(self) -> float:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _event(self, stats: ModuleStats, phase: str, start: float, end: float, flops: int):
+        self.events.append(dict(name=stats.name, cat=f'{stats.kind},{phase}', ph='X', pid=0,
+                                tid=0 if phase == 'forward' else 1, ts=(start - self.origin) * 1e6,
+                                dur=(end - start) * 1e6, args=dict(flops=flops, step=self.recorded)))
+
+    def _pre_forward(self, stats: ModuleStats):
+        def hook(module, args):
+            stats.calls += 1
+            self.forward_stack.append(stats)
+            stats._forward_start = self._now()
+            stats._forward_flops = stats.forward_flops
+            if torch.is_grad_enabled():
+                inputs = [t for t in tree_flatten(args)[0] if isinstance(t, torch.Tensor) and t.requires_grad]
+                stats._backward_input = inputs[0] if inputs else None
+
+        return hook
+
+    def _post_forward(self, stats: ModuleStats):
+        def hook(module, args, output):
+            end = self._now()
+            self.forward_stack.remove(stats)
+            stats.forward_seconds += end - stats._forward_start
+            self._event(stats, 'forward', stats._forward_start, end, stats.forward_flops - stats._forward_flops)
+            source = getattr(stats, '_backward_input', None)
+            stats._backward_input = None
+            outputs = [t for t in tree_flatten(output)[0] if isinstance(t, torch.Tensor) and t.requires_grad]
+            if source is None or not outputs:
+                return
+            span = {}
+
+            def backward_start(grad):
+                span.update(start=self._now(), flops=stats.backward_flops)
+                self.backward_open.append(stats)
+
+            def backward_end(grad):
+                if 'start' not in span or stats not in self.backward_open:
+                    return
+                end_time = self._now()
+                self.backward_open.remove(stats)
+                stats.backward_seconds += end_time - span['start']
+                self._event(stats, 'backward', span['start'], end_time, stats.backward_flops - span['flops'])
+
+            outputs[0].register_hook(backward_start)
+            source.register_hook(backward_end)
+
+        return hook
+
+    def start(self) -> 'ModuleProfiler':
+        self.stats = self.targets(self.model)
+        for module, stats in self.stats.items():
+            self.handles.append(module.register_forward_pre_hook(self._pre_forward(stats)))
+            self.handles.append(module.register_forward_hook(self._post_forward(stats)))
+        self.counter = _Counter(self)
+        self.counter.__enter__()
+        self.origin = self.step_start = self._now()
+        logger.info(f'profiling {len(self.stats)} modules for {self.steps} steps')
+        return self
+
+    def step(self) -> bool:
+        """
+        call after every training step
+        :return: True when the requested number of steps is recorded (and the profiler stopped)
+        """
+        if self.counter is None:
+            return False
+        end = self._now()
+        self.events.append(dict(name=f'step {self.recorded}', cat='step', ph='X', pid=0, tid=2,
+                                ts=(self.step_start - self.origin) * 1e6, dur=(end - self.step_start) * 1e6))
+        self.step_start = end
+        self.recorded += 1
+        # spans whose input never got a gradient must not leak into the next step
+        self.backward_open.clear()
+        if self.recorded < self.steps:
+            return False
+        self.stop()
+        return True
+
+    def stop(self):
+        if self.counter is not None:
+            self.counter.__exit__(None, None, None)
+            self.counter = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.forward_stack.clear()
+        self.backward_open.clear()
+
+    def export_chrome_trace(self, path: Union[str, os.PathLike]):
+        """
+        forward spans on thread 0, backward spans on thread 1, steps on thread 2
+        """
+        names = [dict(name='thread_name', ph='M', pid=0, tid=tid, args=dict(name=name))
+                 for tid, name in enumerate(('forward', 'backward', 'steps'))]
+        with open(path, 'w') as stream:
+            json.dump(dict(traceEvents=names + self.events, displayTimeUnit='ms'), stream)
+
+    def summary(self) -> str:
+        """
+        per module totals over the recorded steps
+        """
+        header = f'{"module":<36} {"kind":<9} {"calls":>5} {"fwd ms":>9} {"bwd ms":>9} {"fwd GFLOP":>10} ' \
+                 f'{"bwd GFLOP":>10} {"GFLOP/s":>9} {"alloc MB":>9}'
+        lines = [header, '-' * len(header)]
+        for stats in self.stats.values():
+            seconds = stats.forward_seconds + stats.backward_seconds
+            throughput = (stats.forward_flops + stats.backward_flops) / seconds / 1e9 if seconds else 0.0
+            lines.append(f'{stats.name[-36:]:<36} {stats.kind:<9} {stats.calls:>5} '
+                         f'{stats.forward_seconds * 1e3:>9.2f} {stats.backward_seconds * 1e3:>9.2f} '
+                         f'{stats.forward_flops / 1e9:>10.3f} {stats.backward_flops / 1e9:>10.3f} '
+                         f'{throughput:>9.1f} {stats.allocated_bytes / 2 ** 20:>9.1f}')
+        return '\n'.join(lines)
+
+    def export_summary(self, path: Union[str, os.PathLike]):
+        with open(path, 'w') as stream:
+            json.dump(dict(steps=self.recorded, modules=[s.as_dict() for s in self.stats.values()]), stream, indent=2)
+
+    def save(self, directory: Union[str, os.PathLike], name: Optional[str] = 'profile') -> str:
+        """
+        writes `<name>-trace.json` and `<name>-summary.json` into `directory`
+        :return: the summary table
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.export_chrome_trace(os.path.join(directory, f'{name}-trace.json'))
+        self.export_summary(os.path.join(directory, f'{name}-summary.json'))
+        return self.summary()
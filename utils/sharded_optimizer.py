@@ -0,0 +1,136 @@
+import os
+from typing import Optional, Iterable, Dict, Any, List, Type, Union
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+from utils.distributed import get_rank, get_world_size
+
+
+def shard_name(name: Union[str, os.PathLike], rank: Optional[int] = None) -> str:
+    """
+    checkpoint file of the optimizer shard of `rank`, rank 0 keeps its shard in the main checkpoint `name`
+    """
+    rank = get_rank() if rank is None else rank
+    if rank == 0:
+        return os.fspath(name)
+    root, ext = os.path.splitext(os.fspath(name))
+    return f'{root}.rank{rank}{ext}'
+
+
+def partition_parameters(params: List[torch.nn.Parameter], world_size: int) -> List[int]:
+    """
+    owner rank of every parameter, largest parameters first onto the rank holding the fewest elements so every rank
+    keeps about the same amount of optimizer state (parameters are never split)
+    """
+    owners = [0] * len(params)
+    load = [0] * world_size
+    for index in sorted(range(len(params)), key=lambda i: params[i].numel(), reverse=True):
+        rank = min(range(world_size), key=lambda r: load[r])
+        owners[index] = rank
+        load[rank] += params[index].numel()
+    return owners
+
+
+class ShardedOptimizer(torch.optim.Optimizer):
+    """
+    ZeRO stage 1, every rank keeps the optimizer state (AdamW: exp_avg and exp_avg_sq) of only its own part of the
+    parameters; the gradients are still all-reduced by DistributedDataParallel, each rank updates the parameters it
+    owns and then sends them to the others
+
+    `param_groups` hold all parameters (GradientAccumulator divides and clips every gradient, learning rate
+    schedulers change the hyper parameters of all groups) while the wrapped optimizer only sees the owned ones
+    """
+
+    def __init__(self, params: Iterable, optimizer_class: Type[torch.optim.Optimizer] = torch.optim.AdamW,
+                 **defaults):
+        super(ShardedOptimizer, self).__init__(params, defaults)
+        self.optimizer_class = optimizer_class
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.params: List[torch.nn.Parameter] = [p for group in self.param_groups for p in group['params']]
+        self.owners = partition_parameters(self.params, self.world_size)
+        owned = {id(p) for p, owner in zip(self.params, self.owners) if owner == self.rank}
+        local_groups = [{**{k: v for k, v in group.items() if k != 'params'},
+                         'params': [p for p in group['params'] if id(p) in owned]} for group in self.param_groups]
+        self.optimizer = optimizer_class(local_groups, **defaults)
+
+    @property
+    def owned_numel(self) -> int:
+        return sum(p.numel() for p, owner in zip(self.params, self.owners) if owner == self.rank)
+
+    def _sync_hyper_parameters(self):
+        for group, local_group in zip(self.param_groups, self.optimizer.param_groups):
+            for key, value in group.items():
+                if key != 'params':
+                    local_group[key] = value
+
+    @torch.no_grad()
+    def _broadcast_parameters(self):
+        for rank in range(self.world_size):
+            params = [p for p, owner in zip(self.params, self.owners) if owner == rank]
+            by_dtype: Dict[torch.dtype, List[torch.nn.Parameter]] = {}
+            for p in params:
+                by_dtype.setdefault(p.dtype, []).append(p)
+            for tensors in by_dtype.values():
+                flat = _flatten_dense_tensors([p.data for p in tensors])
+                dist.broadcast(flat, src=rank)
+                if rank != self.rank:
+                    for p, synced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+                        p.data.copy_(synced)
+
+    def step(self, closure=None):
+        self._sync_hyper_parameters()
+        loss = self.optimizer.step(closure)
+        if self.world_size > 1:
+            self._broadcast_parameters()
+        return loss
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        state of this rank only, save it with `save_checkpoints(optimizer=..., name=shard_name(name))` (or
+        `AsyncCheckpointWriter.save(optimizer=..., name=name, file_of=shard_name)` to rotate it with `name`)
+        """
+        return dict(shard=self.rank, world_size=self.world_size, optimizer=self.optimizer.state_dict())
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        """
+        :param state_dict: a shard saved by `state_dict` with the same number of ranks, or the state dict of an
+            unsharded optimizer over the same parameters (single process checkpoints) from which this rank takes
+            its own part
+        """
+        if 'shard' not in state_dict:
+            state_dict = dict(shard=self.rank, world_size=self.world_size, optimizer=self._take_shard(state_dict))
+        if state_dict['world_size'] != self.world_size or state_dict['shard'] != self.rank:
+            raise ValueError(f'optimizer shard {state_dict["shard"]} of {state_dict["world_size"]} ranks can not be '
+                             f'loaded on rank {self.rank} of {self.world_size}')
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+        for group, local_group in zip(self.param_groups, self.optimizer.param_groups):
+            group.update({k: v for k, v in local_group.items() if k != 'params'})
+
+    def _take_shard(self, state_dict: Dict[str, Any]) -> Dict[str, Any]:
+        groups, state, local_index = [], {}, 0
+        for group in state_dict['param_groups']:
+            params = []
+            for index in group['params']:
+                if self.owners[index] != self.rank:
+                    continue
+                if index in state_dict['state']:
+                    state[local_index] = state_dict['state'][index]
+                params.append(local_index)
+                local_index += 1
+            groups.append({**group, 'params': params})
+        return dict(state=state, param_groups=groups)
+
+
+def load_optimizer_state(optimizer: torch.optim.Optimizer, checkpoints: Dict[str, Any],
+                         name: Union[str, os.PathLike]):
+    """
+    loads the optimizer state of this rank, from the shard file next to `name` when `checkpoints` (the main
+    checkpoint) was saved sharded and from `checkpoints` itself otherwise
+    """
+    state = checkpoints['optimizer']
+    if isinstance(optimizer, ShardedOptimizer) and 'shard' in state and get_rank() != 0:
+        state = torch.load(shard_name(name), 'cpu')['optimizer']
+    optimizer.load_state_dict(state)
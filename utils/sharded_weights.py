@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import struct
+from collections import OrderedDict
+from typing import Optional, Union, Dict, List, Iterator, Tuple
+
+import numpy as np
+import torch
+from erutils.loggers import fprint
+
+INDEX_NAME = 'model.safetensors.index.json'
+_ALIGNMENT = 8
+# safetensors dtype name -> (torch dtype, numpy dtype the bytes are mapped as)
+_DTYPES = {
+    'F64': (torch.float64, np.float64),
+    'F32': (torch.float32, np.float32),
+    'F16': (torch.float16, np.float16),
+    # numpy has no bfloat16, the raw 16 bit words are mapped and reinterpreted by torch
+    'BF16': (torch.bfloat16, np.int16),
+    'I64': (torch.int64, np.int64),
+    'I32': (torch.int32, np.int32),
+    'I16': (torch.int16, np.int16),
+    'I8': (torch.int8, np.int8),
+    'U8': (torch.uint8, np.uint8),
+    'BOOL': (torch.bool, np.bool_),
+}
+_NAMES = {torch_dtype: name for name, (torch_dtype, _) in _DTYPES.items()}
+# prefixes torch.compile and DistributedDataParallel put in front of every state dict key
+_WRAPPER_PREFIXES = ('_orig_mod.', 'module.')
+
+
+def strip_wrapper_prefixes(state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """
+    keys of a compiled / DDP model (`_orig_mod.h.0...`, `module.h.0...`) as the plain model names them
+    """
+    stripped = OrderedDict()
+    for key, value in state_dict.items():
+        for prefix in _WRAPPER_PREFIXES:
+            while key.startswith(prefix):
+                key = key[len(prefix):]
+        stripped[key] = value
+    return stripped
+
+
+def _module_name(key: str) -> str:
+    return key.rsplit('.', 1)[0] if '.' in key else ''
+
+
+def _plan_shards(state_dict: Dict[str, torch.Tensor], max_shard_bytes: int) -> List[List[str]]:
+    """
+    splits the keys into shards of at most `max_shard_bytes` (a bigger single module gets a shard of its own), the
+    tensors of one module always land in the same shard so a module is loaded from one file
+    """
+    modules: Dict[str, List[str]] = OrderedDict()
+    for key in state_dict:
+        modules.setdefault(_module_name(key), []).append(key)
+    shards, current, size = [], [], 0
+    for keys in modules.values():
+        module_bytes = sum(state_dict[k].numel() * state_dict[k].element_size() for k in keys)
+        if current and size + module_bytes > max_shard_bytes:
+            shards.append(current)
+            current, size = [], 0
+        current.extend(keys)
+        size += module_bytes
+    if current:
+        shards.append(current)
+    return shards
+
+
+def write_safetensors(tensors: Dict[str, torch.Tensor], path: Union[str, os.PathLike],
+                      metadata: Optional[Dict[str, str]] = None):
+    """
+    writes `tensors` in the safetensors layout (8 byte header size, json header, raw little endian data), the
+    tensors are streamed to the file one at a time
+    """
+    # widest dtypes first keeps every tensor aligned to its element size without gaps between them
+    names = sorted(tensors, key=lambda k: -tensors[k].element_size())
+    header, offset = OrderedDict(), 0
+    if metadata:
+        header['__metadata__'] = {str(k): str(v) for k, v in metadata.items()}
+    for name in names:
+        tensor = tensors[name]
+        if tensor.dtype not in _NAMES:
+            raise ValueError(f'{name} has dtype {tensor.dtype} which the format does not support')
+        size = tensor.numel() * tensor.element_size()
+        header[name] = dict(dtype=_NAMES[tensor.dtype], shape=list(tensor.shape), data_offsets=[offset, offset + size])
+        offset += size
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf8')
+    encoded += b' ' * (-len(encoded) % _ALIGNMENT)
+    tmp = f'{os.fspath(path)}.tmp-{os.getpid()}'
+    with open(tmp, 'wb') as stream:
+        stream.write(struct.pack('<Q', len(encoded)))
+        stream.write(encoded)
+        for name in names:
+            tensor = tensors[name].detach().to('cpu').contiguous()
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            stream.write(tensor.numpy().tobytes())
+    os.replace(tmp, path)
+
+
+def export_sharded(state_dict: Dict[str, torch.Tensor], out_dir: Union[str, os.PathLike],
+                   max_shard_bytes: int = 1 << 30, metadata: Optional[Dict[str, str]] = None) -> dict:
+    """
+    weights only inference export, `model-00001-of-0000n.safetensors` shards plus `model.safetensors.index.json`
+    mapping every tensor to its shard (the layout of huggingface sharded checkpoints)
+    :param state_dict: model state dict, wrapper prefixes of compiled / DDP models are removed
+    :param out_dir: directory for the shards and the index
+    :param max_shard_bytes: target shard size
+    :param metadata: string key / values stored in the index and every shard header
+    :return: the index
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    state_dict = strip_wrapper_prefixes(state_dict)
+    shards = _plan_shards(state_dict, max_shard_bytes)
+    weight_map = OrderedDict()
+    for number, keys in enumerate(shards, start=1):
+        file_name = f'model-{number:05d}-of-{len(shards):05d}.safetensors'
+        write_safetensors({k: state_dict[k] for k in keys}, os.path.join(out_dir, file_name), metadata=metadata)
+        weight_map.update((k, file_name) for k in keys)
+    index = dict(metadata=dict(total_size=sum(v.numel() * v.element_size() for v in state_dict.values()),
+                               **(metadata or {})),
+                 weight_map=weight_map)
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as stream:
+        json.dump(index, stream, indent=2)
+    return index
+
+
+class SafetensorsFile:
+    """
+    one mapped shard, tensors are views of a copy-on-write `numpy.memmap` so nothing is read before a tensor is
+    touched and pages are never written back to the file
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        with open(path, 'rb') as stream:
+            header_size = struct.unpack('<Q', stream.read(8))[0]
+            self.header = json.loads(stream.read(header_size))
+        self.metadata = self.header.pop('__metadata__', {})
+        self.data_start = 8 + header_size
+        self._data: Optional[np.memmap] = None
+
+    def keys(self) -> List[str]:
+        return list(self.header)
+
+    def get(self, name: str) -> torch.Tensor:
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=np.uint8, mode='c', offset=self.data_start)
+        info = self.header[name]
+        torch_dtype, np_dtype = _DTYPES[info['dtype']]
+        begin, end = info['data_offsets']
+        tensor = torch.from_numpy(self._data[begin:end].view(np_dtype).reshape(info['shape']))
+        return tensor.view(torch_dtype) if torch_dtype == torch.bfloat16 else tensor
+
+    def close(self):
+        """
+        unmaps the file (tensors returned by `get` must not be used afterwards unless they were copied)
+        """
+        if self._data is not None:
+            self._data._mmap.close()
+            self._data = None
+
+
+class ShardedWeights:
+    """
+    read side of `export_sharded`, accepts the export directory, its index or a single .safetensors file
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        path = os.fspath(path)
+        if os.path.isdir(path):
+            path = os.path.join(path, INDEX_NAME)
+        if path.endswith('.safetensors'):
+            self.root = os.path.dirname(path)
+            self.weight_map = OrderedDict((k, os.path.basename(path)) for k in SafetensorsFile(path).keys())
+            self.metadata = {}
+        else:
+            self.root = os.path.dirname(path)
+            with open(path, 'r') as stream:
+                index = json.load(stream)
+            self.weight_map = OrderedDict(index['weight_map'])
+            self.metadata = index.get('metadata', {})
+        self.files: Dict[str, SafetensorsFile] = {}
+
+    @staticmethod
+    def is_export(path: Union[str, os.PathLike]) -> bool:
+        path = os.fspath(path)
+        return path.endswith('.safetensors') or path.endswith(INDEX_NAME) or (
+                os.path.isdir(path) and os.path.exists(os.path.join(path, INDEX_NAME)))
+
+    def __len__(self):
+        return len(self.weight_map)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.weight_map
+
+    def keys(self) -> List[str]:
+        return list(self.weight_map)
+
+    def shard_of(self, name: str) -> SafetensorsFile:
+        file_name = self.weight_map[name]
+        if file_name not in self.files:
+            self.files[file_name] = SafetensorsFile(os.path.join(self.root, file_name))
+        return self.files[file_name]
+
+    def __getitem__(self, name: str) -> torch.Tensor:
+        """
+        :return: a tensor sharing memory with the mapped file, copy it (or keep this object open) to use it
+        """
+        return self.shard_of(name).get(name)
+
+    def by_shard(self) -> Iterator[Tuple[str, List[str]]]:
+        """
+        (shard file, its keys) in the order of the index
+        """
+        groups: Dict[str, List[str]] = OrderedDict()
+        for key, file_name in self.weight_map.items():
+            groups.setdefault(file_name, []).append(key)
+        yield from groups.items()
+
+    def release(self, file_name: str):
+        shard = self.files.pop(file_name, None)
+        if shard is not None:
+            shard.close()
+
+    def close(self):
+        for file_name in list(self.files):
+            self.release(file_name)
+
+
+@torch.no_grad()
+def load_sharded(model: torch.nn.Module, path: Union[str, os.PathLike], strict: bool = True) -> torch.nn.Module:
+    """
+    copies an export into the parameters and buffers of `model` module by module, every shard is unmapped as soon
+    as its modules are loaded, so besides the model itself at most one shard is resident
+    :param model: model to fill, on any device
+    :param path: export directory, index or .safetensors file
+    :param strict: raise on missing or unexpected keys like `load_state_dict`
+    """
+    weights = ShardedWeights(path)
+    targets = OrderedDict(model.state_dict(keep_vars=True))
+    if strict:
+        missing = [k for k in targets if k not in weights]
+        unexpected = [k for k in weights.keys() if k not in targets]
+        if missing or unexpected:
+            raise RuntimeError(f'error loading {path} into {type(model).__name__}, missing keys {missing}, '
+                               f'unexpected keys {unexpected}')
+    for file_name, keys in weights.by_shard():
+        modules: Dict[str, List[str]] = OrderedDict()
+        for key in keys:
+            if key in targets:
+                modules.setdefault(_module_name(key), []).append(key)
+        for names in modules.values():
+            for key in names:
+                source = weights[key]
+                if targets[key].shape != source.shape:
+                    raise RuntimeError(f'size mismatch for {key}: {tuple(source.shape)} in {path}, '
+                                       f'{tuple(targets[key].shape)} in the model')
+                targets[key].copy_(source)
+        weights.release(file_name)
+    return model
+
+
+def export_checkpoint(checkpoint: Union[str, os.PathLike], out_dir: Union[str, os.PathLike],
+                      max_shard_bytes: int = 1 << 30, dtype: Optional[torch.dtype] = None) -> dict:
+    """
+    inference export of a training checkpoint (`save_checkpoints` file with a `model` entry, or a bare state dict),
+    optimizer state and everything else is left out
+    :param dtype: cast floating point weights, e.g. torch.bfloat16 to halve the export
+    """
+    loaded = torch.load(checkpoint, 'cpu')
+    state_dict = loaded['model'] if isinstance(loaded, dict) and 'model' in loaded else loaded
+    metadata = {k: str(v) for k, v in loaded.items() if k in ('config', 'config_name', 'epoch', 'at')} \
+        if isinstance(loaded, dict) and 'model' in loaded else {}
+    del loaded
+    if dtype is not None:
+        state_dict = OrderedDict((k, v.to(dtype) if v.is_floating_point() else v) for k, v in state_dict.items())
+    return export_sharded(state_dict, out_dir, max_shard_bytes=max_shard_bytes, metadata=metadata)
+
+
+if __name__ == "__main__":
+    pars = argparse.ArgumentParser(description='weights only, sharded and memory mappable export of a checkpoint')
+    pars.add_argument('--checkpoint', '--checkpoint', type=str, required=True)
+    pars.add_argument('--out', '--out', type=str, required=True)
+    pars.add_argument('--shard-size-mb', '--shard-size-mb', type=int, default=1024)
+    pars.add_argument('--dtype', '--dtype', type=str, default=None, choices=['fp32', 'fp16', 'bf16'])
+    opt = pars.parse_args()
+    exported = export_checkpoint(opt.checkpoint, opt.out, max_shard_bytes=opt.shard_size_mb << 20,
+                                 dtype=dict(fp32=torch.float32, fp16=torch.float16, bf16=torch.bfloat16).get(opt.dtype))
+    fprint(f'Exported {len(exported["weight_map"])} tensors ({exported["metadata"]["total_size"] / 1e6:.1f} MB) '
+           f'in {len(set(exported["weight_map"].values()))} shards to {opt.out}')
@@ -0,0 +1,151 @@
+import os
+import random
+from itertools import islice
+from typing import Optional, Union, Iterable, Iterator, Callable, List
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from utils.token_shards import iter_documents
+
+
+def iter_records(source: Union[str, os.PathLike], split: str = 'train', text_field: str = 'text',
+                 sep: Optional[str] = '<|endoftext|>') -> Iterator[str]:
+    """
+    yields raw text records one at a time without loading the source
+    :param source: 'HF-name' / 'HF-name/config' for a huggingface dataset (opened with streaming=True) or a path
+     to a text file
+    :param split: huggingface split
+    :param text_field: huggingface column holding the text
+    :param sep: document separator for text files (None yields one record per line)
+    """
+    source = os.fspath(source)
+    if source.startswith('HF-'):
+        from datasets import load_dataset
+
+        name = source.replace('HF-', '')
+        data = load_dataset(*name.split('/', 1), split=split, streaming=True)
+        for record in data:
+            yield record[text_field]
+    else:
+        yield from iter_documents(source, sep=sep)
+
+
+def is_article_text(text: str) -> bool:
+    """
+    drops the empty lines and ' = heading = ' lines of wikitext style dumps
+    """
+    return text != '' and not text.startswith(' =')
+
+
+def shuffle_buffer(items: Iterable, buffer_size: int, rng: random.Random) -> Iterator:
+    """
+    approximate shuffle holding at most `buffer_size` items, every new item replaces a random one in the buffer
+    which is yielded instead
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def _shard_info() -> (int, int):
+    """
+    :return: index of this reader and the number of readers, over distributed ranks and DataLoader workers
+    """
+    worker = get_worker_info()
+    worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+    rank, world_size = 0, 1
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return rank * num_workers + worker_id, world_size * num_workers
+
+
+class StreamingTextDataset(IterableDataset):
+    """
+    text records -> (shard per worker / rank) -> bounded shuffle -> batched tokenization -> fixed length rows
+
+    documents are concatenated and cut into rows of `seq_len` tokens, so nothing is padded and only the shuffle
+    buffer, one tokenizer batch and one partial row are ever held in memory
+    """
+
+    def __init__(self, records: Union[str, os.PathLike, Callable[[], Iterable[str]]], tokenizer, seq_len: int,
+                 prefix: str = '', suffix: str = '', keep: Optional[Callable[[str], bool]] = None,
+                 shuffle_buffer_size: int = 10_000, tokenize_batch: int = 256, max_records: Optional[int] = None,
+                 return_mask: bool = True, seed: int = 0, **record_kwargs):
+        """
+        :param records: a source understood by `iter_records` or a callable returning a fresh iterable of texts
+        :param tokenizer: huggingface tokenizer
+        :param seq_len: tokens per row
+        :param prefix: prepended to every record before tokenization (e.g. the sos token)
+        :param suffix: appended to every record (e.g. the eos token), marks document boundaries inside a row
+        :param keep: filter on the raw record, records it returns False for are dropped
+        :param shuffle_buffer_size: records held for shuffling, 0 keeps the source order
+        :param tokenize_batch: records per tokenizer call
+        :param max_records: stop after this many records of the source (before sharding)
+        :param return_mask: yield (ids, mask) instead of ids only, the mask is all ones since rows are packed
+        :param seed: shuffle seed, mixed with the epoch given to `set_epoch`
+        :param record_kwargs: passed to `iter_records`
+        """
+        super().__init__()
+        self.records = records
+        self.tokenizer = tokenizer
+        self.seq_len = seq_len
+        self.prefix = prefix
+        self.suffix = suffix
+        self.keep = keep
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.tokenize_batch = tokenize_batch
+        self.max_records = max_records
+        self.return_mask = return_mask
+        self.seed = seed
+        self.record_kwargs = record_kwargs
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        """
+        reseeds the shuffle, call it before every epoch (DataLoader workers work on copies of the dataset)
+        """
+        self.epoch = epoch
+
+    def _records(self) -> Iterator[str]:
+        if callable(self.records):
+            records = iter(self.records())
+        else:
+            records = iter_records(self.records, **self.record_kwargs)
+        if self.max_records is not None:
+            records = islice(records, self.max_records)
+        index, count = _shard_info()
+        if count > 1:
+            records = islice(records, index, None, count)
+        if self.keep is not None:
+            records = filter(self.keep, records)
+        if self.shuffle_buffer_size > 0:
+            rng = random.Random(hash((self.seed, self.epoch, index)))
+            records = shuffle_buffer(records, self.shuffle_buffer_size, rng)
+        return records
+
+    def _token_batches(self) -> Iterator[np.ndarray]:
+        records = self._records()
+        while True:
+            batch: List[str] = [self.prefix + r + self.suffix for r in islice(records, self.tokenize_batch)]
+            if not batch:
+                return
+            ids = self.tokenizer(batch, add_special_tokens=False)['input_ids']
+            yield np.fromiter((t for doc in ids for t in doc), dtype=np.int64)
+
+    def __iter__(self):
+        carry = np.empty(0, dtype=np.int64)
+        for tokens in self._token_batches():
+            tokens = np.concatenate([carry, tokens]) if len(carry) else tokens
+            rows = len(tokens) // self.seq_len
+            for row in torch.from_numpy(tokens[:rows * self.seq_len]).view(rows, self.seq_len):
+                yield (row, torch.ones_like(row)) if self.return_mask else row
+            carry = tokens[rows * self.seq_len:]
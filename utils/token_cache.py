@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Optional, Sequence, Union, Iterable, Callable
+
+import numpy as np
+
+from utils.pretokenize import TokenizedArrays, pretokenize, pretokenize_iter
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    hash of everything that changes the ids a tokenizer produces (vocab, merges, added tokens, normalizer,
+    padding id and side)
+    """
+    h = hashlib.sha256()
+    h.update(type(tokenizer).__name__.encode())
+    if getattr(tokenizer, 'is_fast', False):
+        h.update(tokenizer.backend_tokenizer.to_str().encode())
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+        h.update(json.dumps(sorted(tokenizer.get_added_vocab().items())).encode())
+    h.update(json.dumps([str(tokenizer.pad_token_id), tokenizer.padding_side, tokenizer.truncation_side,
+                         str(tokenizer.special_tokens_map)]).encode())
+    return h.hexdigest()
+
+
+def texts_fingerprint(texts: Iterable[str]) -> str:
+    """
+    hash of the formatted examples, so it covers both the data source and the formatting template, works on
+    lists and on one-pass iterators alike
+    """
+    h = hashlib.sha256()
+    count = 0
+    for text in texts:
+        encoded = text.encode('utf8')
+        h.update(len(encoded).to_bytes(8, 'little'))
+        h.update(encoded)
+        count += 1
+    h.update(str(count).encode())
+    return h.hexdigest()
+
+
+def cache_key(tokenizer, texts: Iterable[str], **key_parts) -> str:
+    parts = dict(version=CACHE_VERSION, tokenizer=tokenizer_fingerprint(tokenizer), texts=texts_fingerprint(texts),
+                 **{k: str(v) for k, v in key_parts.items()})
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def _load(path: Union[str, os.PathLike]) -> TokenizedArrays:
+    # copy-on-write mapping: arrays are writable for torch.from_numpy but nothing is read until it is used
+    arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='c')
+              for name in os.listdir(path) if name.endswith('.npy')}
+    return TokenizedArrays(input_ids=arrays['input_ids'], attention_mask=arrays.get('attention_mask'),
+                           offsets=arrays.get('offsets'))
+
+
+def _save(path: Union[str, os.PathLike], tokenized: TokenizedArrays, meta: dict):
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        for name in ('input_ids', 'attention_mask', 'offsets'):
+            array = getattr(tokenized, name)
+            if array is not None:
+                np.save(os.path.join(tmp, f'{name}.npy'), array)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as stream:
+            json.dump(meta, stream, indent=2)
+        # a finished entry appears at once, a crash mid-write only leaves a .tmp- directory behind
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            raise
+
+
+def load_or_pretokenize(tokenizer, texts: Union[Sequence[str], Callable[[], Iterable[str]]],
+                        cache_dir: Optional[Union[str, os.PathLike]] = None,
+                        dataset: Optional[str] = None, **pretokenize_kwargs) -> TokenizedArrays:
+    """
+    `pretokenize` behind an on-disk cache
+
+    the cache entry is addressed by a hash of the tokenizer files, the formatted texts (data source + template),
+    the dataset class and the tokenization arguments, so changing any of them makes a new entry instead of
+    reusing a stale one; entries are `.npy` files opened with mmap so repeat runs start without tokenizing
+    :param tokenizer: huggingface tokenizer
+    :param texts: formatted examples, or a callable returning a fresh iterator over them for sources too large to
+     hold as a list (it is called once to hash and once more to tokenize on a cache miss)
+    :param cache_dir: cache root, None disables caching
+    :param dataset: name of the dataset class, part of the key
+    """
+    streamed = callable(texts)
+
+    def run():
+        if streamed:
+            kwargs = {k: v for k, v in pretokenize_kwargs.items() if k not in ('num_proc', 'parallel_threshold')}
+            return pretokenize_iter(tokenizer, texts(), **kwargs)
+        return pretokenize(tokenizer, texts, **pretokenize_kwargs)
+
+    if cache_dir is None:
+        return run()
+    key_kwargs = {k: v for k, v in pretokenize_kwargs.items() if k in ('max_length', 'padding', 'add_special_tokens')}
+    key = cache_key(tokenizer, texts() if streamed else texts, dataset=dataset, **key_kwargs)
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        logger.info(f'Loading Tokenized Data From Cache {path}')
+        return _load(path)
+    tokenized = run()
+    _save(path, tokenized, meta=dict(dataset=dataset, examples=len(tokenized), **key_kwargs))
+    logger.info(f'Tokenized Data Cached At {path}')
+    return _load(path)
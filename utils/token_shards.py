@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+from typing import Optional, Union, List, Iterable
+
+import numpy as np
+import torch
+from erutils.loggers import fprint
+from tqdm.auto import tqdm
+
+MANIFEST_NAME = 'manifest.json'
+# torch has no (or very limited) unsigned 16/32 bit support, windows are handed out as the signed type of the
+# same width (a free reinterpretation) and masked back to the real id when widened to int64
+_SIGNED = {np.dtype(np.uint16): np.dtype(np.int16), np.dtype(np.uint32): np.dtype(np.int32)}
+
+
+def shard_dtype(vocab_size: int) -> np.dtype:
+    """
+    :param vocab_size: number of ids the tokenizer can produce
+    :return: smallest unsigned dtype that holds every token id
+    """
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.uint32)
+
+
+def iter_documents(path: Union[str, os.PathLike], sep: Optional[str] = '<|endoftext|>',
+                   buffer_size: int = 1 << 20) -> Iterable[str]:
+    """
+    reads a text file in chunks of `buffer_size` characters and yields the documents separated by `sep`,
+    a separator cut in half by a chunk boundary is carried over to the next read, the documents are exactly those
+    of `text.split(sep)`
+    :param path: path to the text file
+    :param sep: document separator (None yields one document per line)
+    :param buffer_size: number of characters to read at once
+    """
+    with open(path, 'r', encoding='utf8') as stream:
+        if sep is None:
+            for line in stream:
+                yield line
+            return
+        carry = ''
+        while True:
+            chunk = stream.read(buffer_size)
+            if not chunk:
+                break
+            parts = (carry + chunk).split(sep)
+            carry = parts.pop()
+            for part in parts:
+                yield part
+        # same pieces as str.split, including the empty one after a trailing separator
+        yield carry
+
+
+class TokenShardWriter:
+    """
+    writes tokenized documents into flat binary shards
+
+    every shard is a pair of files, `shard_xxxxx.bin` holding the token ids back to back as uint16/uint32 and
+    `shard_xxxxx.idx` holding the int64 offsets of the documents inside the shard (n_documents + 1 entries),
+    `manifest.json` describes the dtype and the shards and is written on close
+    """
+
+    def __init__(self, out_dir: Union[str, os.PathLike], vocab_size: int, shard_tokens: int = 1 << 28,
+                 metadata: Optional[dict] = None):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.vocab_size = vocab_size
+        self.dtype = shard_dtype(vocab_size)
+        self.shard_tokens = shard_tokens
+        self.metadata = metadata or {}
+        self.shards: List[dict] = []
+        self._stream = None
+        self._offsets: List[int] = []
+        self._tokens = 0
+
+    def _open_shard(self):
+        name = f'shard_{len(self.shards):05d}'
+        self._stream = open(os.path.join(self.out_dir, f'{name}.bin'), 'wb')
+        self._offsets = [0]
+        self._tokens = 0
+        self.shards.append(dict(name=name, tokens=0, documents=0))
+
+    def _close_shard(self):
+        if self._stream is None:
+            return
+        self._stream.close()
+        self._stream = None
+        np.asarray(self._offsets, dtype=np.int64).tofile(
+            os.path.join(self.out_dir, f'{self.shards[-1]["name"]}.idx'))
+        self.shards[-1].update(tokens=self._tokens, documents=len(self._offsets) - 1)
+
+    def add_document(self, ids: Union[List[int], np.ndarray, torch.Tensor]):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.view(-1).cpu().numpy()
+        ids = np.asarray(ids)
+        if ids.size == 0:
+            return
+        if self._stream is None or (self._tokens > 0 and self._tokens + ids.size > self.shard_tokens):
+            self._close_shard()
+            self._open_shard()
+        self._stream.write(ids.astype(self.dtype, copy=False).tobytes())
+        self._tokens += int(ids.size)
+        self._offsets.append(self._tokens)
+
+    def close(self):
+        self._close_shard()
+        manifest = dict(
+            dtype=self.dtype.name,
+            vocab_size=self.vocab_size,
+            total_tokens=sum(s['tokens'] for s in self.shards),
+            total_documents=sum(s['documents'] for s in self.shards),
+            shards=self.shards,
+            **self.metadata
+        )
+        with open(os.path.join(self.out_dir, MANIFEST_NAME), 'w') as stream:
+            json.dump(manifest, stream, indent=2)
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TokenShards:
+    """
+    read side of the shard format, shards are opened with `numpy.memmap` so nothing is loaded until a window
+    is touched and windows returned by `slice` share memory with the mapped file
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_NAME), 'r') as stream:
+            self.manifest = json.load(stream)
+        self.dtype = np.dtype(self.manifest['dtype'])
+        self.vocab_size = self.manifest['vocab_size']
+        self.tokens: List[np.ndarray] = []
+        self.offsets: List[np.ndarray] = []
+        for shard in self.manifest['shards']:
+            # copy-on-write mapping gives writable arrays, so torch.from_numpy does not warn and the file stays intact
+            self.tokens.append(np.memmap(os.path.join(path, f'{shard["name"]}.bin'), dtype=self.dtype, mode='c',
+                                         shape=(shard['tokens'],)))
+            self.offsets.append(np.fromfile(os.path.join(path, f'{shard["name"]}.idx'), dtype=np.int64))
+        self.starts = np.cumsum([0] + [s['tokens'] for s in self.manifest['shards']])
+
+    @staticmethod
+    def is_shard_dir(path: Union[str, os.PathLike]) -> bool:
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @property
+    def num_documents(self) -> int:
+        return sum(len(o) - 1 for o in self.offsets)
+
+    def slice(self, start: int, stop: int) -> torch.Tensor:
+        """
+        :return: raw tokens[start:stop] of the whole corpus as a signed int16/int32 tensor sharing memory with the
+         mapped shard (a copy only when the window crosses a shard boundary), use `ids` for int64 token ids
+        """
+        shard = int(np.searchsorted(self.starts, start, side='right')) - 1
+        local = start - int(self.starts[shard])
+        if stop <= int(self.starts[shard + 1]):
+            return torch.from_numpy(self.tokens[shard][local:local + stop - start].view(_SIGNED[self.dtype]))
+        parts = []
+        while start < stop:
+            end = min(stop, int(self.starts[shard + 1]))
+            parts.append(self.tokens[shard][start - int(self.starts[shard]):end - int(self.starts[shard])])
+            start = end
+            shard += 1
+        return torch.from_numpy(np.concatenate(parts).view(_SIGNED[self.dtype]))
+
+    def widen(self, raw: torch.Tensor) -> torch.Tensor:
+        return raw.long() & np.iinfo(self.dtype).max
+
+    def ids(self, start: int, stop: int) -> torch.Tensor:
+        """
+        :return: tokens[start:stop] as int64 token ids
+        """
+        return self.widen(self.slice(start, stop))
+
+    def document(self, index: int) -> torch.Tensor:
+        for shard, offsets in enumerate(self.offsets):
+            if index < len(offsets) - 1:
+                return self.widen(torch.from_numpy(
+                    self.tokens[shard][offsets[index]:offsets[index + 1]].view(_SIGNED[self.dtype])))
+            index -= len(offsets) - 1
+        raise IndexError(f'document index out of range for {self.path}')
+
+
+def tokenize_into(writer: TokenShardWriter, tokenizer, documents: Iterable[str], batch_size: int = 1024,
+                  append_eos: bool = True, desc: str = 'Converting Documents'):
+    """
+    tokenizes `documents` in batches through the (fast) tokenizer and adds them to `writer`, blank documents are
+    skipped
+    """
+    eos = [tokenizer.eos_token_id] if append_eos and tokenizer.eos_token_id is not None else []
+    batch = []
+    for doc in tqdm(documents, desc=desc):
+        if doc.strip() == '':
+            continue
+        batch.append(doc)
+        if len(batch) == batch_size:
+            for ids in tokenizer(batch, add_special_tokens=False)['input_ids']:
+                writer.add_document(ids + eos)
+            batch = []
+    if batch:
+        for ids in tokenizer(batch, add_special_tokens=False)['input_ids']:
+            writer.add_document(ids + eos)
+
+
+def convert(src: Union[str, os.PathLike], out_dir: Union[str, os.PathLike], tokenizer: str = 'gpt2',
+            sep: Optional[str] = '<|endoftext|>', shard_tokens: int = 1 << 28, batch_size: int = 1024,
+            append_eos: bool = True) -> dict:
+    """
+    tokenizes `src` document by document (batched through the fast tokenizer) and writes token shards to `out_dir`
+    """
+    from transformers import AutoTokenizer
+
+    tok = AutoTokenizer.from_pretrained(tokenizer, use_fast=True)
+    metadata = dict(source=os.fspath(src), tokenizer=tokenizer, separator=sep)
+    writer = TokenShardWriter(out_dir, vocab_size=len(tok), shard_tokens=shard_tokens, metadata=metadata)
+    tokenize_into(writer, tok, iter_documents(src, sep=sep), batch_size=batch_size, append_eos=append_eos)
+    manifest = writer.close()
+    fprint(f'Wrote {manifest["total_tokens"]} tokens in {len(manifest["shards"])} shards to {out_dir}')
+    return manifest
+
+
+if __name__ == "__main__":
+    pars = argparse.ArgumentParser(description='convert a text corpus into memory-mapped token shards')
+    pars.add_argument('--src', '--src', type=str, default='data/PGT-DATA-V2.txt')
+    pars.add_argument('--out', '--out', type=str, default='data/PGT-DATA-V2-shards')
+    pars.add_argument('--tokenizer', '--tokenizer', type=str, default='gpt2')
+    pars.add_argument('--sep', '--sep', type=str, default='<|endoftext|>')
+    pars.add_argument('--shard-tokens', '--shard-tokens', type=int, default=1 << 28)
+    pars.add_argument('--batch-size', '--batch-size', type=int, default=1024)
+    opt = pars.parse_args()
+    convert(opt.src, opt.out, tokenizer=opt.tokenizer, sep=opt.sep, shard_tokens=opt.shard_tokens,
+            batch_size=opt.batch_size)
@@ -0,0 +1,126 @@
+import contextlib
+from typing import Optional, Tuple, Union, List
+
+import torch
+import torch.nn.functional as F
+
+from utils.distributed import get_world_size, all_reduce_mean
+
+
+def token_loss(logits: torch.Tensor, labels: torch.Tensor,
+               ignore_index: int = -100) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    :param logits: [..., vocab] predictions
+    :param labels: [...] target ids, positions equal to `ignore_index` do not count
+    :return: summed cross entropy and the number of tokens it was summed over (both tensors, no host sync)
+    """
+    labels = labels.reshape(-1)
+    loss_sum = F.cross_entropy(logits.reshape(-1, logits.size(-1)).float(), labels, ignore_index=ignore_index,
+                               reduction='sum')
+    return loss_sum, (labels != ignore_index).sum()
+
+
+def causal_lm_loss(logits: torch.Tensor, labels: torch.Tensor, attention_mask: Optional[torch.Tensor] = None,
+                   ignore_index: int = -100) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    next token loss, position t predicts labels[t + 1], padded positions (attention_mask == 0) are not counted
+    :return: summed cross entropy and the number of predicted tokens
+    """
+    shift_logits = logits[..., :-1, :]
+    shift_labels = labels[..., 1:]
+    if attention_mask is not None:
+        shift_labels = shift_labels.masked_fill(
+            attention_mask.to(shift_labels.device).reshape(shift_labels.shape[0], -1)[..., 1:] == 0, ignore_index)
+    return token_loss(shift_logits, shift_labels, ignore_index=ignore_index)
+
+
+class GradientAccumulator:
+    """
+    optimizer step over `accumulation_steps` micro-batches
+
+    every micro-batch backpropagates its *summed* token loss, before the optimizer step the gradients are divided
+    by the number of tokens seen since the last step, so the update is the mean over all tokens of the effective
+    batch no matter how unevenly the tokens are spread over micro-batches (padding, packing, a short last batch)
+
+    with several processes DistributedDataParallel averages the summed gradients over ranks and the token count is
+    averaged the same way, so the update is still the mean over the tokens of all ranks
+    """
+
+    def __init__(self, optimizer: torch.optim.Optimizer, accumulation_steps: int = 1,
+                 max_grad_norm: Optional[float] = None, model: Optional[torch.nn.Module] = None):
+        """
+        :param model: the (DistributedDataParallel) model, only needed to skip the gradient all-reduce of the
+            micro-batches before the last one
+        """
+        if accumulation_steps < 1:
+            raise ValueError(f'accumulation_steps must be at least 1, got {accumulation_steps}')
+        self.optimizer = optimizer
+        self.accumulation_steps = accumulation_steps
+        self.max_grad_norm = max_grad_norm
+        self.model = model
+        self.micro_steps = 0
+        self.tokens: Union[torch.Tensor, int] = 0
+        self.steps = 0
+        self.unsynced = False
+
+    @property
+    def parameters(self) -> List[torch.nn.Parameter]:
+        return [p for group in self.optimizer.param_groups for p in group['params']]
+
+    def no_sync(self):
+        """
+        context for the forward and backward pass of one micro-batch, gradients of all but the last micro-batch
+        stay local and are reduced once with the last one
+        """
+        if self.model is None or not hasattr(self.model, 'no_sync') or \
+                self.micro_steps + 1 >= self.accumulation_steps:
+            self.unsynced = False
+            return contextlib.nullcontext()
+        self.unsynced = True
+        return self.model.no_sync()
+
+    def backward(self, loss_sum: torch.Tensor, num_tokens: Union[torch.Tensor, int]) -> bool:
+        """
+        :param loss_sum: summed (not averaged) loss of one micro-batch
+        :param num_tokens: number of tokens `loss_sum` is summed over
+        :return: True when this call ran an optimizer step
+        """
+        loss_sum.backward()
+        self.tokens = self.tokens + num_tokens
+        self.micro_steps += 1
+        if self.micro_steps < self.accumulation_steps:
+            return False
+        self.step()
+        return True
+
+    def step(self):
+        """
+        divides the accumulated gradients by the token count, (optionally) clips them and steps the optimizer
+        """
+        if self.micro_steps == 0:
+            return
+        grads = [p.grad for p in self.parameters if p.grad is not None]
+        tokens = torch.as_tensor(self.tokens)
+        if get_world_size() > 1:
+            if self.unsynced:
+                # flush after micro-batches that ran under no_sync
+                for grad in grads:
+                    all_reduce_mean(grad)
+                self.unsynced = False
+            tokens = all_reduce_mean(tokens.to(grads[0].device if grads else 'cpu', torch.float32))
+        tokens = tokens.clamp(min=1)
+        for grad in grads:
+            grad.div_(tokens.to(grad.device, grad.dtype))
+        if self.max_grad_norm is not None:
+            torch.nn.utils.clip_grad_norm_(self.parameters, self.max_grad_norm)
+        self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.micro_steps = 0
+        self.tokens = 0
+        self.steps += 1
+
+    def flush(self):
+        """
+        steps on a partial accumulation, call at the end of an epoch so the last micro-batches are not dropped
+        """
+        self.step()
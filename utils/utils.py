@@ -1,21 +1,26 @@
+import atexit
 import os
+import queue
+import threading
 import time
 import typing
 from typing import Union, Optional
 
 import psutil
 import torch
-import tqdm
 from erutils import fprint
 from torch import nn
 from torch.utils.data import Dataset
-from tqdm.auto import tqdm
-from transformers import BertTokenizer, GPT2Tokenizer
+from transformers import BertTokenizer, GPT2Tokenizer, GPT2TokenizerFast
 
 from modules.cross_modules import LLmPConfig
 from modules.modeling_LLMoU import LLMoUConfig
 from modules.modeling_LLmPU import LLmPUConfig
 from modules.modelling_LLAmA import LLamaConfig
+from utils.async_checkpoint import atomic_save
+from utils.pretokenize import PreEncoded
+from utils.token_cache import load_or_pretokenize
+from utils.token_shards import TokenShards
 
 
 class Tokens:
@@ -27,27 +32,109 @@ class Tokens:
 
 
 class GB:
-    def __init__(self, train_data, eval_data, batch_size, chunk_size):
-        self.train_data = train_data
-        self.eval_data = eval_data
+    """
+    random-window batch sampler over contiguous 1D token buffers
+
+    windows are gathered with one index into an `unfold` view of the buffer instead of slicing and stacking every
+    row, `sampling='epoch'` walks shuffled non-overlapping windows so every token is seen once per epoch and
+    `prefetch > 0` builds the next train batches in a background thread
+    """
+
+    def __init__(self, train_data, eval_data, batch_size, chunk_size, sampling: str = 'random', prefetch: int = 0,
+                 seed: typing.Optional[int] = None):
+        if sampling not in ('random', 'epoch'):
+            raise ValueError(f'sampling must be random or epoch, got {sampling}')
+        self.train_data = train_data.reshape(-1).contiguous()
+        self.eval_data = eval_data.reshape(-1).contiguous()
         self.batch_size = batch_size
         self.chunk_size = chunk_size
+        self.sampling = sampling
+        # one generator per split so the prefetch thread never shares RNG state with eval calls
+        self.generator = {'train': torch.Generator(), 'eval': torch.Generator()}
+        if seed is not None:
+            self.generator['train'].manual_seed(seed)
+            self.generator['eval'].manual_seed(seed + 1)
+        else:
+            # an unseeded Generator always starts from the same fixed seed, draw one per split from the process seed
+            # (random per run unless torch.manual_seed was called)
+            seeds = torch.randint(2 ** 62, (2,), generator=torch.Generator().manual_seed(torch.initial_seed()))
+            self.generator['train'].manual_seed(int(seeds[0]))
+            self.generator['eval'].manual_seed(int(seeds[1]))
+        # [num_windows, chunk_size + 1] views, x is [:, :-1] and y is [:, 1:]
+        self.windows = {
+            'train': self.train_data.unfold(0, chunk_size + 1, 1),
+            'eval': self.eval_data.unfold(0, chunk_size + 1, 1)
+        }
+        self.epoch = {'train': 0, 'eval': 0}
+        self._order = {}
+        self._cursor = {}
+        self._queue = None
+        self._stop = threading.Event()
+        self._thread = None
+        if prefetch > 0:
+            self._queue = queue.Queue(maxsize=prefetch)
+            self._thread = threading.Thread(target=self._prefetch, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
 
     def __call__(self, *args, **kwargs):
-        return self.forward(*args, *kwargs)
+        return self.forward(*args, **kwargs)
+
+    def _offsets(self, mode: str) -> torch.Tensor:
+        num_windows = self.windows[mode].shape[0]
+        if self.sampling == 'random':
+            return torch.randint(num_windows, (self.batch_size,), generator=self.generator[mode])
+        if mode not in self._order or self._cursor[mode] + self.batch_size > self._order[mode].numel():
+            if mode in self._order:
+                self.epoch[mode] += 1
+            starts = torch.arange(0, num_windows, self.chunk_size)
+            self._order[mode] = starts[torch.randperm(starts.numel(), generator=self.generator[mode])]
+            self._cursor[mode] = 0
+        ix = self._order[mode][self._cursor[mode]:self._cursor[mode] + self.batch_size]
+        self._cursor[mode] += self.batch_size
+        return ix
+
+    def sample(self, mode: str) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        batch = self.windows[mode][self._offsets(mode)]
+        return batch[:, :-1], batch[:, 1:]
+
+    def _prefetch(self):
+        while not self._stop.is_set():
+            batch = self.sample('train')
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
 
     def forward(self, mode: str, *args, **kwargs):
-        data = self.train_data if mode == 'train' else self.eval_data
-        ix = torch.randint(len(data) - self.chunk_size, (self.batch_size,))
-        x = torch.stack([data[i:i + self.chunk_size] for i in ix])
-        y = torch.stack([data[i + 1:i + self.chunk_size + 1] for i in ix])
-        return x, y
+        mode = 'train' if mode == 'train' else 'eval'
+        if mode == 'train' and self._queue is not None:
+            return self._queue.get()
+        return self.sample(mode)
+
+
+def make_window_pairs(tokens: torch.Tensor, chunk: int) -> torch.Tensor:
+    """
+    :param tokens: token ids of the whole corpus (any shape, read as one flat sequence)
+    :param chunk: window size, every window gives an x of chunk - 2 tokens and a y shifted by one
+    :return: [num_windows, 2, chunk - 2] view over `tokens` ([:, 0] is x and [:, 1] is y), nothing is copied
+    """
+    tokens = tokens.reshape(-1).contiguous()
+    num_windows = tokens.numel() // chunk
+    return tokens.as_strided((num_windows, 2, chunk - 2), (chunk, 1, 1), tokens.storage_offset())
 
 
 def save_checkpoints(name: str, **kwargs):
     v = {**kwargs}
 
-    torch.save(v, name)
+    atomic_save(v, name)
 
 
 def tokenize_words(word: list, first_word_token: int = 0, swap: int = 1001, last_word_token: int = 1002,
@@ -89,7 +176,11 @@ def count_model_parameters(model, div: int = 1e6):
 
 class DatasetQA(Dataset):
     def __init__(self, src=None, trg=None, mode: str = "bert-base-uncased", max_length: int = 512,
-                 pad_to_max_length: bool = True):
+                 pad_to_max_length: bool = True, pre_encode: Optional[str] = 'lazy'):
+        """
+        :param pre_encode: 'eager' encodes every pair up front, 'lazy' encodes a pair the first time it is read and
+         keeps the ids for later epochs, None calls the tokenizer on every read
+        """
         super().__init__()
         self.tokenizer = BertTokenizer.from_pretrained(mode)
 
@@ -99,6 +190,12 @@ class DatasetQA(Dataset):
         self.src = src
         self.max_length = max_length
         self.trg = trg
+        self.pre_encode = pre_encode if src is not None else None
+        if self.pre_encode is not None:
+            self.enc_src = PreEncoded(self.tokenizer, src, max_length=max_length,
+                                      pad_to_max_length=pad_to_max_length, mode=pre_encode)
+            self.enc_trg = PreEncoded(self.tokenizer, trg, max_length=max_length,
+                                      pad_to_max_length=pad_to_max_length, mode=pre_encode)
 
     def __len__(self):
         return len(self.src) if self.src is not None else 1
@@ -115,7 +212,21 @@ class DatasetQA(Dataset):
         )
         return enc_trg
 
+    @staticmethod
+    def _as_encoding(ids: torch.Tensor, mask: torch.Tensor) -> dict:
+        # same keys and [1, seq] shapes encode_plus(return_tensors='pt') gives for a single bert sentence
+        return {
+            'input_ids': ids.unsqueeze(0),
+            'token_type_ids': torch.zeros_like(ids).unsqueeze(0),
+            'attention_mask': mask.unsqueeze(0)
+        }
+
     def __getitem__(self, item):
+        if self.pre_encode is not None:
+            return {
+                'input': self._as_encoding(*self.enc_src[item]),
+                'label': self._as_encoding(*self.enc_trg[item])
+            }
         # src = str(self.src[item])
         # trg = str(self.trg[item]['text'][0])
         src = str(self.src[item])
@@ -174,26 +285,23 @@ class DatasetQA(Dataset):
 class DatasetPGTC(Dataset, Tokens):
     def __init__(self, data=None,
                  mode: str = "gpt2", chunk: int = 184,
+                 cache_dir: Optional[Union[os.PathLike, str]] = None
                  ):
         super().__init__()
 
-        self.input_ids = []
-        self.attention_mask = []
-        self.tokenizer = GPT2Tokenizer.from_pretrained(mode, bos_token=self.sos, eos_token=self.eos,
-                                                       pad_token=self.pad)
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(mode, bos_token=self.sos, eos_token=self.eos,
+                                                           pad_token=self.pad)
         self.chunk = chunk
         self.vocab_size = self.tokenizer.vocab_size
         self.data = data
+        self.tokenized = None
         if self.data is not None:
-            for d in tqdm(self.data):
-                if d != '' and not d.startswith(' ='):
-                    emb = self.tokenizer.encode_plus(self.sos + d + self.eos, truncation=True, return_tensors='pt',
-                                                     max_length=chunk, padding="max_length")
-                    self.attention_mask.append(emb['attention_mask'])
-                    self.input_ids.append(emb['input_ids'])
+            texts = [self.sos + d + self.eos for d in self.data if d != '' and not d.startswith(' =')]
+            self.tokenized = load_or_pretokenize(self.tokenizer, texts, max_length=chunk, padding='max_length',
+                                                 cache_dir=cache_dir, dataset=type(self).__name__)
 
     def __len__(self):
-        return len(self.input_ids)
+        return len(self.tokenized) if self.tokenized is not None else 0
 
     def encode(self, text):
         enc_trg = self.tokenizer.encode_plus(
@@ -208,7 +316,7 @@ class DatasetPGTC(Dataset, Tokens):
         return enc_trg
 
     def __getitem__(self, item):
-        return self.input_ids[item], self.attention_mask[item]
+        return self.tokenized.ids(item).unsqueeze(0), self.tokenized.mask(item).unsqueeze(0)
 
     def decode(self, text):
         text = self.tokenizer.decode(text[0], skip_special_tokens=False)
@@ -234,6 +342,10 @@ class DatasetPGT(Dataset):
                 self.init()
 
     def __len__(self):
+        if isinstance(self.data, TokenShards):
+            return len(self.data) // self.chunk
+        if self.data is not None:
+            return self.data.shape[0]
         return ((len(self.src) // self.chunk) - (
                 self.batch_size * 2) if self.src is not None else 1) if not self.pt_data else self.data.shape[0]
 
@@ -243,6 +355,13 @@ class DatasetPGT(Dataset):
         return data
 
     def init_pt(self, path: typing.Union[str, os.PathLike]):
+        """
+        :param path: a token shard directory written by `utils.token_shards` (memory-mapped, nothing is read
+         until a window is used) or one/many legacy `.pth` files which are concatenated in memory
+        """
+        if isinstance(path, (str, os.PathLike)) and TokenShards.is_shard_dir(path):
+            self.data = TokenShards(path)
+            return
         if isinstance(path, str):
             path = [path]
         data = torch.cat([torch.load(p) for p in path], dim=0)
@@ -262,31 +381,24 @@ class DatasetPGT(Dataset):
 
     def init(self):
         if not self.pt_data:
-            start_from: int = 0
-            data_list = torch.tensor([])
-            total = (len(self.src) // self.chunk) - (self.batch_size * 2)
-            loop = tqdm.tqdm(iterable=range(start_from, total))
-
-            for ipa in loop:
-                data = self.tokenizer.encode_plus(
-                    text=self.src[self.chunk * (ipa + 1):],
-                    add_special_tokens=True,
-                    return_attention_mask=True,
-                    return_tensors='pt',
-                    padding='do_not_pad',
-                    # max_length=self.chunk,
-                    truncation=False
-                )['input_ids']
-                print(data.shape)
-                data_list = torch.cat([data_list, torch.cat([data[:, 0:-2], data[:, 1:-1]], dim=-2).unsqueeze(0)],
-                                      dim=-3)
-                # print(f'\r\033[1;32m Loading Data [{ipa}/{total}]', end='')
-
-            self.data = data_list
+            data = self.tokenizer.encode_plus(
+                text=self.src,
+                add_special_tokens=True,
+                return_attention_mask=False,
+                return_tensors='pt',
+                padding='do_not_pad',
+                truncation=False,
+                verbose=False
+            )['input_ids']
+            self.data = make_window_pairs(data, self.chunk)
         else:
             raise ValueError('You can\'t use init model when your data type is pt')
 
     def __getitem__(self, item):
+        if isinstance(self.data, TokenShards):
+            # same layout as txt_2_pt: windows of `chunk` tokens, x is the first chunk - 2 and y is x shifted by one
+            window = self.data.ids(item * self.chunk, (item + 1) * self.chunk)
+            return window[0:-2].unsqueeze(0), window[1:-1].unsqueeze(0)
         x, y = self.data[item]
         return x.unsqueeze(0), y.unsqueeze(0)
 
@@ -306,23 +418,18 @@ class DatasetPGT(Dataset):
 
 class GPT2Dataset(Dataset, Tokens):
 
-    def __init__(self, txt_list: typing.Optional[typing.List[str]], tokenizer, max_length: typing.Optional[int] = 768):
+    def __init__(self, txt_list: typing.Optional[typing.List[str]], tokenizer, max_length: typing.Optional[int] = 768,
+                 cache_dir: typing.Optional[typing.Union[str, os.PathLike]] = None):
         self.tokenizer = tokenizer
-        self.input_ids = []
-        self.attn_masks = []
-
-        for txt in txt_list:
-            encodings_dict = tokenizer(self.sos + txt + self.eos, truncation=True,
-                                       max_length=max_length, padding="max_length")
-
-            self.input_ids.append(torch.tensor(encodings_dict['input_ids']))
-            self.attn_masks.append(torch.tensor(encodings_dict['attention_mask']))
+        self.tokenized = load_or_pretokenize(tokenizer, [self.sos + txt + self.eos for txt in txt_list],
+                                             max_length=max_length, padding='max_length',
+                                             cache_dir=cache_dir, dataset=type(self).__name__)
 
     def __len__(self):
-        return len(self.input_ids)
+        return len(self.tokenized)
 
     def __getitem__(self, idx):
-        return self.input_ids[idx], self.attn_masks[idx]
+        return self.tokenized.ids(idx), self.tokenized.mask(idx)
 
     def encode(self, text):
         enc_trg = self.tokenizer.encode_plus(